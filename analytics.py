@@ -0,0 +1,336 @@
+"""Engagement data exported for analysis away from the primary database.
+
+`flask analytics export` copies users, messages, likes and follows to files
+under EXPORT_ROOT, as Parquet (needs pyarrow) or gzipped CSV:
+
+    exports/users/users-00000000000000000000.parquet
+    exports/messages/messages-00000000000000052311.parquet
+    exports/followers_following/snapshot.parquet
+    exports/watermarks.json
+
+Rows are read through a server-side cursor and written EXPORT_BATCH_ROWS at
+a time, so memory stays flat however large the tables are.
+
+Users, messages and likes are exported incrementally. watermarks.json holds
+the highest id exported from each, and every run writes one new file with
+the rows after it, named after that watermark: if a run dies before saving
+the watermark, the next one overwrites its file instead of duplicating it.
+A run stops short of rows that may belong to transactions still in flight,
+so their ids are not skipped: for messages and likes, at the first id
+timestamped within EXPORT_LAG; for users, which have no timestamp, at the
+highest id an earlier run saw at least EXPORT_LAG ago (kept under
+"pending" in watermarks.json). Only new rows are exported; later changes
+such as a message's deleted_at or a removed like are not. Follows have
+neither id nor timestamp, so each run replaces a full snapshot of them.
+Delete the directory to start over.
+
+`flask analytics report` reads the files back into NumPy arrays and prints
+daily active posters and the distribution of likes per message.
+"""
+
+import csv
+import gzip
+import json
+import os
+from datetime import datetime, timedelta
+
+import click
+import numpy as np
+from flask import current_app
+from flask.cli import AppGroup
+from sqlalchemy import DateTime, Integer, func, select
+
+from models import db
+from partitions import arrow_type
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # pragma: no cover - CSV exports work without it
+    pa = None
+
+EXPORT_BATCH_ROWS = 10_000
+EXPORT_LAG = timedelta(minutes=1)
+
+FORMATS = ('parquet', 'csv')
+EXTENSIONS = {'parquet': '.parquet', 'csv': '.csv.gz'}
+
+# Exported columns; users leave out emails and password hashes.
+EXPORT_COLUMNS = {
+    'users': ('id', 'username', 'location', 'last_active_at'),
+    'messages': ('id', 'user_id', 'text', 'timestamp', 'deleted_at'),
+    'likes': ('id', 'user_id', 'message_id', 'timestamp'),
+    'followers_following': ('follower_id', 'following_id'),
+}
+INCREMENTAL_TABLES = ('users', 'messages', 'likes')
+
+analytics_cli = AppGroup('analytics', help='Export engagement data and summarize it.')
+
+
+##############################################################################
+# Export
+
+def load_watermarks(root):
+    try:
+        with open(os.path.join(root, 'watermarks.json')) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def save_watermarks(root, marks):
+    path = os.path.join(root, 'watermarks.json')
+    tmp = f"{path}.tmp"
+    with open(tmp, 'w') as f:
+        json.dump(marks, f, indent=2, sort_keys=True)
+    os.replace(tmp, path)
+
+
+def _write_parquet(path, columns, batches):
+    schema = pa.schema([(c.name, arrow_type(c)) for c in columns])
+    with pq.ParquetWriter(path, schema, compression='zstd') as writer:
+        for rows in batches:
+            writer.write_batch(pa.RecordBatch.from_pylist(
+                [dict(row._mapping) for row in rows], schema=schema))
+
+
+def _write_csv(path, columns, batches):
+    with gzip.open(path, 'wt', newline='') as f:
+        out = csv.writer(f)
+        out.writerow([c.name for c in columns])
+        for rows in batches:
+            out.writerows(rows)
+
+
+def write_result(path, fmt, columns, result):
+    """Stream `result` to `path`; return (rows written, last row).
+
+    Nothing is left behind when there are no rows.
+    """
+    written = [0, None]
+
+    def batches():
+        for rows in result.partitions():
+            written[0] += len(rows)
+            written[1] = rows[-1]
+            yield rows
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    (_write_parquet if fmt == 'parquet' else _write_csv)(tmp, columns, batches())
+    if written[0]:
+        os.replace(tmp, path)
+    else:
+        os.remove(tmp)
+    return tuple(written)
+
+
+def _stream(stmt):
+    return db.session.execute(stmt, execution_options={'yield_per': EXPORT_BATCH_ROWS})
+
+
+def export_new_rows(root, table, fmt, after=0, until=None):
+    """Export rows of `table` with id > `after`; return (count, new watermark).
+
+    With `until`, rows from that id on are left for later.
+    """
+    t = db.metadata.tables[table]
+    columns = [t.c[name] for name in EXPORT_COLUMNS[table]]
+    stmt = select(*columns).where(t.c.id > after).order_by(t.c.id)
+    if until is not None:
+        stmt = stmt.where(t.c.id < until)
+    path = os.path.join(root, table, f"{table}-{after:020d}{EXTENSIONS[fmt]}")
+    count, last = write_result(path, fmt, columns, _stream(stmt))
+    return count, last.id if count else after
+
+
+def first_lagging_id(table, after, before):
+    """Lowest id above `after` timestamped at or after `before`, or None."""
+    t = db.metadata.tables[table]
+    return db.session.scalar(select(func.min(t.c.id)).where(t.c.id > after,
+                                                            t.c.timestamp >= before))
+
+
+def settled_by_age(table, seen, before, now):
+    """(id bound for `table` rows settled by `before`, [max id, time] to keep).
+
+    `seen` is the [max id, ISO time] an earlier run kept. Once it is older
+    than `before` every row up to that id has been committed; until then
+    nothing is. A fresh max id is kept whenever the old one is used up.
+    """
+    until = 0
+    if seen is not None and datetime.fromisoformat(seen[1]) <= before:
+        until, seen = seen[0] + 1, None
+    if seen is None:
+        t = db.metadata.tables[table]
+        seen = [db.session.scalar(select(func.max(t.c.id))) or 0, now.isoformat()]
+    return until, seen
+
+
+def export_snapshot(root, table, fmt):
+    """Replace the full snapshot of `table`; return the row count."""
+    t = db.metadata.tables[table]
+    columns = [t.c[name] for name in EXPORT_COLUMNS[table]]
+    stmt = select(*columns).order_by(*t.primary_key.columns)
+    path = os.path.join(root, table, f"snapshot{EXTENSIONS[fmt]}")
+    count, _ = write_result(path, fmt, columns, _stream(stmt))
+    for ext in EXTENSIONS.values():
+        stale = os.path.join(root, table, f"snapshot{ext}")
+        if (stale != path or not count) and os.path.exists(stale):
+            os.remove(stale)
+    return count
+
+
+def export(root, fmt='csv', now=None):
+    """Export every table under `root`; return {table: rows written}."""
+    if fmt == 'parquet' and pa is None:
+        raise RuntimeError("pyarrow is required for Parquet exports.")
+    now = now or datetime.utcnow()
+    before = now - EXPORT_LAG
+    marks = load_watermarks(root)
+    pending = marks.setdefault('pending', {})
+    written = {}
+    for table in INCREMENTAL_TABLES:
+        after = marks.get(table, 0)
+        if 'timestamp' in db.metadata.tables[table].c:
+            until = first_lagging_id(table, after, before)
+        else:
+            until, pending[table] = settled_by_age(table, pending.get(table), before, now)
+        written[table], marks[table] = export_new_rows(root, table, fmt, after, until)
+        save_watermarks(root, marks)
+    written['followers_following'] = export_snapshot(root, 'followers_following', fmt)
+    return written
+
+
+##############################################################################
+# Reports
+
+def _dtype(column):
+    if isinstance(column.type, Integer):
+        return np.int64
+    if isinstance(column.type, DateTime):
+        return 'datetime64[us]'
+    return object
+
+
+def export_files(root, table):
+    folder = os.path.join(root, table)
+    if not os.path.isdir(folder):
+        return []
+    return sorted(os.path.join(folder, name) for name in os.listdir(folder)
+                  if name.endswith(tuple(EXTENSIONS.values())))
+
+
+def read_columns(root, table, names):
+    """Columns `names` from every exported file of `table`, as NumPy arrays."""
+    t = db.metadata.tables[table]
+    dtypes = {name: _dtype(t.c[name]) for name in names}
+    parts = {name: [] for name in names}
+    for path in export_files(root, table):
+        if path.endswith('.parquet'):
+            if pa is None:
+                raise RuntimeError("pyarrow is required to read Parquet exports.")
+            data = pq.read_table(path, columns=list(names))
+            for name in names:
+                parts[name].append(data.column(name).to_numpy().astype(dtypes[name]))
+            continue
+        with gzip.open(path, 'rt', newline='') as f:
+            reader = csv.reader(f)
+            header = next(reader)
+            positions = [header.index(name) for name in names]
+            values = [[] for _ in names]
+            for row in reader:
+                for column, i in zip(values, positions):
+                    column.append(row[i])
+        for name, column in zip(names, values):
+            parts[name].append(np.array(column, dtype=dtypes[name]))
+    return {name: np.concatenate(parts[name]) if parts[name] else np.array([], dtypes[name])
+            for name in names}
+
+
+def daily_active_posters(user_ids, timestamps):
+    """(days, counts): how many distinct users posted on each day, oldest first."""
+    days = timestamps.astype('datetime64[D]')
+    pairs = np.unique(np.stack([days.astype(np.int64), user_ids]), axis=1)
+    active, counts = np.unique(pairs[0], return_counts=True)
+    return active.astype('datetime64[D]'), counts
+
+
+def like_distribution(message_ids, liked_message_ids, percentiles=(50, 90, 99)):
+    """Summary of likes per message over `message_ids`, as a dict.
+
+    Likes of other messages are ignored. 'histogram' maps "0", "1", "2-3",
+    "4-7", ... to how many messages got that many likes.
+    """
+    messages = np.sort(message_ids)
+    positions = np.searchsorted(messages, liked_message_ids)
+    inside = positions < len(messages)
+    inside[inside] = messages[positions[inside]] == liked_message_ids[inside]
+    counts = np.bincount(positions[inside], minlength=len(messages))
+    summary = {'messages': len(messages), 'likes': int(counts.sum()),
+               'liked_messages': int(np.count_nonzero(counts)), 'histogram': {}}
+    if not len(messages):
+        return summary
+    summary['mean'] = float(counts.mean())
+    summary['max'] = int(counts.max())
+    for p, value in zip(percentiles, np.percentile(counts, percentiles)):
+        summary[f"p{p}"] = float(value)
+    # frexp's exponent is 0 for 0, 1 for 1, 2 for 2-3, 3 for 4-7, ...
+    buckets = np.bincount(np.frexp(counts)[1])
+    summary['histogram'] = {_bucket_label(b): int(n) for b, n in enumerate(buckets) if n}
+    return summary
+
+
+def _bucket_label(bucket):
+    if bucket < 2:
+        return str(bucket)
+    return f"{2 ** (bucket - 1)}-{2 ** bucket - 1}"
+
+
+def report(root, days=14):
+    """Daily active posters over the last `days` exported days and the like distribution."""
+    messages = read_columns(root, 'messages', ('id', 'user_id', 'timestamp', 'deleted_at'))
+    likes = read_columns(root, 'likes', ('message_id',))
+    active_days, counts = daily_active_posters(messages['user_id'], messages['timestamp'])
+    live = np.isnat(messages['deleted_at'])
+    return {'daily_active_posters': list(zip(active_days[-days:].tolist(), counts[-days:].tolist())),
+            'likes_per_message': like_distribution(messages['id'][live], likes['message_id'])}
+
+
+##############################################################################
+# CLI
+
+@analytics_cli.command('export')
+@click.option('--format', 'fmt', type=click.Choice(FORMATS),
+              default='parquet' if pa is not None else 'csv', show_default=True)
+@click.option('--root', default=None, help='Export directory (default: EXPORT_ROOT).')
+def export_command(fmt, root):
+    """Export rows added since the last run."""
+    root = root or current_app.config['EXPORT_ROOT']
+    try:
+        written = export(root, fmt)
+    except RuntimeError as exc:
+        raise click.ClickException(str(exc))
+    finally:
+        db.session.rollback()
+    for table, count in written.items():
+        click.echo(f"{table}: {count} rows")
+
+
+@analytics_cli.command('report')
+@click.option('--root', default=None, help='Export directory (default: EXPORT_ROOT).')
+@click.option('--days', default=14, help='Days of active posters to show.')
+def report_command(root, days):
+    """Summarize the exported data."""
+    summary = report(root or current_app.config['EXPORT_ROOT'], days)
+    click.echo("Daily active posters:")
+    for day, count in summary['daily_active_posters']:
+        click.echo(f"  {day}  {count}")
+    likes = summary['likes_per_message']
+    click.echo(f"Likes per message: {likes['likes']} likes on {likes['liked_messages']} "
+               f"of {likes['messages']} messages")
+    if likes['messages']:
+        click.echo("  mean {mean:.2f}  p50 {p50:g}  p90 {p90:g}  p99 {p99:g}  max {max}"
+                   .format(**likes))
+        for label, count in likes['histogram'].items():
+            click.echo(f"  {label:>9}  {count}")
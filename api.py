@@ -0,0 +1,522 @@
+"""JSON API (v1) for mobile clients.
+
+Every endpoint selects only the columns it serializes (no ORM instances are
+built), pages with an opaque keyset cursor and accepts a `fields` param for
+sparse fieldsets, e.g. `/api/v1/timeline?fields=id,text&limit=20`.
+"""
+
+import base64
+import json
+import time
+from datetime import datetime
+
+from flask import Blueprint, Response, current_app, g, request
+from sqlalchemy import select, delete, func, tuple_
+
+from broker import broker
+from deletes import soft_delete
+from likes import insert_like, like_lock
+from events import stage
+from notifications import LIKE, notify
+from posting import IDEMPOTENCY_KEY_MAX, post_message
+from profiles import invalidate as invalidate_profiles
+from models import db, User, Message, Like, followers_following
+from partitions import archived_messages, partitioned
+from recent import recent_messages
+from timeline import load_timeline
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - stdlib fallback
+    orjson = None
+
+api = Blueprint('api', __name__, url_prefix='/api/v1')
+
+DEFAULT_LIMIT = 20
+MAX_LIMIT = 100
+MAX_MESSAGE_LENGTH = 140
+
+# Streams send a comment every STREAM_HEARTBEAT seconds to keep proxies from
+# closing them, and end after STREAM_MAX_SECONDS so the client reconnects
+# (with Last-Event-ID) and picks up follow changes. They are off unless
+# TIMELINE_STREAM is set (see gunicorn.conf.py for why).
+STREAM_HEARTBEAT = 15
+STREAM_MAX_SECONDS = 300
+
+# Public columns a client may ask for. Email and password are never exposed.
+MESSAGE_COLUMNS = {
+    'id': Message.id,
+    'text': Message.text,
+    'timestamp': Message.timestamp,
+    'user_id': Message.user_id,
+    'username': User.username,
+    'image_url': User.image_url,
+}
+
+USER_COLUMNS = {
+    'id': User.id,
+    'username': User.username,
+    'image_url': User.image_url,
+    'header_image_url': User.header_image_url,
+    'bio': User.bio,
+    'location': User.location,
+}
+
+# Counters are computed with correlated subqueries in the same SELECT.
+USER_COUNTERS = {
+    'messages_count': lambda: (select(func.count(Message.id))
+                               .where(Message.user_id == User.id,
+                                      Message.deleted_at.is_(None))
+                               .scalar_subquery()),
+    'followers_count': lambda: (select(func.count())
+                                .select_from(followers_following)
+                                .where(followers_following.c.following_id == User.id)
+                                .scalar_subquery()),
+    'following_count': lambda: (select(func.count())
+                                .select_from(followers_following)
+                                .where(followers_following.c.follower_id == User.id)
+                                .scalar_subquery()),
+}
+
+USER_DETAIL_FIELDS = {**USER_COLUMNS, **USER_COUNTERS}
+
+
+class APIError(Exception):
+    """Error that is rendered as a JSON body with the given status.
+
+    `retry_after` (seconds) is sent as a Retry-After header.
+    """
+
+    def __init__(self, message, status=400, retry_after=None):
+        super().__init__(message)
+        self.message = message
+        self.status = status
+        self.retry_after = retry_after
+
+
+@api.errorhandler(APIError)
+def handle_api_error(err):
+    resp = json_response({'error': err.message}, err.status)
+    if err.retry_after is not None:
+        resp.headers['Retry-After'] = str(err.retry_after)
+    return resp
+
+
+@api.errorhandler(404)
+def handle_not_found(err):
+    return json_response({'error': 'Not found.'}, 404)
+
+
+@api.errorhandler(429)
+def handle_too_many_requests(err):
+    resp = json_response({'error': err.description}, 429)
+    resp.headers['Retry-After'] = str(err.retry_after)
+    return resp
+
+
+##############################################################################
+# Serialization helpers
+
+def _default(obj):
+    if isinstance(obj, datetime):
+        return obj.isoformat()
+    raise TypeError(f"Cannot serialize {type(obj).__name__}")
+
+
+def dumps(payload):
+    """Serialize `payload` to bytes with orjson when available."""
+    if orjson is not None:
+        return orjson.dumps(payload, default=_default)
+    return json.dumps(payload, default=_default, separators=(',', ':')).encode()
+
+
+def json_response(payload, status=200):
+    return Response(dumps(payload), status=status, mimetype='application/json')
+
+
+def parse_fields(available, args=None):
+    """Return the list of requested field names from `?fields=`."""
+    raw = (request.args if args is None else args).get('fields')
+    if not raw:
+        return list(available)
+    fields = [f.strip() for f in raw.split(',') if f.strip()]
+    unknown = [f for f in fields if f not in available]
+    if unknown:
+        raise APIError(f"Unknown field(s): {', '.join(unknown)}")
+    return fields
+
+
+def parse_limit(args=None):
+    try:
+        limit = int((request.args if args is None else args).get('limit', DEFAULT_LIMIT))
+    except ValueError:
+        raise APIError("limit must be an integer")
+    return max(1, min(limit, MAX_LIMIT))
+
+
+def encode_cursor(*values):
+    raw = '|'.join(v.isoformat() if isinstance(v, datetime) else str(v) for v in values)
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor, *types):
+    """Decode a cursor built by `encode_cursor` into a tuple of `types`."""
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        parts = base64.urlsafe_b64decode(padded.encode()).decode().split('|')
+        if len(parts) != len(types):
+            raise ValueError
+        return tuple(datetime.fromisoformat(p) if t is datetime else t(p)
+                     for p, t in zip(parts, types))
+    except ValueError:
+        raise APIError("Invalid cursor")
+
+
+def page(rows, fields, limit, cursor_of):
+    """Build a paginated payload from `rows` fetched with `limit + 1`.
+
+    `cursor_of(row)` returns the keyset values for the next-page cursor.
+    """
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    data = [{f: row._mapping[f] for f in fields} for row in rows]
+    next_cursor = encode_cursor(*cursor_of(rows[-1])) if has_more else None
+    return {'data': data, 'next_cursor': next_cursor}
+
+
+def require_login():
+    if not g.user:
+        raise APIError("Authentication required.", 401)
+
+
+def message_page(rows, fields, limit):
+    return page(rows, fields, limit,
+                lambda r: (r._mapping['_cursor_ts'], r._mapping['_cursor_id']))
+
+
+def message_select(fields):
+    columns = [MESSAGE_COLUMNS[f].label(f) for f in fields]
+    columns += [Message.timestamp.label('_cursor_ts'), Message.id.label('_cursor_id')]
+    return (select(*columns).select_from(Message).join(User, User.id == Message.user_id)
+            .where(Message.deleted_at.is_(None)))
+
+
+def likes_select(fields, user_id, before=None):
+    """Messages liked by `user_id` newest like first, paged like `message_page`."""
+    columns = [MESSAGE_COLUMNS[f].label(f) for f in fields]
+    columns += [Like.timestamp.label('_cursor_ts'), Like.id.label('_cursor_id')]
+    stmt = (select(*columns)
+            .select_from(Like)
+            .join(Message, Message.id == Like.message_id)
+            .join(User, User.id == Message.user_id)
+            .where(Like.user_id == user_id, Message.deleted_at.is_(None)))
+    if before is not None:
+        stmt = stmt.where(tuple_(Like.timestamp, Like.id) < before)
+    return stmt.order_by(Like.timestamp.desc(), Like.id.desc())
+
+
+def user_select(fields):
+    columns = [USER_COUNTERS[f]().label(f) if f in USER_COUNTERS
+               else USER_COLUMNS[f].label(f) for f in fields]
+    return select(*columns, User.id.label('_cursor_id')).select_from(User)
+
+
+def followed_select(user_id):
+    return (select(followers_following.c.following_id)
+            .where(followers_following.c.follower_id == user_id))
+
+
+def followed_ids(user_id):
+    """Ids of the users `user_id` follows."""
+    return set(db.session.execute(followed_select(user_id)).scalars())
+
+
+def user_exists(user_id):
+    exists = db.session.execute(select(User.id).where(User.id == user_id)).first()
+    if exists is None:
+        raise APIError("User not found.", 404)
+
+
+##############################################################################
+# Timeline & messages
+
+@api.route('/timeline')
+def timeline():
+    """Messages from the current user and everyone they follow."""
+    require_login()
+    fields = parse_fields(MESSAGE_COLUMNS)
+    limit = parse_limit()
+    cursor = request.args.get('cursor')
+    before = decode_cursor(cursor, datetime, int) if cursor else None
+    rows = load_timeline(g.user.id, message_select(fields),
+                         lambda s: db.session.execute(s).all(), limit + 1, before)
+    if current_app.config['TIMELINE_PRECOMPUTED']:
+        # Keep the timeline if load_timeline just materialized it.
+        db.session.commit()
+    return json_response(message_page(rows, fields, limit))
+
+
+def sse_event(message_id):
+    return f"id: {message_id}\nevent: message\ndata: {{\"id\": {message_id}}}\n\n"
+
+
+def require_streaming():
+    if not current_app.config['TIMELINE_STREAM']:
+        raise APIError("Timeline streaming is not enabled.", 404)
+
+
+def parse_last_event_id(value):
+    try:
+        return int(value)
+    except ValueError:
+        raise APIError("Last-Event-ID must be an integer")
+
+
+def missed_select(author_ids, last_id):
+    """Ids a stream reconnecting after `last_id` has not seen yet, oldest first."""
+    return (select(Message.id)
+            .where(Message.user_id.in_(author_ids), Message.id > last_id,
+                   Message.deleted_at.is_(None))
+            .order_by(Message.id)
+            .limit(MAX_LIMIT))
+
+
+@api.route('/timeline/stream')
+def timeline_stream():
+    """Server-sent events carrying the ids of new timeline messages.
+
+    Only ids are pushed; clients fetch the messages themselves (for example
+    from /timeline) when they choose to show them. A reconnecting client
+    sends Last-Event-ID and first receives the ids it missed.
+    """
+    require_streaming()
+    require_login()
+    author_ids = followed_ids(g.user.id) | {g.user.id}
+    last_id = request.headers.get('Last-Event-ID') or request.args.get('last_id')
+    last_id = parse_last_event_id(last_id) if last_id else None
+
+    # Subscribe before reading the backlog so nothing falls in between.
+    sub = broker.subscribe(author_ids)
+
+    missed = []
+    if last_id is not None:
+        missed = list(db.session.execute(missed_select(author_ids, last_id)).scalars())
+
+    heartbeat = current_app.config.get('STREAM_HEARTBEAT', STREAM_HEARTBEAT)
+    max_seconds = current_app.config.get('STREAM_MAX_SECONDS', STREAM_MAX_SECONDS)
+
+    def events():
+        with sub:
+            sent = set(missed)
+            for message_id in missed:
+                yield sse_event(message_id)
+            deadline = time.monotonic() + max_seconds
+            while time.monotonic() < deadline:
+                message_id = sub.get(timeout=min(heartbeat, max_seconds))
+                if message_id is None:
+                    yield ": keep-alive\n\n"
+                elif message_id not in sent:
+                    yield sse_event(message_id)
+
+    return Response(events(), mimetype='text/event-stream',
+                    headers={'X-Accel-Buffering': 'no'})
+
+
+@api.route('/messages', methods=['POST'])
+def create_message():
+    """Create a message for the current user from `{"text": ...}`.
+
+    Retrying with the same Idempotency-Key header returns the message the
+    first request created (200 rather than 201) instead of posting it again.
+    """
+    require_login()
+    body = request.get_json(silent=True) or {}
+    text = (body.get('text') or '').strip()
+    if not text:
+        raise APIError("text is required")
+    if len(text) > MAX_MESSAGE_LENGTH:
+        raise APIError(f"text must be at most {MAX_MESSAGE_LENGTH} characters")
+
+    key = request.headers.get('Idempotency-Key')
+    if key is not None and not 0 < len(key) <= IDEMPOTENCY_KEY_MAX:
+        raise APIError(f"Idempotency-Key must be 1 to {IDEMPOTENCY_KEY_MAX} characters")
+
+    post = post_message(g.user.id, text, key)
+    return json_response({'id': post.id, 'text': post.text,
+                          'timestamp': post.timestamp, 'user_id': post.user_id},
+                         201 if post.created else 200)
+
+
+@api.route('/messages/<int:message_id>', methods=['DELETE'])
+def delete_message(message_id):
+    """Delete one of the current user's messages.
+
+    The message is only marked deleted here; `flask messages purge` removes
+    it and its likes later.
+    """
+    require_login()
+    owner_id = db.session.execute(
+        select(Message.user_id).where(Message.id == message_id,
+                                      Message.deleted_at.is_(None))).scalar()
+    if owner_id is None:
+        raise APIError("Message not found.", 404)
+    if owner_id != g.user.id:
+        raise APIError("You can only delete your own messages.", 403)
+
+    soft_delete(message_id)
+    stage('message_deleted', message_id=message_id, user_id=g.user.id)
+    invalidate_profiles(g.user.id)
+    db.session.commit()
+    recent_messages.remove(g.user.id, message_id)
+    return Response(status=204)
+
+
+##############################################################################
+# Users
+
+@api.route('/users/<int:user_id>')
+def user_detail(user_id):
+    """A single user's public profile, with counters."""
+    fields = parse_fields(USER_DETAIL_FIELDS)
+    row = db.session.execute(user_select(fields).where(User.id == user_id)).first()
+    if row is None:
+        raise APIError("User not found.", 404)
+    return json_response({f: row._mapping[f] for f in fields})
+
+
+@api.route('/users/<int:user_id>/archive')
+def user_archive(user_id):
+    """A user's archived messages (from exported partitions), newest first."""
+    user_exists(user_id)
+    limit = parse_limit()
+    cursor = request.args.get('cursor')
+    before = decode_cursor(cursor, datetime, int) if cursor else None
+    rows = archived_messages(current_app.config['ARCHIVE_ROOT'], user_id, before, limit + 1)
+    next_cursor = None
+    if len(rows) > limit:
+        next_cursor = encode_cursor(rows[limit - 1]['timestamp'], rows[limit - 1]['id'])
+    return json_response({'data': rows[:limit], 'next_cursor': next_cursor})
+
+
+def _follow_page(user_id, match_col, other_col):
+    user_exists(user_id)
+    fields = parse_fields(USER_COLUMNS)
+    stmt = (user_select(fields)
+            .join(followers_following, other_col == User.id)
+            .where(match_col == user_id))
+    cursor = request.args.get('cursor')
+    if cursor:
+        (after_id,) = decode_cursor(cursor, int)
+        stmt = stmt.where(User.id > after_id)
+    limit = parse_limit()
+    rows = db.session.execute(stmt.order_by(User.id).limit(limit + 1)).all()
+    return json_response(page(rows, fields, limit, lambda r: (r._mapping['_cursor_id'],)))
+
+
+@api.route('/users/<int:user_id>/followers')
+def user_followers(user_id):
+    """Users following `user_id`."""
+    return _follow_page(user_id,
+                        followers_following.c.following_id,
+                        followers_following.c.follower_id)
+
+
+@api.route('/users/<int:user_id>/following')
+def user_following(user_id):
+    """Users `user_id` is following."""
+    return _follow_page(user_id,
+                        followers_following.c.follower_id,
+                        followers_following.c.following_id)
+
+
+def _follow_targets():
+    body = request.get_json(silent=True) or {}
+    ids, usernames = body.get('ids') or [], body.get('usernames') or []
+    if not isinstance(ids, list) or not isinstance(usernames, list):
+        raise APIError("ids and usernames must be lists")
+    try:
+        return [int(i) for i in ids], [str(u) for u in usernames]
+    except (TypeError, ValueError):
+        raise APIError("ids must be integers")
+
+
+def _following_count(user_id):
+    return db.session.execute(
+        select(func.count()).select_from(followers_following)
+        .where(followers_following.c.follower_id == user_id)).scalar()
+
+
+@api.route('/follows', methods=['POST'])
+def bulk_follow():
+    """Follow many users from `{"ids": [...], "usernames": [...]}`."""
+    require_login()
+    ids, usernames = _follow_targets()
+    try:
+        added = g.user.follow_many(ids=ids, usernames=usernames)
+    except ValueError as err:
+        raise APIError(str(err))
+    db.session.commit()
+    return json_response({'followed': added, 'following_count': _following_count(g.user.id)})
+
+
+@api.route('/follows', methods=['DELETE'])
+def bulk_unfollow():
+    """Unfollow many users from `{"ids": [...], "usernames": [...]}`."""
+    require_login()
+    ids, usernames = _follow_targets()
+    try:
+        removed = g.user.unfollow_many(ids=ids, usernames=usernames)
+    except ValueError as err:
+        raise APIError(str(err))
+    db.session.commit()
+    return json_response({'unfollowed': removed,
+                          'following_count': _following_count(g.user.id)})
+
+
+##############################################################################
+# Likes
+
+@api.route('/users/<int:user_id>/likes')
+def user_likes(user_id):
+    """Messages liked by `user_id`, most recently liked first."""
+    user_exists(user_id)
+    fields = parse_fields(MESSAGE_COLUMNS)
+    cursor = request.args.get('cursor')
+    before = decode_cursor(cursor, datetime, int) if cursor else None
+    limit = parse_limit()
+    rows = db.session.execute(likes_select(fields, user_id, before).limit(limit + 1)).all()
+    return json_response(message_page(rows, fields, limit))
+
+
+@api.route('/messages/<int:message_id>/like', methods=['POST'])
+def like_message(message_id):
+    """Like a message as the current user."""
+    require_login()
+    owner_id = db.session.execute(
+        select(Message.user_id).where(Message.id == message_id,
+                                      Message.deleted_at.is_(None))).scalar()
+    if owner_id is None:
+        raise APIError("Message not found.", 404)
+    if owner_id == g.user.id:
+        raise APIError("You cannot like your own warbles.", 403)
+
+    if partitioned(db.session.connection(), 'likes'):
+        db.session.execute(like_lock(g.user.id, message_id))
+    liked = db.session.execute(insert_like(g.user.id, message_id)).first()
+    if liked is not None:
+        stage('like', user_id=g.user.id, message_id=message_id)
+        notify(LIKE, [owner_id], g.user.id, message_id)
+    db.session.commit()
+    return json_response({'message_id': message_id, 'liked': True})
+
+
+@api.route('/messages/<int:message_id>/like', methods=['DELETE'])
+def unlike_message(message_id):
+    """Remove the current user's like from a message."""
+    require_login()
+    result = db.session.execute(delete(Like).where(Like.user_id == g.user.id,
+                                                   Like.message_id == message_id))
+    if result.rowcount:
+        stage('unlike', user_id=g.user.id, message_id=message_id)
+    db.session.commit()
+    return json_response({'message_id': message_id, 'liked': False})
@@ -1,10 +1,37 @@
 import os
-from flask import Flask, render_template, request, flash, redirect, session, g, jsonify, url_for
+import re
+from datetime import datetime
+from flask import Flask, render_template, request, flash, redirect, session, g, jsonify, url_for, abort
+from werkzeug.exceptions import TooManyRequests
 # from flask_debugtoolbar import DebugToolbarExtension
 from sqlalchemy.exc import IntegrityError, SQLAlchemyError
-from sqlalchemy import or_
-from forms import UserAddForm, LoginForm, MessageForm, UserProfileForm
+from sqlalchemy import or_, select
+from forms import UserAddForm, LoginForm, MessageForm, UserProfileForm, FollowImportForm
 from models import db, connect_db, User, Message, Like, followers_following
+from api import api, APIError, encode_cursor, decode_cursor
+from media import media, save_upload, MediaError
+from broker import broker, RedisBackend
+from ratelimit import limiter, RedisBackend as SharedRateLimitBackend
+from sessions import init_sessions
+from partitions import partitions_cli
+from timeline import timeline_cli, load_timeline, server_timing as timeline_timing
+from recent import recent_messages, server_timing as recent_timing
+from profiling import init_profiling
+from profiles import (load_profile, cached_profile, home_counters, live_message_count,
+                      invalidate as invalidate_profiles, profile_cache)
+from cache import SharedStore
+from events import events_cli, event_log, stage
+from usernames import usernames_cli, username_ids
+from posting import posts_cli, post_message, group_writer
+from directory import directory_cli, directory_page, cursor_types, followed_among
+from deletes import messages_cli, soft_delete
+from analytics import analytics_cli
+from preload import preload_cli
+from likes import likes_cli
+from follows import follows_cli
+from readmodels import message_card_select, message_cards
+from notifications import (FOLLOW, LIKE, MENTION, notify, notification_writer, notifications_page, mark_read,
+                           unread_count, unread_counts)
 
 CURR_USER_KEY = "curr_user"
 
@@ -19,22 +46,120 @@ app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['SQLALCHEMY_ECHO'] = False
 app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', "it's a secret")
+# 'cookie' (Flask's signed cookie), 'memory' or 'sql'; see sessions.py.
+app.config['SESSION_BACKEND'] = os.environ.get('SESSION_BACKEND', 'cookie')
+app.config['MEDIA_ROOT'] = os.environ.get('MEDIA_ROOT', os.path.join(app.root_path, 'media'))
+# Cold message/like partitions are exported here; see partitions.py.
+app.config['ARCHIVE_ROOT'] = os.environ.get('ARCHIVE_ROOT', os.path.join(app.root_path, 'archive'))
+app.config['ARCHIVE_AFTER_MONTHS'] = int(os.environ.get('ARCHIVE_AFTER_MONTHS', 12))
+app.config['EXPORT_ROOT'] = os.environ.get('EXPORT_ROOT', os.path.join(app.root_path, 'exports'))
+# Materialize timelines of users following many accounts; see timeline.py.
+app.config['TIMELINE_PRECOMPUTED'] = os.environ.get('TIMELINE_PRECOMPUTED', '0') == '1'
+# Memory budget of the per-worker recent-messages cache (0 turns it off).
+app.config['RECENT_CACHE_BYTES'] = int(os.environ.get('RECENT_CACHE_BYTES', 32 * 1024 * 1024))
+# Fraction of requests to CPU-profile into PROFILE_DIR (0 is off); see profiling.py.
+app.config['PROFILE_SAMPLE_RATE'] = float(os.environ.get('PROFILE_SAMPLE_RATE', 0))
+app.config['PROFILE_MODE'] = os.environ.get('PROFILE_MODE', 'sample')
+app.config['PROFILE_INTERVAL'] = float(os.environ.get('PROFILE_INTERVAL', 0.005))
+app.config['PROFILE_DIR'] = os.environ.get('PROFILE_DIR', os.path.join(app.root_path, 'profiles'))
+app.config['PROFILE_FLUSH_INTERVAL'] = float(os.environ.get('PROFILE_FLUSH_INTERVAL', 10))
+# Append-only log of likes, follows and messages ('' turns it off); see events.py.
+app.config['EVENT_LOG_DIR'] = os.environ.get('EVENT_LOG_DIR', os.path.join(app.root_path, 'events'))
+app.config['EVENT_LOG_SEGMENT_BYTES'] = int(os.environ.get('EVENT_LOG_SEGMENT_BYTES', 64 * 1024 * 1024))
+app.config['EVENT_LOG_FSYNC'] = os.environ.get('EVENT_LOG_FSYNC', '0') == '1'
+# Seconds a profile's first page is cached, then served stale while one
+# request reloads it (0 turns the cache off); see cache.py and profiles.py.
+app.config['PROFILE_CACHE_TTL'] = float(os.environ.get('PROFILE_CACHE_TTL', 30))
+app.config['PROFILE_CACHE_STALE'] = float(os.environ.get('PROFILE_CACHE_STALE', 300))
+# Batch concurrent message posts into shared commits; see posting.py.
+app.config['POST_GROUP_COMMIT'] = os.environ.get('POST_GROUP_COMMIT', '0') == '1'
+app.config['POST_GROUP_COMMIT_WINDOW'] = float(os.environ.get('POST_GROUP_COMMIT_WINDOW', 0.002))
+# Seconds notifications from likes/follows/mentions are collected before one
+# batched write (0 writes them in the request's own transaction); see notifications.py.
+app.config['NOTIFY_FLUSH_INTERVAL'] = float(os.environ.get('NOTIFY_FLUSH_INTERVAL', 1.0))
+# Most followed users whose profiles and recent messages gunicorn loads
+# before forking workers (0 skips them); see preload.py.
+app.config['PRELOAD_AUTHORS'] = int(os.environ.get('PRELOAD_AUTHORS', 200))
+# Live timeline updates over server-sent events. Each open stream holds a
+# connection for minutes, so only turn this on under the ASGI entry point or
+# gevent workers; see gunicorn.conf.py.
+app.config['TIMELINE_STREAM'] = os.environ.get('TIMELINE_STREAM', '0') == '1'
+app.config['RATELIMIT_ENABLED'] = os.environ.get('RATELIMIT_ENABLED', '1') != '0'
+# Per-endpoint overrides of ratelimit.DEFAULT_POLICIES, e.g.
+# {'like': [Policy(10, 60, 'user')]}
+app.config['RATE_LIMITS'] = {}
 # toolbar = DebugToolbarExtension(app)
 
 # if app.debug:
 #     from flask_debugtoolbar import DebugToolbarExtension
 #     toolbar = DebugToolbarExtension(app)
 
+init_sessions(app, app.config['SESSION_BACKEND'])
 connect_db(app)
 app.app_context().push()
 db.create_all()
 
+# Share live timeline publishes and rate limit buckets between workers when a
+# Redis URL is given; otherwise each worker keeps its own.
+if os.environ.get('REDIS_URL'):
+    import redis
+    redis_client = redis.Redis.from_url(os.environ['REDIS_URL'])
+    broker.use_backend(RedisBackend(redis_client))
+    limiter.backend = SharedRateLimitBackend(redis_client)
+    profile_cache.store = SharedStore(redis_client)
+    unread_counts.store = SharedStore(redis_client)
+
+limiter.policies.update(app.config['RATE_LIMITS'])
+recent_messages.max_bytes = app.config['RECENT_CACHE_BYTES']
+profile_cache.ttl = app.config['PROFILE_CACHE_TTL']
+profile_cache.stale_ttl = app.config['PROFILE_CACHE_STALE']
+if app.config['POST_GROUP_COMMIT']:
+    group_writer.app = app
+    group_writer.window = app.config['POST_GROUP_COMMIT_WINDOW']
+if app.config['NOTIFY_FLUSH_INTERVAL'] > 0:
+    notification_writer.app = app
+    notification_writer.interval = app.config['NOTIFY_FLUSH_INTERVAL']
+event_log.root = app.config['EVENT_LOG_DIR']
+event_log.segment_bytes = app.config['EVENT_LOG_SEGMENT_BYTES']
+event_log.fsync = app.config['EVENT_LOG_FSYNC']
+
+app.register_blueprint(api)
+app.register_blueprint(media)
+app.cli.add_command(partitions_cli)
+app.cli.add_command(timeline_cli)
+app.cli.add_command(events_cli)
+app.cli.add_command(usernames_cli)
+app.cli.add_command(directory_cli)
+app.cli.add_command(messages_cli)
+app.cli.add_command(analytics_cli)
+app.cli.add_command(preload_cli)
+app.cli.add_command(likes_cli)
+app.cli.add_command(follows_cli)
+app.cli.add_command(posts_cli)
+init_profiling(app)
+
 ##############################################################################
 # User signup/login/logout
 
 @app.before_request
 def add_user_to_g():
-    """If we're logged in, add curr user to Flask global."""
+    """If we're logged in, add curr user to Flask global.
+
+    Rate limits are checked first, using only the session and client IP, so a
+    throttled request is rejected before any database work; the session is
+    only read once the IP limits have passed. Static and media files skip
+    this entirely, so they never load the session.
+    """
+    if request.endpoint in ('static', 'media.serve'):
+        return
+
+    if app.config['RATELIMIT_ENABLED']:
+        retry_after = limiter.check(request.endpoint, request.method,
+                                    lambda: session.get(CURR_USER_KEY), request.remote_addr)
+        if retry_after is not None:
+            raise TooManyRequests("You're doing that too often. Please slow down.",
+                                  retry_after=retry_after)
+
     if CURR_USER_KEY in session:
         g.user = User.query.get(session[CURR_USER_KEY])
     else:
@@ -42,6 +167,9 @@ def add_user_to_g():
 
 def do_login(user):
     """Log in user."""
+    if hasattr(session, 'regenerate'):
+        # Server-side sessions get a fresh id on login.
+        session.regenerate()
     session[CURR_USER_KEY] = user.id
 
 def do_logout():
@@ -108,67 +236,43 @@ def logout():
 def list_users():
     """Page with listing of users.
 
-    Can take a 'q' param in querystring to search by that username.
+    Can take a 'q' param in querystring to search by that username. Pages
+    are keyset-paginated by 'cursor'; with 'fragment' the page comes back as
+    JSON card HTML for infinite scroll. See directory.py.
     """
-    search = request.args.get('q')
-
-    if not search:
-        users = User.query.all()
-        flash('Displaying all users', 'info')
-    else:
-        users = User.query.filter(User.username.like(f"%{search}%")).all()
-
-    return render_template('users/index.html', users=users)
+    q = request.args.get('q') or None
+    cursor = request.args.get('cursor')
+    if cursor:
+        try:
+            cursor = decode_cursor(cursor, *cursor_types(q))
+        except APIError:
+            abort(400)
+    users, next_cursor = directory_page(cursor, q)
+    followed = followed_among(g.user.id, [u.id for u in users]) if g.user else set()
+    next_cursor = encode_cursor(*next_cursor) if next_cursor else None
+
+    if request.args.get('fragment'):
+        html = render_template('users/_cards.html', users=users, followed=followed)
+        return jsonify(html=html, next_cursor=next_cursor)
+    return render_template('users/index.html', users=users, followed=followed,
+                           next_cursor=next_cursor, q=q)
 
 @app.route('/users/<int:user_id>')
 def users_show(user_id):
     """Show user profile."""
+    page = max(request.args.get('page', 1, type=int), 1)
+    if page == 1:
+        return render_template('users/show.html', **cached_profile(user_id, g.user))
     user = User.query.get_or_404(user_id)
-    is_own_profile = g.user == user
-
-    liked_messages = [message.id for message in user.user_liked_messages]  # Get a list of liked message IDs
-
-    # Calculate the counts
-    following_count = user.following.count()
-    followers_count = user.followers.count()
-
-    # Fetch messages for the user and others they are following
-    followed_users = [user.id for user in g.user.following]
-    messages = (Message.query.join(User)
-                    .filter((User.id.in_(followed_users)) | (User.id == g.user.id))
-                    .order_by(Message.timestamp.desc())
-                    .limit(100)
-                    .all())
-
-    messages_liked_by_user = user.user_liked_messages  # Fetch liked messages for the user
-    messages_liked_by_others = Message.query.filter(Message.id.in_(liked_messages)).all()  # Fetch messages liked by others
-
-    return render_template(
-        'users/show.html',
-        user=user,
-        messages=messages,
-        is_own_profile=is_own_profile,
-        liked_messages=liked_messages,
-        messages_liked_by_user=messages_liked_by_user,
-        messages_liked_by_others=messages_liked_by_others,
-        following_count=following_count,
-        followers_count=followers_count  # Pass the counts to the template
-    )
+    return render_template('users/show.html', **load_profile(user, g.user, page))
 
 @app.route('/users/<string:username>')
 def user_profile(username):
     """Show user profile."""
-    user = User.query.filter_by(username=username).first_or_404()
-    is_own_profile = g.user == user
-
-    # Add your profile rendering logic here
-
-    return render_template(
-        'users/show.html',
-        user=user,
-        is_own_profile=is_own_profile,
-        # Other variables you want to pass to the template
-    )
+    user_id = username_ids.get(username)
+    if user_id is None:
+        abort(404)
+    return users_show(user_id)
 
 @app.route('/users/<int:user_id>/following')
 def show_following(user_id):
@@ -180,7 +284,8 @@ def show_following(user_id):
     user = User.query.get_or_404(user_id)
     follower_count = user.followers.count()  # Count of followers for the profile being viewed
     
-    return render_template('users/following.html', user=user, follower_count=follower_count)
+    return render_template('users/following.html', user=user, follower_count=follower_count,
+                           message_count=db.session.scalar(select(live_message_count(user.id))))
 
 
 @app.route('/users/<int:user_id>/followers')
@@ -192,7 +297,8 @@ def users_followers(user_id):
   
     user = User.query.get_or_404(user_id)
 
-    return render_template('users/followers.html', user=user)
+    return render_template('users/followers.html', user=user,
+                           message_count=db.session.scalar(select(live_message_count(user.id))))
 
 @app.route('/users/follow/<int:follow_id>', methods=['POST'])
 def add_follow(follow_id):
@@ -202,17 +308,12 @@ def add_follow(follow_id):
         return redirect("/")
 
     followed_user = User.query.get_or_404(follow_id)
-    
-    # Check if the user is already following
-    if g.user.is_following(followed_user):
-        flash(f"You are already following {followed_user.username}.", "info")
-    else:
-        # Add the user to the following list
-        g.user.following.append(followed_user)
-        # Add the current user to the follower list of the followed user
-        followed_user.followers.append(g.user)
+
+    if g.user.follow_many(ids=[follow_id]):
         db.session.commit()
         flash(f"You are now following {followed_user.username}.", "success")
+    else:
+        flash(f"You are already following {followed_user.username}.", "info")
 
     return redirect(f"/users/{follow_id}")
 
@@ -220,21 +321,12 @@ def add_follow(follow_id):
 @app.route('/users/stop-following/<int:user_id>', methods=['POST'])
 def stop_following(user_id):
     """Stop following a user."""
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
 
-    # Check if the logged-in user is following the user to be unfollowed
-    if g.user.is_following(user_id):
-        # Remove the relationship
-        followed_user = User.query.get(user_id)
-        g.user.following.remove(followed_user)
+    if g.user.unfollow_many(ids=[user_id]):
         db.session.commit()
-
-        # Update the counts for the current user (who is unfollowing)
-        g.user.following_count = g.user.following.count()
-        # Update the counts for the user who was unfollowed
-        followed_user.followers_count = followed_user.followers.count()
-
-        db.session.commit()  # Commit the updates to the counts
-
         flash('You have stopped following this user.', 'success')
     else:
         flash('You are not following this user.', 'danger')
@@ -245,24 +337,23 @@ def stop_following(user_id):
 
 @app.route('/users/follow-unfollow/<int:user_id>', methods=['POST'])
 def follow_unfollow(user_id):
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
     user_to_follow_unfollow = User.query.get_or_404(user_id)
     action = request.form.get('action')
 
     if action == 'follow':
-        if not g.user.is_following(user_to_follow_unfollow):
-            g.user.follow(user_to_follow_unfollow)
+        if g.user.follow_many(ids=[user_id]):
             flash(f'You are now following {user_to_follow_unfollow.username}.', 'success')
         else:
             flash(f'You are already following {user_to_follow_unfollow.username}.', 'info')
     elif action == 'unfollow':
-        # Check if there is exactly one row to delete
-        delete_count = db.session.query(followers_following).filter_by(follower_id=g.user.id, following_id=user_id).delete()
-        if delete_count == 1:
+        if g.user.unfollow_many(ids=[user_id]):
             flash(f'You have unfollowed {user_to_follow_unfollow.username}.', 'success')
-        elif delete_count == 0:
-            flash(f'You are not following {user_to_follow_unfollow.username}.', 'danger')
         else:
-            flash(f'You are now following {user_to_follow_unfollow.username}.', 'success')
+            flash(f'You are not following {user_to_follow_unfollow.username}.', 'danger')
 
     db.session.commit()
 
@@ -270,6 +361,28 @@ def follow_unfollow(user_id):
     return redirect(url_for('user_profile', username=user_to_follow_unfollow.username))
 
 
+@app.route('/users/follows/import', methods=["GET", "POST"])
+def import_follows():
+    """Follow many users at once from a pasted list of usernames."""
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    form = FollowImportForm()
+    if form.validate_on_submit():
+        usernames = [u.lstrip('@') for u in re.split(r'[\s,]+', form.usernames.data) if u]
+        try:
+            added = g.user.follow_many(usernames=usernames)
+        except ValueError as err:
+            flash(str(err), "danger")
+            return render_template('users/import_follows.html', form=form)
+        db.session.commit()
+        flash(f"You are now following {added} more user(s).", "success")
+        return redirect(f"/users/{g.user.id}/following")
+
+    return render_template('users/import_follows.html', form=form)
+
+
 #__________________________________________________________________________________________________
 @app.route('/users/profile', methods=["GET", "POST"])
 def profile():
@@ -280,12 +393,20 @@ def profile():
     user_id = g.user.id
     form = UserProfileForm(obj=g.user)
     if form.validate():
+        try:
+            image_url = save_upload(form.image_file.data) or form.image_url.data
+            header_image_url = (save_upload(form.header_image_file.data)
+                                or form.header_image_url.data)
+        except MediaError as err:
+            flash(str(err), "danger")
+            return render_template('users/edit.html', form=form, user_id=user_id)
         g.user.username = form.username.data
         g.user.email = form.email.data
         g.user.bio = form.bio.data
-        g.user.image_url = form.image_url.data
-        g.user.header_image_url = form.header_image_url.data
+        g.user.image_url = image_url
+        g.user.header_image_url = header_image_url
         g.user.location = form.location.data
+        invalidate_profiles(g.user.id)
         db.session.commit()
         flash("Profile updated.", "success")
         return redirect(f"/users/{g.user.id}")
@@ -325,6 +446,7 @@ def delete_user(user_id):
 
                 # Delete the user
                 db.session.delete(user)
+                invalidate_profiles(user_id)
                 db.session.commit()
                 flash('User deleted successfully', 'success')
             except Exception as e:
@@ -355,54 +477,94 @@ def messages_add():
         return redirect("/")
     form = MessageForm()
     if form.validate_on_submit():
-        msg = Message(text=form.text.data)
-        g.user.messages.append(msg)
-        db.session.commit()
+        post_message(g.user.id, form.text.data, form.idempotency_key.data)
         return redirect(f"/users/{g.user.id}")
     return render_template('messages/new.html', form=form)
 
 @app.route('/messages/<int:message_id>', methods=["GET"])
 def messages_show(message_id):
     """Show a message."""
-    msg = Message.query.get(message_id)
+    msg = Message.query.filter_by(id=message_id, deleted_at=None).first_or_404()
     return render_template('messages/show.html', message=msg)
 
 @app.route('/messages/<int:message_id>/delete', methods=["POST"])
 def messages_destroy(message_id):
-    """Delete a message."""
+    """Delete one of the current user's messages (see deletes.py)."""
     if not g.user:
         flash("Access unauthorized.", "danger")
         return redirect("/")
-    msg = Message.query.get(message_id)
-    db.session.delete(msg)
+    author_id = db.session.execute(
+        select(Message.user_id).where(Message.id == message_id,
+                                      Message.deleted_at.is_(None))).scalar()
+    if author_id is None:
+        abort(404)
+    if author_id != g.user.id:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+    soft_delete(message_id)
+    stage('message_deleted', message_id=message_id, user_id=author_id)
+    invalidate_profiles(author_id)
     db.session.commit()
+    recent_messages.remove(author_id, message_id)
     return redirect(f"/users/{g.user.id}")
 
+##############################################################################
+# Notifications
+
+@app.route('/notifications')
+def notifications_index():
+    """The current user's notifications, newest first; the ones shown are marked read."""
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+    cursor = request.args.get('cursor')
+    if cursor:
+        try:
+            cursor = decode_cursor(cursor, datetime, int)
+        except APIError:
+            abort(400)
+    rows, next_cursor = notifications_page(g.user.id, cursor)
+    html = render_template('notifications/index.html', notifications=rows,
+                           next_cursor=encode_cursor(*next_cursor) if next_cursor else None,
+                           FOLLOW=FOLLOW, LIKE=LIKE, MENTION=MENTION)
+    if mark_read(g.user.id, [row.id for row in rows if row.read_at is None]):
+        db.session.commit()
+    return html
+
+
+@app.context_processor
+def notification_context():
+    # Called from base.html only when someone is logged in.
+    return {'unread_notifications': lambda: unread_count(g.user.id)}
+
 ##############################################################################
 # Homepage and error pages
 
 @app.route('/')
 def homepage():
     if g.user:
-        followed_users = [user.id for user in g.user.following]
-        messages_query = (Message.query.join(User)
-                    .filter((User.id.in_(followed_users)) | (User.id == g.user.id))
-                    .order_by(Message.timestamp.desc())
-                    .limit(100))
-        
-        # Execute the query and retrieve the count
-        messages = messages_query.all()
-        messages_count = messages_query.count()
-        
-        liked_messages_count = Like.query.filter_by(user_id=g.user.id).count()
-        return render_template('home.html', messages=messages, messages_count=messages_count, liked_messages_count=liked_messages_count, user=g.user)
+        messages = message_cards(load_timeline(g.user.id, message_card_select(),
+                                               lambda s: db.session.execute(s).all(), 100))
+        if app.config['TIMELINE_PRECOMPUTED']:
+            # Keep the timeline if load_timeline just materialized it.
+            db.session.commit()
+        message_count, liked_messages_count = home_counters(g.user.id)
+        return render_template('home.html', messages=messages, message_count=message_count, liked_messages_count=liked_messages_count, user=g.user)
     else:
         return render_template('home-anon.html')
 
 
 @app.after_request
 def add_header(req):
-    """Add non-caching headers on every request."""
+    """Add non-caching headers on every request.
+
+    Media files are content-addressed and keep their immutable headers.
+    """
+    if request.blueprint == 'media':
+        return req
+    timings = [t for t in (timeline_timing(), recent_timing()) if t]
+    if timings:
+        req.headers['Server-Timing'] = ', '.join(timings)
     req.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
     req.headers["Pragma"] = "no-cache"
     req.headers["Expires"] = "0"
@@ -415,7 +577,7 @@ def like(message_id):
         flash('You must be logged in to like warbles.', 'danger')
         return redirect(url_for('login'))
     
-    message = Message.query.get_or_404(message_id)
+    message = Message.query.filter_by(id=message_id, deleted_at=None).first_or_404()
     
     if message.user_id == g.user.id:
         flash('You cannot like your own warbles.', 'danger')
@@ -424,6 +586,8 @@ def like(message_id):
     else:
         like = Like(user_id=g.user.id, message_id=message_id)
         db.session.add(like)
+        stage('like', user_id=g.user.id, message_id=message_id)
+        notify(LIKE, [message.user_id], g.user.id, message_id)
         db.session.commit()
         flash('You liked a warble!', 'success')
     
@@ -435,11 +599,12 @@ def unlike(message_id):
         flash('You must be logged in to unlike warbles.', 'danger')
         return redirect(url_for('login'))
     
-    message = Message.query.get_or_404(message_id)
+    message = Message.query.filter_by(id=message_id, deleted_at=None).first_or_404()
     
     if message in g.user.user_liked_messages:
         like = Like.query.filter_by(user_id=g.user.id, message_id=message_id).first()
         db.session.delete(like)
+        stage('unlike', user_id=g.user.id, message_id=message_id)
         db.session.commit()
         flash('You unliked a warble.', 'success')
     else:
@@ -451,9 +616,11 @@ def unlike(message_id):
 def liked_messages(user_id):
     """Show liked messages by a specific user."""
     user = User.query.get_or_404(user_id)
-    liked_messages = user.user_liked_messages  # Fetch liked messages for the user
-    
-    return render_template('users/liked_messages.html', user=user, liked_messages=liked_messages)
+    page = request.args.get('page', 1, type=int)
+    liked_messages, has_next = Message.liked_by(user.id, page=max(page, 1))
+
+    return render_template('users/liked_messages.html', user=user,
+                           liked_messages=liked_messages, page=page, has_next=has_next)
 
 
 
@@ -0,0 +1,332 @@
+"""ASGI entry point for the async serving mode.
+
+    uvicorn asgi:app --workers 4
+
+The I/O-bound JSON endpoints below are served as native coroutines on
+SQLAlchemy's asyncio engine (asyncpg), so one worker can keep many requests
+waiting on the database at once:
+
+    GET    /api/v1/timeline
+    GET    /api/v1/users/<id>
+    GET    /api/v1/users/<id>/likes
+    POST   /api/v1/messages/<id>/like
+    DELETE /api/v1/messages/<id>/like
+
+They build exactly the same statements and payloads as the sync views in
+api.py. So does the timeline stream (GET /api/v1/timeline/stream), which here
+waits on an asyncio queue instead of holding a thread for its whole life;
+this is the entry point to serve it from. Every other path (HTML pages,
+forms, the rest of the API) is handed to the regular Flask app through
+asgiref's WSGI adapter, which runs it in a thread pool.
+
+The native views still share some blocking code with the sync app: the
+session store (SESSION_BACKEND=sql), the rate limiter, caches and the event
+log, which may all be network or disk calls. Those run in the default
+executor through `asyncio.to_thread`, so they never stall the event loop.
+"""
+
+import asyncio
+import os
+import re
+from datetime import datetime
+from http.cookies import SimpleCookie
+from urllib.parse import parse_qsl
+
+from asgiref.wsgi import WsgiToAsgi
+from sqlalchemy import select, delete
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import create_async_engine
+
+from api import (APIError, MESSAGE_COLUMNS, STREAM_HEARTBEAT, STREAM_MAX_SECONDS,
+                 USER_DETAIL_FIELDS, dumps, followed_select, likes_select, message_page,
+                 message_select, missed_select, parse_fields, parse_last_event_id,
+                 parse_limit, decode_cursor, sse_event, user_select)
+from app import app as flask_app, CURR_USER_KEY
+from broker import broker
+from events import log_committed, make_event
+from likes import insert_like, like_lock
+from models import User, Message, Like
+from notifications import (LIKE, aggregate, notification_events, unread_counts, unread_key,
+                           upsert_rows, upsert_statement)
+from partitions import partitioned, windowed
+from timeline import newest_page, plan_for, stats_select, timeline_condition
+from ratelimit import limiter
+from sessions import ServerSessionInterface, session_data
+
+
+def async_database_url(url):
+    """Swap the sync Postgres driver in `url` for asyncpg."""
+    url = make_url(url)
+    if url.get_backend_name() == 'postgresql':
+        url = url.set(drivername='postgresql+asyncpg')
+    return url
+
+
+engine = create_async_engine(
+    async_database_url(flask_app.config['SQLALCHEMY_DATABASE_URI']),
+    pool_size=int(os.environ.get('ASYNC_POOL_SIZE', 20)),
+    max_overflow=int(os.environ.get('ASYNC_MAX_OVERFLOW', 10)),
+)
+
+wsgi_app = WsgiToAsgi(flask_app)
+
+
+##############################################################################
+# Request helpers
+
+_UNSET = object()
+
+
+class Request:
+    """The parts of an ASGI HTTP scope the async views need."""
+
+    def __init__(self, scope):
+        self.method = scope['method']
+        self.path = scope['path']
+        self.args = dict(parse_qsl(scope['query_string'].decode()))
+        self.headers = {k.decode().lower(): v.decode() for k, v in scope['headers']}
+        self._user_id = _UNSET
+
+    def load_user_id(self):
+        """Id of the logged-in user from the session cookie. May block on the session store."""
+        if self._user_id is _UNSET:
+            cookie = SimpleCookie(self.headers.get('cookie', ''))
+            morsel = cookie.get(flask_app.config['SESSION_COOKIE_NAME'])
+            self._user_id = (None if morsel is None else
+                             session_data(flask_app, morsel.value).get(CURR_USER_KEY))
+        return self._user_id
+
+    async def user_id(self):
+        # Signed cookies are checked in place; server-side sessions are a store lookup.
+        if (self._user_id is _UNSET
+                and isinstance(flask_app.session_interface, ServerSessionInterface)):
+            return await asyncio.to_thread(self.load_user_id)
+        return self.load_user_id()
+
+    async def require_login(self):
+        user_id = await self.user_id()
+        if user_id is None:
+            raise APIError("Authentication required.", 401)
+        return user_id
+
+
+async def send_json(send, payload, status=200, retry_after=None):
+    body = dumps(payload) if payload is not None else b''
+    headers = [(b'content-length', str(len(body)).encode()),
+               (b'cache-control', b'public, max-age=0')]
+    if payload is not None:
+        headers.append((b'content-type', b'application/json'))
+    if retry_after is not None:
+        headers.append((b'retry-after', str(retry_after).encode()))
+    await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+    await send({'type': 'http.response.body', 'body': body})
+
+
+##############################################################################
+# Async views
+
+async def timeline(req):
+    user_id = await req.require_login()
+    fields = parse_fields(MESSAGE_COLUMNS, req.args)
+    limit = parse_limit(req.args)
+    cursor = req.args.get('cursor')
+    before = decode_cursor(cursor, datetime, int) if cursor else None
+    async with engine.connect() as conn:
+        stats = (await conn.execute(stats_select(user_id))).one()
+        # Materializing a timeline is a write; leave precomputed ones to the sync app.
+        # The merge plan needs the recent-message cache, which these views don't fill.
+        plan = plan_for(stats.follows, stats.recent, engine.dialect.name)
+        stmt = newest_page(message_select(fields).where(
+            timeline_condition(plan, user_id, limit + 1, before)), limit + 1, before)
+        if plan != 'in_list' or not await conn.run_sync(partitioned):
+            rows = (await conn.execute(stmt)).all()
+        else:
+            for last, bounded in windowed(stmt, before[0] if before else None):
+                rows = (await conn.execute(bounded)).all()
+                if last or len(rows) > limit:
+                    break
+    return message_page(rows, fields, limit)
+
+
+async def user_detail(req, user_id):
+    fields = parse_fields(USER_DETAIL_FIELDS, req.args)
+    async with engine.connect() as conn:
+        row = (await conn.execute(user_select(fields).where(User.id == user_id))).first()
+    if row is None:
+        raise APIError("User not found.", 404)
+    return {f: row._mapping[f] for f in fields}
+
+
+async def user_likes(req, user_id):
+    fields = parse_fields(MESSAGE_COLUMNS, req.args)
+    limit = parse_limit(req.args)
+    cursor = req.args.get('cursor')
+    before = decode_cursor(cursor, datetime, int) if cursor else None
+    async with engine.connect() as conn:
+        if (await conn.execute(select(User.id).where(User.id == user_id))).first() is None:
+            raise APIError("User not found.", 404)
+        rows = (await conn.execute(likes_select(fields, user_id, before).limit(limit + 1))).all()
+    return message_page(rows, fields, limit)
+
+
+async def like(req, message_id):
+    user_id = await req.require_login()
+    async with engine.begin() as conn:
+        owner_id = (await conn.execute(
+            select(Message.user_id).where(Message.id == message_id,
+                                          Message.deleted_at.is_(None)))).scalar()
+        if owner_id is None:
+            raise APIError("Message not found.", 404)
+        if owner_id == user_id:
+            raise APIError("You cannot like your own warbles.", 403)
+        if await conn.run_sync(partitioned, 'likes'):
+            await conn.execute(like_lock(user_id, message_id))
+        liked = (await conn.execute(insert_like(user_id, message_id))).first()
+        if liked is not None:
+            # Written right here even when the sync app batches notifications.
+            await conn.execute(upsert_statement(engine.dialect.name), upsert_rows(aggregate(
+                notification_events(LIKE, [owner_id], user_id, message_id))))
+    if liked is not None:
+        await asyncio.to_thread(unread_counts.delete, unread_key(owner_id))
+        await asyncio.to_thread(log_committed,
+                                [make_event('like', user_id=user_id, message_id=message_id)])
+    return {'message_id': message_id, 'liked': True}
+
+
+async def unlike(req, message_id):
+    user_id = await req.require_login()
+    async with engine.begin() as conn:
+        result = await conn.execute(delete(Like).where(Like.user_id == user_id,
+                                                       Like.message_id == message_id))
+    if result.rowcount:
+        await asyncio.to_thread(log_committed,
+                                [make_event('unlike', user_id=user_id, message_id=message_id)])
+    return {'message_id': message_id, 'liked': False}
+
+
+async def wait_for_disconnect(receive):
+    while (await receive())['type'] != 'http.disconnect':
+        pass
+
+
+async def timeline_stream(req, receive, send):
+    """Server-sent events carrying the ids of new timeline messages."""
+    if not flask_app.config['TIMELINE_STREAM']:
+        raise APIError("Timeline streaming is not enabled.", 404)
+    user_id = await req.require_login()
+    last_id = req.headers.get('last-event-id') or req.args.get('last_id')
+    last_id = parse_last_event_id(last_id) if last_id else None
+    heartbeat = flask_app.config.get('STREAM_HEARTBEAT', STREAM_HEARTBEAT)
+    max_seconds = flask_app.config.get('STREAM_MAX_SECONDS', STREAM_MAX_SECONDS)
+    loop = asyncio.get_running_loop()
+
+    async with engine.connect() as conn:
+        author_ids = set((await conn.execute(followed_select(user_id))).scalars()) | {user_id}
+        # Subscribe before reading the backlog so nothing falls in between.
+        sub = broker.subscribe(author_ids, loop=loop)
+        try:
+            missed = []
+            if last_id is not None:
+                missed = list((await conn.execute(missed_select(author_ids, last_id))).scalars())
+        except BaseException:
+            sub.close()
+            raise
+
+    await send({'type': 'http.response.start', 'status': 200, 'headers': [
+        (b'content-type', b'text/event-stream; charset=utf-8'),
+        (b'cache-control', b'no-cache'),
+        (b'x-accel-buffering', b'no')]})
+    disconnected = asyncio.ensure_future(wait_for_disconnect(receive))
+    with sub:
+        try:
+            sent = set(missed)
+            for message_id in missed:
+                await send({'type': 'http.response.body', 'body': sse_event(message_id).encode(),
+                            'more_body': True})
+            deadline = loop.time() + max_seconds
+            while not disconnected.done() and loop.time() < deadline:
+                message_id = await sub.get(timeout=min(heartbeat, max_seconds))
+                if message_id is None:
+                    chunk = ": keep-alive\n\n"
+                elif message_id not in sent:
+                    chunk = sse_event(message_id)
+                else:
+                    continue
+                await send({'type': 'http.response.body', 'body': chunk.encode(),
+                            'more_body': True})
+        finally:
+            disconnected.cancel()
+    await send({'type': 'http.response.body', 'body': b''})
+
+
+# (method, path, view, endpoint name the sync view has for rate limiting)
+ROUTES = [
+    ('GET', re.compile(r'^/api/v1/timeline$'), timeline, 'api.timeline'),
+    ('GET', re.compile(r'^/api/v1/users/(\d+)$'), user_detail, 'api.user_detail'),
+    ('GET', re.compile(r'^/api/v1/users/(\d+)/likes$'), user_likes, 'api.user_likes'),
+    ('POST', re.compile(r'^/api/v1/messages/(\d+)/like$'), like, 'api.like_message'),
+    ('DELETE', re.compile(r'^/api/v1/messages/(\d+)/like$'), unlike, 'api.unlike_message'),
+]
+
+STREAM_PATH = re.compile(r'^/api/v1/timeline/stream$')
+
+
+def match(method, path):
+    for route_method, pattern, view, endpoint in ROUTES:
+        found = pattern.match(path)
+        if found and route_method == method:
+            return view, endpoint, [int(arg) for arg in found.groups()]
+    return None, None, None
+
+
+async def check_rate_limit(scope, req, endpoint):
+    if not flask_app.config['RATELIMIT_ENABLED']:
+        return
+    client = scope.get('client')
+    retry_after = await asyncio.to_thread(limiter.check, endpoint, req.method,
+                                          req.load_user_id, client[0] if client else None)
+    if retry_after is not None:
+        raise APIError("You're doing that too often. Please slow down.", 429,
+                       retry_after=retry_after)
+
+
+##############################################################################
+# ASGI application
+
+async def lifespan(receive, send):
+    while True:
+        event = await receive()
+        if event['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif event['type'] == 'lifespan.shutdown':
+            await engine.dispose()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def app(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        return await lifespan(receive, send)
+
+    if scope['type'] == 'http':
+        if scope['method'] == 'GET' and STREAM_PATH.match(scope['path']):
+            req = Request(scope)
+            try:
+                await check_rate_limit(scope, req, 'api.timeline_stream')
+                return await timeline_stream(req, receive, send)
+            except APIError as err:
+                return await send_json(send, {'error': err.message}, err.status,
+                                       err.retry_after)
+
+        view, endpoint, args = match(scope['method'], scope['path'])
+        if view is not None:
+            req = Request(scope)
+            try:
+                await check_rate_limit(scope, req, endpoint)
+                payload = await view(req, *args)
+            except APIError as err:
+                return await send_json(send, {'error': err.message}, err.status,
+                                       err.retry_after)
+            return await send_json(send, payload)
+
+    return await wsgi_app(scope, receive, send)
@@ -0,0 +1,135 @@
+"""Sync (gunicorn) vs async (uvicorn + asgi.py) serving at high concurrency.
+
+Starts each server in turn against the same database, drives it with an
+asyncio keep-alive HTTP client and prints throughput and latency percentiles.
+
+    python benchmarks/bench_async.py --concurrency 256 --duration 10
+
+Seed the database first (python seed.py). The timeline endpoint needs a
+logged-in user; the script signs a session cookie for --user-id itself.
+"""
+
+import argparse
+import asyncio
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+SERVERS = {
+    'gunicorn-sync': ['gunicorn', 'app:app', '-k', 'sync'],
+    'gunicorn-gthread': ['gunicorn', 'app:app', '-k', 'gthread', '--threads', '32'],
+    'uvicorn-asgi': ['uvicorn', 'asgi:app'],
+}
+
+
+def session_cookie(user_id):
+    from app import app, CURR_USER_KEY
+    serializer = app.session_interface.get_signing_serializer(app)
+    return f"{app.config['SESSION_COOKIE_NAME']}={serializer.dumps({CURR_USER_KEY: user_id})}"
+
+
+def server_command(name, port, workers):
+    cmd = list(SERVERS[name])
+    if name.startswith('gunicorn'):
+        cmd += ['--workers', str(workers), '--bind', f'127.0.0.1:{port}']
+    else:
+        cmd += ['--workers', str(workers), '--port', str(port), '--log-level', 'warning']
+    return cmd
+
+
+async def wait_for_port(port, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            _, writer = await asyncio.open_connection('127.0.0.1', port)
+            writer.close()
+            return
+        except OSError:
+            await asyncio.sleep(0.2)
+    raise RuntimeError(f"server on port {port} did not start")
+
+
+async def client(port, request, deadline, latencies, errors):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    try:
+        while time.monotonic() < deadline:
+            start = time.perf_counter()
+            writer.write(request)
+            await writer.drain()
+            status_line = await reader.readline()
+            length = 0
+            while True:
+                line = await reader.readline()
+                if line in (b'\r\n', b''):
+                    break
+                name, _, value = line.decode().partition(':')
+                if name.lower() == 'content-length':
+                    length = int(value)
+            await reader.readexactly(length)
+            if b' 200 ' not in status_line:
+                errors.append(status_line)
+            latencies.append(time.perf_counter() - start)
+    except (ConnectionError, asyncio.IncompleteReadError) as exc:
+        errors.append(exc)
+    finally:
+        writer.close()
+
+
+async def drive(port, path, cookie, concurrency, duration):
+    request = (f"GET {path} HTTP/1.1\r\nHost: 127.0.0.1\r\n"
+               f"Cookie: {cookie}\r\nConnection: keep-alive\r\n\r\n").encode()
+    latencies, errors = [], []
+    deadline = time.monotonic() + duration
+    started = time.monotonic()
+    await asyncio.gather(*(client(port, request, deadline, latencies, errors)
+                           for _ in range(concurrency)))
+    return latencies, errors, time.monotonic() - started
+
+
+def percentile(values, pct):
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--path', default='/api/v1/timeline')
+    parser.add_argument('--user-id', type=int, default=1)
+    parser.add_argument('--concurrency', type=int, default=256)
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--servers', default=','.join(SERVERS))
+    args = parser.parse_args()
+
+    cookie = session_cookie(args.user_id)
+    print(f"{args.path}  concurrency={args.concurrency}  workers={args.workers}  "
+          f"duration={args.duration}s")
+    print(f"{'server':<18}{'req/s':>10}{'p50 ms':>10}{'p99 ms':>10}{'errors':>8}")
+
+    for name in args.servers.split(','):
+        proc = subprocess.Popen(server_command(name, args.port, args.workers), cwd=ROOT,
+                                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            asyncio.run(wait_for_port(args.port))
+            latencies, errors, elapsed = asyncio.run(
+                drive(args.port, args.path, cookie, args.concurrency, args.duration))
+        finally:
+            proc.terminate()
+            proc.wait()
+        print(f"{name:<18}{len(latencies) / elapsed:>10.0f}"
+              f"{percentile(latencies, 50) * 1000:>10.1f}"
+              f"{percentile(latencies, 99) * 1000:>10.1f}{len(errors):>8}")
+        if latencies:
+            print(f"{'':<18}mean {statistics.mean(latencies) * 1000:.1f} ms")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+"""Posting throughput with and without group commit.
+
+Seeds a throwaway author (named bench_post_*), then has --threads threads
+post --posts messages each, once committing every post on its own and once
+through the group-commit writer, and prints posts per second and how many
+commits each run needed:
+
+    python benchmarks/bench_posting.py --threads 1,8,32 --posts 50 --window 0.002
+
+Run it against a scratch database (DATABASE_URL); the seeded rows are
+deleted again at the end.
+"""
+
+import argparse
+import os
+import sys
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from app import app  # noqa: E402
+from models import db, User  # noqa: E402
+import posting  # noqa: E402
+from posting import GroupCommitWriter, post_message  # noqa: E402
+
+PREFIX = 'bench_post_'
+
+
+def seed():
+    user = User(username=f"{PREFIX}author", email=f"{PREFIX}author@example.com", password='x')
+    db.session.add(user)
+    db.session.commit()
+    return user.id
+
+
+def run(user_id, threads, posts, writer):
+    """Seconds for `threads` threads to post `posts` messages each."""
+    saved, posting.group_writer = posting.group_writer, writer
+    start_line = threading.Barrier(threads + 1)
+
+    def worker(n):
+        with app.app_context():
+            start_line.wait()
+            for i in range(posts):
+                post_message(user_id, f"warble {n}.{i}", f"{n}-{i}")
+            db.session.remove()
+
+    workers = [threading.Thread(target=worker, args=(n,)) for n in range(threads)]
+    try:
+        for t in workers:
+            t.start()
+        start_line.wait()
+        start = time.perf_counter()
+        for t in workers:
+            t.join()
+        return time.perf_counter() - start
+    finally:
+        posting.group_writer = saved
+
+
+def clear(user_id):
+    db.session.execute(db.delete(posting.messages).where(posting.messages.c.user_id == user_id))
+    db.session.commit()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--threads', default='1,8,32')
+    parser.add_argument('--posts', type=int, default=50, help='Posts per thread.')
+    parser.add_argument('--window', type=float, default=posting.GROUP_COMMIT_WINDOW)
+    args = parser.parse_args()
+
+    with app.app_context():
+        user_id = seed()
+        try:
+            print(f"{'threads':>8}{'sync posts/s':>16}{'group posts/s':>16}{'commits':>10}")
+            for n in [int(t) for t in args.threads.split(',')]:
+                total = n * args.posts
+                sync = run(user_id, n, args.posts, GroupCommitWriter())
+                clear(user_id)
+                writer = GroupCommitWriter(window=args.window)
+                writer.app = app
+                group = run(user_id, n, args.posts, writer)
+                clear(user_id)
+                print(f"{n:>8}{total / sync:>16.0f}{total / group:>16.0f}"
+                      f"{writer.batches:>10}")
+        finally:
+            db.session.rollback()
+            clear(user_id)
+            User.query.filter(User.username.like(f"{PREFIX}%")).delete(synchronize_session=False)
+            db.session.commit()
+
+
+if __name__ == '__main__':
+    main()
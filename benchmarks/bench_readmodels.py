@@ -0,0 +1,117 @@
+"""100-message timeline pages as ORM instances and as read models.
+
+Seeds throwaway authors (named bench_rm_*) and a viewer following them,
+then loads the viewer's first timeline page both ways and reads every field
+the home template shows. Prints milliseconds per page (median) and the
+memory a built page holds on to, measured with tracemalloc (for the ORM
+that includes the session's identity map):
+
+    python benchmarks/bench_readmodels.py --authors 20 --messages 50 --limit 100
+
+Run it against a scratch database (DATABASE_URL); the seeded rows are
+deleted again at the end.
+"""
+
+import argparse
+import os
+import statistics
+import sys
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from sqlalchemy import insert  # noqa: E402
+
+from app import app  # noqa: E402
+from models import db, User, Message, followers_following  # noqa: E402
+from readmodels import message_card_select, message_cards  # noqa: E402
+from timeline import load_timeline  # noqa: E402
+
+PREFIX = 'bench_rm_'
+
+
+def seed(authors, messages):
+    """A viewer following `authors` users with `messages` messages each."""
+    now = datetime.utcnow()
+    db.session.execute(insert(User), [
+        {'username': f"{PREFIX}{i}", 'email': f"{PREFIX}{i}@example.com", 'password': 'x',
+         'bio': 'x' * 500}
+        for i in range(authors + 1)])
+    ids = [u.id for u in User.query.filter(User.username.like(f"{PREFIX}%"))
+           .order_by(User.id)]
+    viewer, author_ids = ids[0], ids[1:]
+    db.session.execute(insert(followers_following), [
+        {'follower_id': viewer, 'following_id': a} for a in author_ids])
+    db.session.execute(insert(Message), [
+        {'text': f"warble {j} " + 'x' * 100, 'user_id': author_id,
+         'timestamp': now - timedelta(minutes=j, seconds=author_id % 60)}
+        for author_id in author_ids for j in range(messages)])
+    db.session.commit()
+    return viewer
+
+
+def orm_page(viewer, limit, plan):
+    return load_timeline(viewer, Message.query.join(User), lambda q: q.all(), limit, plan=plan)
+
+
+def card_page(viewer, limit, plan):
+    return message_cards(load_timeline(viewer, message_card_select(),
+                                       lambda s: db.session.execute(s).all(), limit, plan=plan))
+
+
+def render(page):
+    """Read what home.html reads of each message."""
+    for msg in page:
+        (msg.id, msg.text, msg.timestamp, msg.user_id,
+         msg.user.id, msg.user.username, msg.user.image_url)
+
+
+def measure(load, viewer, limit, plan, repeat):
+    """(median ms per page, bytes a page holds) for `load`."""
+    with app.test_request_context('/'):
+        render(load(viewer, limit, plan))  # warm up
+        db.session.expunge_all()
+        times = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            render(load(viewer, limit, plan))
+            times.append((time.perf_counter() - start) * 1000)
+            db.session.expunge_all()
+
+        tracemalloc.start()
+        before = tracemalloc.take_snapshot()
+        page = load(viewer, limit, plan)
+        render(page)
+        held = sum(s.size_diff for s in tracemalloc.take_snapshot().compare_to(before, 'filename'))
+        tracemalloc.stop()
+        del page
+        db.session.expunge_all()
+    return statistics.median(times), held
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--authors', type=int, default=20)
+    parser.add_argument('--messages', type=int, default=50, help='Messages per author.')
+    parser.add_argument('--limit', type=int, default=100, help='Messages per page.')
+    parser.add_argument('--plan', default='in_list', help='Timeline plan (see timeline.py).')
+    parser.add_argument('--repeat', type=int, default=50)
+    args = parser.parse_args()
+
+    viewer = seed(args.authors, args.messages)
+    try:
+        print(f"{'':>12}{'ms/page':>10}{'KiB held':>10}")
+        for name, load in (('orm', orm_page), ('read model', card_page)):
+            ms, held = measure(load, viewer, args.limit, args.plan, args.repeat)
+            print(f"{name:>12}{ms:>10.2f}{held / 1024:>10.1f}")
+    finally:
+        db.session.rollback()
+        User.query.filter(User.username.like(f"{PREFIX}%")).delete(synchronize_session=False)
+        db.session.commit()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+"""Per-request session overhead: signed cookie vs server-side stores.
+
+Times Flask's open_session/save_session around a request for three request
+shapes and prints microseconds per request for each backend:
+
+    read    view reads session[CURR_USER_KEY] (most page views)
+    flash   view flashes a message and the next page consumes it (a write)
+    none    view never touches the session (static-like)
+
+    python benchmarks/bench_sessions.py --requests 5000
+"""
+
+import argparse
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from flask import flash, get_flashed_messages, request, session  # noqa: E402
+from flask.sessions import SecureCookieSessionInterface  # noqa: E402
+
+from app import app, CURR_USER_KEY  # noqa: E402
+from sessions import MemoryStore, SQLStore, ServerSessionInterface  # noqa: E402
+
+BACKENDS = {
+    'cookie': SecureCookieSessionInterface,
+    'memory': lambda: ServerSessionInterface(MemoryStore()),
+    'sql': lambda: ServerSessionInterface(SQLStore()),
+}
+
+WORK = {
+    'read': lambda: session.get(CURR_USER_KEY),
+    'flash': lambda: (flash("You liked a warble!", "success"), get_flashed_messages()),
+    'none': lambda: None,
+}
+
+
+def cookie_for(interface):
+    """Create a logged-in session and return its cookie header value."""
+    with app.test_request_context('/'):
+        sess = interface.open_session(app, request)
+        sess[CURR_USER_KEY] = 1
+        resp = app.response_class()
+        interface.save_session(app, sess, resp)
+        return resp.headers['Set-Cookie'].split(';')[0]
+
+
+def run(interface, work, requests):
+    cookie = cookie_for(interface)
+    start = time.perf_counter()
+    for _ in range(requests):
+        with app.test_request_context('/', headers={'Cookie': cookie}) as ctx:
+            sess = interface.open_session(app, ctx.request)
+            ctx.session = sess
+            work()
+            interface.save_session(app, sess, app.response_class())
+    elapsed = time.perf_counter() - start
+
+    # Subtract the request-context setup every backend pays anyway.
+    start = time.perf_counter()
+    for _ in range(requests):
+        with app.test_request_context('/', headers={'Cookie': cookie}):
+            pass
+    baseline = time.perf_counter() - start
+    return (elapsed - baseline) / requests * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--requests', type=int, default=5000)
+    parser.add_argument('--backends', default=','.join(BACKENDS))
+    args = parser.parse_args()
+
+    print(f"{'backend':<10}" + ''.join(f"{name + ' us':>12}" for name in WORK))
+    for name in args.backends.split(','):
+        interface = BACKENDS[name]()
+        cols = [run(interface, work, args.requests) for work in WORK.values()]
+        print(f"{name:<10}" + ''.join(f"{c:>12.1f}" for c in cols))
+
+
+if __name__ == '__main__':
+    main()
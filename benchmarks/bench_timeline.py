@@ -0,0 +1,94 @@
+"""Timeline plans across follow counts.
+
+Seeds throwaway authors (named bench_tl_*), then for viewers following an
+increasing number of them times every plan in timeline.py, and prints
+milliseconds per first page alongside the plan the planner would pick:
+
+    python benchmarks/bench_timeline.py --follows 10,100,1000,3000 --messages 50
+
+Run it against a scratch database (DATABASE_URL); the seeded rows are
+deleted again at the end.
+"""
+
+import argparse
+import os
+import sys
+import time
+from datetime import datetime, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from sqlalchemy import insert  # noqa: E402
+
+from app import app  # noqa: E402
+from models import db, User, Message, followers_following, timeline_entries  # noqa: E402
+from timeline import PLANS, choose_plan, load_timeline  # noqa: E402
+
+PREFIX = 'bench_tl_'
+
+
+def seed(authors, messages):
+    """Create `authors` users with `messages` messages each over 30 days."""
+    now = datetime.utcnow()
+    db.session.execute(insert(User), [
+        {'username': f"{PREFIX}{i}", 'email': f"{PREFIX}{i}@example.com", 'password': 'x'}
+        for i in range(authors + 1)])
+    ids = [u.id for u in User.query.filter(User.username.like(f"{PREFIX}%"))
+           .order_by(User.id)]
+    viewer, author_ids = ids[0], ids[1:]
+    step = timedelta(days=30) / messages
+    for author_id in author_ids:
+        db.session.execute(insert(Message), [
+            {'text': f"warble {j}", 'user_id': author_id,
+             'timestamp': now - step * j - timedelta(seconds=author_id % 600)}
+            for j in range(messages)])
+    db.session.commit()
+    return viewer, author_ids
+
+
+def follow(viewer, author_ids):
+    db.session.execute(followers_following.delete()
+                       .where(followers_following.c.follower_id == viewer))
+    db.session.execute(insert(followers_following), [
+        {'follower_id': viewer, 'following_id': a} for a in author_ids])
+    db.session.execute(timeline_entries.delete().where(timeline_entries.c.owner_id == viewer))
+    db.session.commit()
+
+
+def run(viewer, plan, repeat, limit=100):
+    with app.test_request_context('/'):
+        load_timeline(viewer, Message.query, lambda q: q.all(), limit, plan=plan)  # warm up
+        start = time.perf_counter()
+        for _ in range(repeat):
+            load_timeline(viewer, Message.query, lambda q: q.all(), limit, plan=plan)
+            db.session.expunge_all()
+        return (time.perf_counter() - start) / repeat * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--follows', default='10,100,1000,3000')
+    parser.add_argument('--messages', type=int, default=50, help='Messages per author.')
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    follows = [int(n) for n in args.follows.split(',')]
+    plans = [p for p in PLANS if p != 'lateral' or db.engine.dialect.name == 'postgresql']
+    viewer, author_ids = seed(max(follows), args.messages)
+    try:
+        print(f"{'follows':>8}" + ''.join(f"{p + ' ms':>16}" for p in plans) + f"{'chosen':>14}")
+        for n in follows:
+            follow(viewer, author_ids[:n])
+            cols = [run(viewer, plan, args.repeat) for plan in plans]
+            with app.test_request_context('/'):
+                chosen = choose_plan(viewer)
+            print(f"{n:>8}" + ''.join(f"{c:>16.2f}" for c in cols) + f"{chosen:>14}")
+    finally:
+        db.session.rollback()
+        User.query.filter(User.username.like(f"{PREFIX}%")).delete(synchronize_session=False)
+        db.session.commit()
+
+
+if __name__ == '__main__':
+    main()
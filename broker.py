@@ -0,0 +1,188 @@
+"""Tiny pub/sub broker for live timeline updates.
+
+Routes publish `(author_id, message_id)` after a new message is committed and
+every open timeline stream holds a `Subscription` for the authors it cares
+about. Delivery inside a worker is a dict lookup by author, so an idle stream
+costs one queue and nothing per published message unless it follows the author.
+
+The backend decides how publishes travel between workers:
+
+* `MemoryBackend` (default) delivers straight back to this process.
+* `RedisBackend` fans out through a shared pub/sub channel so every gunicorn
+  worker sees every publish. It only needs a redis-py style client
+  (`publish()` and `pubsub()`), so tests can hand it a local stand-in. Its
+  listener thread starts with the first subscription in each process, so
+  workers forked from a preloaded master each get their own.
+"""
+
+import asyncio
+import os
+import queue
+import threading
+
+CHANNEL = 'warbler:messages'
+
+
+class Subscription:
+    """Queue of new message ids for one stream."""
+
+    def __init__(self, broker, author_ids, maxsize=1000):
+        self.broker = broker
+        self.author_ids = frozenset(author_ids)
+        self.queue = queue.Queue(maxsize=maxsize)
+
+    def put(self, message_id):
+        try:
+            self.queue.put_nowait(message_id)
+        except queue.Full:
+            # A stalled client just misses ids; it catches up on reconnect
+            # through Last-Event-ID.
+            pass
+
+    def get(self, timeout=None):
+        """Return the next message id, or None if `timeout` passes first."""
+        try:
+            return self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def close(self):
+        self.broker.unsubscribe(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class AsyncSubscription(Subscription):
+    """Subscription read from a coroutine; ids may be delivered from any thread."""
+
+    def __init__(self, broker, author_ids, loop, maxsize=1000):
+        self.broker = broker
+        self.author_ids = frozenset(author_ids)
+        self.loop = loop
+        self.queue = asyncio.Queue(maxsize=maxsize)
+
+    def put(self, message_id):
+        try:
+            self.loop.call_soon_threadsafe(self._put, message_id)
+        except RuntimeError:
+            # The loop is already closed; the stream is going away.
+            pass
+
+    def _put(self, message_id):
+        try:
+            self.queue.put_nowait(message_id)
+        except asyncio.QueueFull:
+            pass
+
+    async def get(self, timeout=None):
+        """Return the next message id, or None if `timeout` passes first."""
+        try:
+            return await asyncio.wait_for(self.queue.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+
+class MemoryBackend:
+    """Deliver publishes only within the current process."""
+
+    def start(self, deliver):
+        self.deliver = deliver
+
+    def ensure_listening(self):
+        pass
+
+    def publish(self, author_id, message_id):
+        self.deliver(author_id, message_id)
+
+
+class RedisBackend:
+    """Share publishes across processes through a redis-style pub/sub client."""
+
+    def __init__(self, client, channel=CHANNEL):
+        self.client = client
+        self.channel = channel
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+
+    def start(self, deliver):
+        self.deliver = deliver
+
+    def ensure_listening(self):
+        with self._lock:
+            if self._thread is None or self._pid != os.getpid():
+                self._pid = os.getpid()
+                pubsub = self.client.pubsub()
+                # Subscribed before returning, so no publish after this is missed.
+                pubsub.subscribe(self.channel)
+                self._thread = threading.Thread(target=self._listen, args=(pubsub,),
+                                                name='broker-listener', daemon=True)
+                self._thread.start()
+
+    def _listen(self, pubsub):
+        for item in pubsub.listen():
+            if item.get('type') != 'message':
+                continue
+            data = item['data']
+            if isinstance(data, bytes):
+                data = data.decode()
+            author_id, message_id = data.split(':')
+            self.deliver(int(author_id), int(message_id))
+
+    def publish(self, author_id, message_id):
+        self.client.publish(self.channel, f"{author_id}:{message_id}")
+
+
+class Broker:
+    """Fan out new message ids to the subscriptions that follow the author."""
+
+    def __init__(self, backend=None):
+        self._lock = threading.Lock()
+        self._by_author = {}
+        self.use_backend(backend or MemoryBackend())
+
+    def use_backend(self, backend):
+        self.backend = backend
+        backend.start(self._deliver)
+
+    def subscribe(self, author_ids, loop=None):
+        """Subscribe to `author_ids`; pass the running `loop` to read from a coroutine."""
+        if loop is None:
+            sub = Subscription(self, author_ids)
+        else:
+            sub = AsyncSubscription(self, author_ids, loop)
+        self.backend.ensure_listening()
+        with self._lock:
+            for author_id in sub.author_ids:
+                self._by_author.setdefault(author_id, set()).add(sub)
+        return sub
+
+    def unsubscribe(self, sub):
+        with self._lock:
+            for author_id in sub.author_ids:
+                subs = self._by_author.get(author_id)
+                if subs is None:
+                    continue
+                subs.discard(sub)
+                if not subs:
+                    del self._by_author[author_id]
+
+    def publish(self, author_id, message_id):
+        self.backend.publish(author_id, message_id)
+
+    def subscriber_count(self):
+        with self._lock:
+            return len({sub for subs in self._by_author.values() for sub in subs})
+
+    def _deliver(self, author_id, message_id):
+        with self._lock:
+            subs = list(self._by_author.get(author_id, ()))
+        for sub in subs:
+            sub.put(message_id)
+
+
+broker = Broker()
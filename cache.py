@@ -0,0 +1,205 @@
+"""Read-through cache for payloads that are expensive to build and hot to read.
+
+`ReadThroughCache.get(key, loader)` returns the cached value or calls
+`loader()` and stores what it returns. Three things keep a hot key from
+stampeding the database:
+
+* Single flight: concurrent misses for a key in one worker share one
+  `loader()` call; the others wait for its result.
+* Probabilistic early expiry (XFetch): a fresh entry is refreshed ahead of
+  its expiry with a probability that grows as expiry nears and with how long
+  the value took to build, so refreshes spread out instead of all landing at
+  the moment it expires.
+* Stale-while-revalidate: for `stale_ttl` seconds after it expires an entry
+  is still served while one caller reloads it; everyone else gets the stale
+  value straight away.
+
+The store decides where entries live:
+
+* `MemoryStore` (default) keeps them per process.
+* `SharedStore` keeps them in a redis-py style client (`get`, `set` with
+  `ex`/`nx`, `delete`) so every worker shares one copy, and takes a short
+  lock there so only one worker refreshes an expired entry. Values must be
+  JSON-serializable.
+"""
+
+import json
+import math
+import random
+import threading
+import time
+from collections import OrderedDict
+
+# How long another worker's refresh of an expired entry may take before this
+# one tries too.
+REFRESH_LOCK_SECONDS = 10
+
+
+class MemoryStore:
+    """Entries in a per-process dict, least recently used evicted first."""
+
+    def __init__(self, max_keys=10_000):
+        self.max_keys = max_keys
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            if item[1] < time.time():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return item[0]
+
+    def set(self, key, entry, ttl):
+        with self._lock:
+            self._data[key] = (entry, time.time() + ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_keys:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def lock(self, key, ttl):
+        # Single flight already keeps refreshes to one per process.
+        return True
+
+    def unlock(self, key):
+        pass
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+class SharedStore:
+    """Entries shared by all workers in Redis (or anything with its API)."""
+
+    def __init__(self, client, prefix='warbler:cache:'):
+        self.client = client
+        self.prefix = prefix
+
+    def get(self, key):
+        data = self.client.get(self.prefix + key)
+        return None if data is None else tuple(json.loads(data))
+
+    def set(self, key, entry, ttl):
+        self.client.set(self.prefix + key, json.dumps(entry), ex=max(1, math.ceil(ttl)))
+
+    def delete(self, key):
+        self.client.delete(self.prefix + key)
+
+    def lock(self, key, ttl):
+        return bool(self.client.set(f"{self.prefix}lock:{key}", b'1', nx=True, ex=ttl))
+
+    def unlock(self, key):
+        self.client.delete(f"{self.prefix}lock:{key}")
+
+
+class Flight:
+    """One in-progress load that concurrent callers wait on."""
+
+    __slots__ = ('done', 'value', 'error', 'invalidated')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+        self.invalidated = False
+
+
+class ReadThroughCache:
+    """Values by key, loaded on demand; see the module docstring."""
+
+    def __init__(self, store=None, ttl=30, stale_ttl=300, beta=1.0):
+        self.store = store or MemoryStore()
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.beta = beta
+        self.hits = self.stale_hits = self.misses = 0
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.ttl > 0
+
+    def get(self, key, loader):
+        if not self.enabled:
+            return loader()
+        entry = self.store.get(key)
+        if entry is not None:
+            value, expires_at, delta = entry
+            if not self._refresh_due(time.time(), expires_at, delta):
+                self.hits += 1
+                return value
+            flight, leader = self._join(key)
+            if not leader or not self.store.lock(key, REFRESH_LOCK_SECONDS):
+                if leader:
+                    self._land(key, flight)
+                self.stale_hits += 1
+                return value
+            try:
+                return self._load(key, loader, flight)
+            finally:
+                self.store.unlock(key)
+
+        self.misses += 1
+        flight, leader = self._join(key)
+        if leader:
+            return self._load(key, loader, flight)
+        flight.done.wait()
+        if flight.error is not None:
+            raise flight.error
+        return flight.value
+
+    def delete(self, key):
+        """Drop `key`, including whatever a load in progress is about to store."""
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is not None:
+                flight.invalidated = True
+        self.store.delete(key)
+
+    def clear(self):
+        self.store.clear()
+        self.hits = self.stale_hits = self.misses = 0
+
+    def _refresh_due(self, now, expires_at, delta):
+        # XFetch: -log(u) is exponentially distributed, so most callers see
+        # a small head start and a few see a large one.
+        return now - delta * self.beta * math.log(1.0 - random.random()) >= expires_at
+
+    def _join(self, key):
+        """(flight, leader): the load in progress for `key`, or a new one to run."""
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is not None:
+                return flight, False
+            flight = self._flights[key] = Flight()
+            return flight, True
+
+    def _land(self, key, flight):
+        with self._lock:
+            self._flights.pop(key, None)
+        flight.done.set()
+
+    def _load(self, key, loader, flight):
+        try:
+            start = time.time()
+            flight.value = loader()
+            now = time.time()
+            if not flight.invalidated:
+                self.store.set(key, (flight.value, now + self.ttl, now - start),
+                               self.ttl + self.stale_ttl)
+            return flight.value
+        except Exception as err:
+            flight.error = err
+            raise
+        finally:
+            self._land(key, flight)
@@ -0,0 +1,154 @@
+"""pytest setup shared by every test module.
+
+The schema is built once per test session, and each test runs inside a
+transaction that is rolled back afterwards: the session joins an outer
+transaction on a single connection, and its commits only release
+SAVEPOINTs. Test modules still clear their tables in setUp, but against
+an empty, uncommitted state that costs next to nothing.
+
+    python -m pytest                       # postgresql:///warbler-test
+    python -m pytest -n 4                  # pytest-xdist, one database per worker
+    python -m pytest --db sqlite           # in-memory SQLite
+    python -m pytest --db postgresql:///x  # any other database
+
+With -n, worker gw0 uses `warbler-test-gw0` and so on; the databases are
+created on first use, which needs the CREATEDB privilege.
+
+Test classes whose code commits on connections of its own (the asyncpg
+engine, the SQL session store, migrations and other DDL) set
+`transactional = False` and commit for real; classes that only work on
+PostgreSQL set `postgres_only = True`. Bulk test data comes from
+factories.py.
+"""
+
+import os
+import tempfile
+
+import pytest
+from flask_sqlalchemy.session import Session
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.engine import make_url
+
+DEFAULT_DATABASE = 'postgresql:///warbler-test'
+
+# Hashing at the default cost dominates signup-heavy tests.
+TEST_BCRYPT_ROUNDS = 4
+
+POSTGRES_ONLY_MODULES = ('test_asgi.py',)
+
+
+class ConnectionSession(Session):
+    """Session that runs everything on the connection it was given."""
+
+    def get_bind(self, *args, **kwargs):
+        return self.bind
+
+
+def pytest_addoption(parser):
+    parser.addoption('--db', default=os.environ.get('TEST_DATABASE_URL', DEFAULT_DATABASE),
+                     help="Database URL to test against, or 'sqlite' for in-memory SQLite.")
+
+
+def database_url(config):
+    url = config.getoption('--db')
+    if url == 'sqlite':
+        return 'sqlite://'
+    worker = os.environ.get('PYTEST_XDIST_WORKER')
+    if worker and not url.startswith('sqlite'):
+        url = make_url(url)
+        url = url.set(database=f"{url.database}-{worker}")
+        create_database(url)
+        url = url.render_as_string(hide_password=False)
+    return url
+
+
+def create_database(url):
+    """Create the database `url` names unless it exists."""
+    engine = create_engine(url.set(database='postgres'), isolation_level='AUTOCOMMIT')
+    with engine.connect() as conn:
+        exists = conn.execute(text("SELECT 1 FROM pg_database WHERE datname = :name"),
+                              {'name': url.database}).scalar()
+        if not exists:
+            conn.execute(text(f'CREATE DATABASE "{url.database}"'))
+    engine.dispose()
+
+
+def pytest_configure(config):
+    # app.py reads these at import time, before any test module sets its own.
+    url = database_url(config)
+    os.environ['DATABASE_URL'] = url
+    config.test_database_url = url
+    os.environ.setdefault('EVENT_LOG_DIR', tempfile.mkdtemp(prefix='warbler-events-'))
+    # Write notifications in the request's own transaction; tests flush the
+    # batched writer themselves.
+    os.environ.setdefault('NOTIFY_FLUSH_INTERVAL', '0')
+    # Test modules set DATABASE_URL themselves before importing the app;
+    # importing it first makes this one stick.
+    import app  # noqa: F401
+
+
+def pytest_ignore_collect(collection_path, config):
+    # The async serving mode needs asyncpg; there is no SQLite driver for it.
+    if collection_path.name in POSTGRES_ONLY_MODULES:
+        return not config.test_database_url.startswith('postgresql') or None
+
+
+def pytest_collection_modifyitems(config, items):
+    if not config.test_database_url.startswith('postgresql'):
+        skip = pytest.mark.skip(reason="needs PostgreSQL")
+        for item in items:
+            if getattr(item.cls, 'postgres_only', False):
+                item.add_marker(skip)
+
+
+def use_sqlite_savepoints(engine):
+    """Let SQLAlchemy issue BEGIN itself, so SAVEPOINTs work on pysqlite."""
+
+    @event.listens_for(engine, 'connect')
+    def connect(dbapi_connection, connection_record):
+        dbapi_connection.isolation_level = None
+
+    @event.listens_for(engine, 'begin')
+    def begin(conn):
+        conn.exec_driver_sql('BEGIN')
+
+
+@pytest.fixture(scope='session')
+def schema():
+    """Build the schema from the models once per session."""
+    from app import app
+    from models import bcrypt, db
+
+    if db.engine.dialect.name == 'sqlite':
+        db.engine.dispose()
+        use_sqlite_savepoints(db.engine)
+
+    bcrypt._log_rounds = TEST_BCRYPT_ROUNDS
+    db.session.remove()
+    db.drop_all()
+    db.create_all()
+    return app
+
+
+@pytest.fixture(autouse=True)
+def transaction(request, schema):
+    """Run the test in a transaction that is rolled back when it ends."""
+    from models import db
+
+    if not getattr(request.cls, 'transactional', True):
+        yield
+        return
+
+    db.session.remove()
+    saved = db.session
+    conn = db.engine.connect()
+    outer = conn.begin()
+    db.session = db._make_scoped_session({'class_': ConnectionSession, 'bind': conn,
+                                          'join_transaction_mode': 'create_savepoint'})
+    try:
+        yield
+    finally:
+        db.session.remove()
+        db.session = saved
+        outer.rollback()
+        conn.close()
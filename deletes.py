@@ -0,0 +1,107 @@
+"""Deleting messages.
+
+Deleting a message only sets `messages.deleted_at` (`soft_delete`), a
+single-row UPDATE, so the request never waits on the message's likes and
+timeline entries. Every read filters on `deleted_at IS NULL`, and the
+(user_id, timestamp) index is partial on that same condition, so deleted
+rows cost the timeline and profile queries nothing.
+
+The rows themselves are removed by the purge, which takes PURGE_CHUNK
+deleted messages at a time, oldest deletion first, and deletes their likes,
+timeline entries, notifications and then the messages in one short
+transaction per chunk. Run it from cron like the partition jobs:
+
+    flask messages purge
+
+Several purges may run at once: on PostgreSQL each chunk skips rows
+another purge has locked.
+
+Databases created before deleted_at existed are upgraded with:
+
+    flask messages migrate
+"""
+
+from datetime import datetime, timedelta
+
+import click
+from flask.cli import AppGroup
+from sqlalchemy import delete, inspect, select, text, update
+
+from models import db, Like, Message, notifications, timeline_entries
+from notifications import FOLLOW
+
+# Messages deleted less than this long ago are left alone, so requests that
+# read one just before it was deleted can still finish (e.g. add a like).
+PURGE_GRACE = timedelta(minutes=10)
+PURGE_CHUNK = 1000
+
+messages_cli = AppGroup('messages', help='Purge deleted messages.')
+
+
+def soft_delete(message_id):
+    """Mark `message_id` deleted; return whether it was live. The caller commits."""
+    result = db.session.execute(
+        update(Message)
+        .where(Message.id == message_id, Message.deleted_at.is_(None))
+        .values(deleted_at=datetime.utcnow()),
+        execution_options={'synchronize_session': False})
+    return result.rowcount > 0
+
+
+def purge_chunk(before, limit=PURGE_CHUNK):
+    """Remove up to `limit` messages deleted before `before`; return how many."""
+    stmt = (select(Message.id)
+            .where(Message.deleted_at < before)
+            .order_by(Message.deleted_at)
+            .limit(limit))
+    if db.engine.dialect.name == 'postgresql':
+        stmt = stmt.with_for_update(skip_locked=True)
+    ids = db.session.execute(stmt).scalars().all()
+    if ids:
+        db.session.execute(delete(Like).where(Like.message_id.in_(ids)),
+                           execution_options={'synchronize_session': False})
+        db.session.execute(delete(timeline_entries)
+                           .where(timeline_entries.c.message_id.in_(ids)))
+        db.session.execute(delete(notifications)
+                           .where(notifications.c.subject_id.in_(ids),
+                                  notifications.c.kind != FOLLOW))
+        db.session.execute(delete(Message).where(Message.id.in_(ids)),
+                           execution_options={'synchronize_session': False})
+    db.session.commit()
+    return len(ids)
+
+
+def purge(grace=PURGE_GRACE, chunk=PURGE_CHUNK):
+    """Remove every message deleted more than `grace` ago; return how many."""
+    before = datetime.utcnow() - grace
+    total = 0
+    while True:
+        count = purge_chunk(before, chunk)
+        total += count
+        if count < chunk:
+            return total
+
+
+@messages_cli.command('purge')
+@click.option('--grace', default=int(PURGE_GRACE.total_seconds()),
+              help='Seconds a deleted message is kept before it is purged.')
+@click.option('--chunk', default=PURGE_CHUNK, help='Messages removed per transaction.')
+def purge_command(grace, chunk):
+    """Remove deleted messages and their likes."""
+    click.echo(f"Purged {purge(timedelta(seconds=grace), chunk)} message(s).")
+
+
+@messages_cli.command('migrate')
+def migrate_command():
+    """Add messages.deleted_at and its indexes on an existing database."""
+    engine = db.engine
+    columns = {c['name'] for c in inspect(engine).get_columns('messages')}
+    with engine.begin() as conn:
+        if 'deleted_at' not in columns:
+            conn.execute(text("ALTER TABLE messages ADD COLUMN deleted_at TIMESTAMP"))
+        # Rebuild the per-author index as a partial one over live messages.
+        conn.execute(text("DROP INDEX IF EXISTS ix_messages_user_id_timestamp"))
+        for index in Message.__table__.indexes:
+            if index.name in ('ix_messages_user_id_timestamp', 'ix_messages_deleted_at'):
+                index.create(conn, checkfirst=True)
+    click.echo("messages.deleted_at is in place.")
@@ -0,0 +1,98 @@
+"""The /users directory.
+
+Pages of user cards, DIRECTORY_PAGE_SIZE at a time, in one of two orders:
+
+    default    most recently active first (users.last_active_at, indexed
+               with id as the tiebreaker)
+    ?q=...     usernames containing `q`, ignoring case, alphabetically
+
+Both are keyset-paginated: the next-page cursor carries the sort key of the
+last card, so page 500 costs the same as page 1. Only the columns a card
+shows are selected, with the bio cut to CARD_BIO_LENGTH, and the viewer's
+follow state for the whole page comes from one query.
+
+Databases created before last_active_at existed are upgraded with:
+
+    flask directory migrate
+"""
+
+from datetime import datetime
+
+import click
+from flask.cli import AppGroup
+from sqlalchemy import func, inspect, select, text, tuple_
+
+from models import db, User, followers_following, normalize_username
+
+DIRECTORY_PAGE_SIZE = 24
+CARD_BIO_LENGTH = 160
+
+directory_cli = AppGroup('directory', help='Maintain the /users directory ordering.')
+
+
+def card_select():
+    return select(User.id, User.username, User.image_url, User.header_image_url,
+                  func.substr(User.bio, 1, CARD_BIO_LENGTH).label('bio'),
+                  User.last_active_at, User.username_key)
+
+
+def escape_like(value):
+    return value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+def directory_page(cursor=None, q=None, limit=DIRECTORY_PAGE_SIZE):
+    """One page of cards after `cursor` (a tuple from a previous page).
+
+    Returns (cards, next_cursor); next_cursor is None on the last page.
+    """
+    stmt = card_select()
+    if q:
+        stmt = stmt.where(User.username_key.like(f"%{escape_like(normalize_username(q))}%",
+                                                 escape='\\'))
+        if cursor:
+            stmt = stmt.where(User.username_key > cursor[0])
+        stmt = stmt.order_by(User.username_key)
+    else:
+        if cursor:
+            stmt = stmt.where(tuple_(User.last_active_at, User.id) < tuple_(*cursor))
+        stmt = stmt.order_by(User.last_active_at.desc(), User.id.desc())
+    rows = db.session.execute(stmt.limit(limit + 1)).all()
+    cards = rows[:limit]
+    next_cursor = None
+    if len(rows) > limit:
+        last = cards[-1]
+        next_cursor = (last.username_key,) if q else (last.last_active_at, last.id)
+    return cards, next_cursor
+
+
+def cursor_types(q):
+    return (str,) if q else (datetime, int)
+
+
+def followed_among(viewer_id, user_ids):
+    """Which of `user_ids` `viewer_id` follows."""
+    if not user_ids:
+        return set()
+    ff = followers_following.c
+    return set(db.session.execute(
+        select(ff.following_id).where(ff.follower_id == viewer_id,
+                                      ff.following_id.in_(user_ids))).scalars())
+
+
+@directory_cli.command('migrate')
+def migrate_command():
+    """Add and backfill users.last_active_at on an existing database."""
+    engine = db.engine
+    columns = {c['name'] for c in inspect(engine).get_columns('users')}
+    with engine.begin() as conn:
+        if 'last_active_at' not in columns:
+            conn.execute(text("ALTER TABLE users ADD COLUMN last_active_at TIMESTAMP"))
+        filled = conn.execute(text(
+            "UPDATE users SET last_active_at = COALESCE("
+            "(SELECT MAX(timestamp) FROM messages WHERE messages.user_id = users.id), "
+            ":now) WHERE last_active_at IS NULL"), {'now': datetime.utcnow()}).rowcount
+        if engine.dialect.name == 'postgresql':
+            conn.execute(text("ALTER TABLE users ALTER COLUMN last_active_at SET NOT NULL"))
+        conn.execute(text("CREATE INDEX IF NOT EXISTS ix_users_last_active_at_id "
+                          "ON users (last_active_at, id)"))
+    click.echo(f"Backfilled last_active_at for {filled} user(s).")
@@ -0,0 +1,321 @@
+"""Append-only log of engagement events.
+
+Likes, follows and messages are recorded as one JSON line each in segment
+files under EVENT_LOG_DIR:
+
+    events/00000000000000000000.jsonl
+    events/00000000000067108903.jsonl
+    events/consumers/<name>.offset
+
+An event's offset is its byte position in the whole log; each segment is named
+after the offset of its first byte and a new one is started once the active
+segment passes EVENT_LOG_SEGMENT_BYTES. Appends take an flock on the
+directory, so every gunicorn worker can write to the same log.
+
+Routes and model methods `stage()` events on the database session and they are
+appended when that session commits (and dropped if it rolls back), so the log
+only ever holds changes that are in the database.
+
+`message_deleted` records the author deleting a message, which only marks
+it deleted (see deletes.py). The purge that later removes the row, its likes
+and its timeline entries is not logged: consumers should treat the message
+and its likes as gone at `message_deleted` and expect no further event.
+
+A `Consumer` reads from the offset it last committed, which lets a derived
+view (counters, trending, recommendations) apply only what is new, or start
+again from offset 0 and rebuild itself by replay:
+
+    consumer = Consumer(event_log, 'like-counts')
+    consumer.run(apply_event)
+"""
+
+import fcntl
+import json
+import logging
+import os
+import re
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+
+import click
+from flask.cli import AppGroup
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from models import db
+
+SEGMENT_BYTES = 64 * 1024 * 1024
+SEGMENT_RE = re.compile(r'^(\d{20})\.jsonl$')
+
+logger = logging.getLogger(__name__)
+
+events_cli = AppGroup('events', help='Inspect and prune the engagement event log.')
+
+
+def segment_name(base):
+    return f"{base:020d}.jsonl"
+
+
+class EventLog:
+    """JSONL segment files addressed by byte offset."""
+
+    def __init__(self, root=None, segment_bytes=SEGMENT_BYTES, fsync=False):
+        self.root = root
+        self.segment_bytes = segment_bytes
+        self.fsync = fsync
+        self._lock = threading.Lock()
+        self._fd = None
+        self._base = None
+        self._pid = None
+        self._opened_root = None
+
+    @property
+    def enabled(self):
+        return bool(self.root)
+
+    def segments(self):
+        """Base offsets of the segments on disk, oldest first."""
+        if not os.path.isdir(self.root):
+            return []
+        return sorted(int(m.group(1)) for m in map(SEGMENT_RE.match, os.listdir(self.root)) if m)
+
+    def end_offset(self):
+        """Offset the next appended event will get."""
+        bases = self.segments()
+        if not bases:
+            return 0
+        return bases[-1] + os.path.getsize(os.path.join(self.root, segment_name(bases[-1])))
+
+    def append(self, events):
+        """Append `events` (dicts) in order; return their offsets."""
+        lines = [json.dumps(e, separators=(',', ':'), default=str).encode() + b'\n'
+                 for e in events]
+        if not lines:
+            return []
+        with self._lock, self._locked():
+            fd, base = self._active()
+            position = base + os.fstat(fd).st_size
+            os.write(fd, b''.join(lines))
+            if self.fsync:
+                os.fsync(fd)
+        offsets = []
+        for line in lines:
+            offsets.append(position)
+            position += len(line)
+        return offsets
+
+    def read(self, offset=0, limit=1000):
+        """Up to `limit` events from `offset` on.
+
+        Returns ([(offset, event), ...], next_offset). Lines that do not
+        parse (a write torn by a crash) are skipped; an unterminated last
+        line is left for the next read.
+        """
+        found = []
+        bases = self.segments()
+        for i, base in enumerate(bases):
+            following = bases[i + 1] if i + 1 < len(bases) else None
+            if following is not None and following <= offset:
+                continue
+            offset = max(offset, base)
+            with open(os.path.join(self.root, segment_name(base)), 'rb') as f:
+                f.seek(offset - base)
+                for line in f:
+                    if len(found) >= limit or not line.endswith(b'\n'):
+                        return found, offset
+                    try:
+                        found.append((offset, json.loads(line)))
+                    except ValueError:
+                        pass
+                    offset += len(line)
+        return found, offset
+
+    def prune(self, before):
+        """Delete whole segments that end at or before offset `before`."""
+        bases = self.segments()
+        removed = 0
+        for base, following in zip(bases, bases[1:]):
+            if following > before:
+                break
+            os.remove(os.path.join(self.root, segment_name(base)))
+            removed += 1
+        return removed
+
+    @contextmanager
+    def _locked(self):
+        os.makedirs(self.root, exist_ok=True)
+        with open(os.path.join(self.root, '.lock'), 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _active(self):
+        """(fd, base) of the segment to append to, rolling over if full.
+
+        Only the newest segment is ever written, so a cached segment that is
+        not full is still the newest; once it is full, another process may
+        already have started the next one.
+        """
+        if self._fd is not None and (self._pid, self._opened_root) != (os.getpid(), self.root):
+            os.close(self._fd)
+            self._fd = None
+        if self._fd is not None and os.fstat(self._fd).st_size < self.segment_bytes:
+            return self._fd, self._base
+        bases = self.segments()
+        base = bases[-1] if bases else 0
+        path = os.path.join(self.root, segment_name(base))
+        if bases and os.path.getsize(path) >= self.segment_bytes:
+            base += os.path.getsize(path)
+            path = os.path.join(self.root, segment_name(base))
+        if self._fd is not None:
+            os.close(self._fd)
+        self._fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        self._base, self._pid, self._opened_root = base, os.getpid(), self.root
+        return self._fd, self._base
+
+
+class Consumer:
+    """Reader of an EventLog that remembers how far it got under `name`."""
+
+    def __init__(self, log, name):
+        self.log = log
+        self.name = name
+        self.path = os.path.join(log.root, 'consumers', f"{name}.offset")
+
+    @property
+    def offset(self):
+        try:
+            with open(self.path) as f:
+                return int(f.read())
+        except FileNotFoundError:
+            return 0
+
+    def poll(self, limit=1000):
+        """([(offset, event), ...], next_offset) after the committed offset."""
+        return self.log.read(self.offset, limit)
+
+    def commit(self, offset):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp = f"{self.path}.tmp"
+        with open(tmp, 'w') as f:
+            f.write(str(offset))
+        os.replace(tmp, self.path)
+
+    def reset(self, offset=0):
+        """Rewind (or skip ahead) so the next poll starts at `offset`."""
+        self.commit(offset)
+
+    def run(self, handler, batch=1000):
+        """Call `handler(event)` for every new event, committing per batch.
+
+        Returns the number of events handled.
+        """
+        handled = 0
+        while True:
+            events, next_offset = self.poll(batch)
+            for _, e in events:
+                handler(e)
+            if next_offset != self.offset:
+                self.commit(next_offset)
+            handled += len(events)
+            if len(events) < batch:
+                return handled
+
+    def lag(self):
+        return self.log.end_offset() - self.offset
+
+
+def replay(log, handler, start=0, batch=1000):
+    """Call `handler(event)` for every event from `start` on, without a consumer."""
+    offset = start
+    while True:
+        events, offset = log.read(offset, batch)
+        for _, e in events:
+            handler(e)
+        if len(events) < batch:
+            return offset
+
+
+event_log = EventLog()
+
+
+def make_event(type, **fields):
+    return {'type': type, 'ts': datetime.utcnow().isoformat(), **fields}
+
+
+def stage(type, **fields):
+    """Queue an event to be logged when the current transaction commits."""
+    if event_log.enabled:
+        pending = db.session.info.setdefault('pending_events', [])
+        pending.append(make_event(type, **fields))
+
+
+def log_committed(events):
+    """Append `events` whose changes have already been committed.
+
+    For writes that do not go through the ORM session (asgi.py); call it
+    only after the transaction has committed.
+    """
+    if not events or not event_log.enabled:
+        return
+    try:
+        event_log.append(events)
+    except OSError:
+        # The rows are committed either way; a consumer that needs every
+        # event can be rebuilt from the tables.
+        logger.exception("Could not append %d events to %s", len(events), event_log.root)
+
+
+@event.listens_for(Session, 'after_commit')
+def _write_pending(session):
+    log_committed(session.info.pop('pending_events', None))
+
+
+@event.listens_for(Session, 'after_rollback')
+def _drop_pending(session):
+    session.info.pop('pending_events', None)
+
+
+@events_cli.command('tail')
+@click.option('--offset', type=int, default=None, help='Start here (default: last 20).')
+@click.option('--limit', type=int, default=20)
+def tail_command(offset, limit):
+    """Print events as `offset json`."""
+    if offset is None:
+        bases = event_log.segments()
+        offset = bases[-1] if bases else 0
+        events, _ = event_log.read(offset, 1_000_000)
+        events = events[-limit:]
+    else:
+        events, _ = event_log.read(offset, limit)
+    for at, e in events:
+        click.echo(f"{at} {json.dumps(e)}")
+
+
+def consumer_names(log):
+    directory = os.path.join(log.root, 'consumers')
+    if not os.path.isdir(directory):
+        return []
+    return sorted(n[:-len('.offset')] for n in os.listdir(directory) if n.endswith('.offset'))
+
+
+@events_cli.command('consumers')
+def consumers_command():
+    """Show each consumer's committed offset and lag in bytes."""
+    for name in consumer_names(event_log):
+        consumer = Consumer(event_log, name)
+        click.echo(f"{name}: offset {consumer.offset}, lag {consumer.lag()}")
+
+
+@events_cli.command('prune')
+def prune_command():
+    """Delete segments every consumer has read past."""
+    names = consumer_names(event_log)
+    if not names:
+        click.echo("No consumers; nothing pruned.")
+        return
+    before = min(Consumer(event_log, name).offset for name in names)
+    click.echo(f"Pruned {event_log.prune(before)} segment(s) before offset {before}.")
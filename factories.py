@@ -0,0 +1,75 @@
+"""Bulk test data.
+
+Each helper writes all its rows with one multi-row INSERT in the current
+transaction and returns the new ids in order. Nothing is committed; the
+caller commits (inside the test fixtures in conftest.py, a commit only
+releases a SAVEPOINT).
+
+    author, *fans = make_users(4)
+    make_follows([(fan, author) for fan in fans])
+    msg_ids = make_messages([author], per_user=30)
+    make_likes([(fans[0], msg_ids[0])])
+"""
+
+from datetime import datetime, timedelta
+from itertools import count
+
+from sqlalchemy import insert
+
+from models import db, bcrypt, followers_following, Like, Message, User
+
+PASSWORD = 'password'
+
+_serial = count(1)
+_hashes = {}
+
+
+def password_hash(password=PASSWORD):
+    """bcrypt hash of `password`, computed once per process."""
+    if password not in _hashes:
+        _hashes[password] = bcrypt.generate_password_hash(password).decode('UTF-8')
+    return _hashes[password]
+
+
+def _insert(model, rows):
+    if not rows:
+        return []
+    return db.session.execute(
+        insert(model).returning(model.id, sort_by_parameter_order=True), rows).scalars().all()
+
+
+def make_users(n, prefix='user', password=PASSWORD, **fields):
+    """Create `n` users named `<prefix><serial>` who can log in with `password`."""
+    hashed = password_hash(password)
+    rows = []
+    for _ in range(n):
+        name = f"{prefix}{next(_serial)}"
+        rows.append({'username': name, 'email': f"{name}@test.com", 'password': hashed,
+                     **fields})
+    return _insert(User, rows)
+
+
+def make_messages(user_ids, per_user=1, start=None, step=timedelta(minutes=1)):
+    """Create `per_user` messages for each of `user_ids`, one `step` apart.
+
+    Messages go back in time from `start` (default: now), newest first per
+    user; ids are returned in the same order.
+    """
+    start = start or datetime.utcnow()
+    return _insert(Message, [
+        {'user_id': user_id, 'text': f"warble {i}", 'timestamp': start - step * i}
+        for user_id in user_ids for i in range(per_user)])
+
+
+def make_follows(pairs):
+    """Create follows from (follower_id, following_id) pairs."""
+    if pairs:
+        db.session.execute(insert(followers_following), [
+            {'follower_id': follower, 'following_id': following}
+            for follower, following in pairs])
+
+
+def make_likes(pairs):
+    """Create likes from (user_id, message_id) pairs; return the like ids."""
+    return _insert(Like, [{'user_id': user_id, 'message_id': message_id}
+                          for user_id, message_id in pairs])
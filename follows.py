@@ -0,0 +1,48 @@
+"""Schema upgrades for the followers_following table.
+
+Each follow edge is stored once: (follower_id, following_id) is the primary
+key, and `User.follow_many` relies on it to skip follows that already exist
+with INSERT ... ON CONFLICT DO NOTHING.
+
+Databases created before the key existed may hold duplicate edges. They are
+removed and the key added with:
+
+    flask follows migrate
+"""
+
+import click
+from flask.cli import AppGroup
+from sqlalchemy import inspect, text
+
+from models import db, followers_following
+
+follows_cli = AppGroup('follows', help='Maintain the followers_following table.')
+
+
+@follows_cli.command('migrate')
+def migrate_command():
+    """Drop duplicate follows and key followers_following on an existing database."""
+    engine = db.engine
+    keyed = inspect(engine).get_pk_constraint('followers_following')['constrained_columns']
+    with engine.begin() as conn:
+        if engine.dialect.name == 'postgresql':
+            removed = conn.execute(text(
+                "DELETE FROM followers_following a USING followers_following b "
+                "WHERE a.follower_id = b.follower_id AND a.following_id = b.following_id "
+                "AND a.ctid > b.ctid")).rowcount
+            if not keyed:
+                conn.execute(text("ALTER TABLE followers_following "
+                                  "ADD PRIMARY KEY (follower_id, following_id)"))
+        else:
+            removed = conn.execute(text(
+                "DELETE FROM followers_following WHERE rowid NOT IN ("
+                "SELECT MIN(rowid) FROM followers_following "
+                "GROUP BY follower_id, following_id)")).rowcount
+            # SQLite can't add a primary key to a table; a unique index
+            # serves ON CONFLICT the same way.
+            if not keyed:
+                conn.execute(text("CREATE UNIQUE INDEX IF NOT EXISTS ux_followers_following "
+                                  "ON followers_following (follower_id, following_id)"))
+        for index in followers_following.indexes:
+            index.create(conn, checkfirst=True)
+    click.echo(f"Removed {removed} duplicate follow(s).")
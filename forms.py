@@ -1,5 +1,8 @@
+from uuid import uuid4
+
 from flask_wtf import FlaskForm
-from wtforms import StringField, PasswordField, TextAreaField, ValidationError
+from flask_wtf.file import FileField, FileAllowed
+from wtforms import StringField, PasswordField, TextAreaField, HiddenField, ValidationError
 from wtforms.validators import DataRequired, Email, Length, Optional
 from models import User, bcrypt
 from flask import g
@@ -9,7 +12,10 @@ from flask import g
 class MessageForm(FlaskForm):
     """Form for adding/editing messages."""
 
-    text = TextAreaField('text', validators=[DataRequired()])
+    text = TextAreaField('text', validators=[DataRequired(), Length(max=140)])
+    # New per rendered form, so submitting the same form twice posts once.
+    idempotency_key = HiddenField(default=lambda: uuid4().hex,
+                                  validators=[Optional(), Length(max=64)])
 
 
 class UserAddForm(FlaskForm):
@@ -22,6 +28,13 @@ class UserAddForm(FlaskForm):
     
 
 
+class FollowImportForm(FlaskForm):
+    """Form for following a list of users by username."""
+
+    usernames = TextAreaField('Usernames (one per line or comma separated)',
+                              validators=[DataRequired()])
+
+
 class LoginForm(FlaskForm):
     """Login form."""
 
@@ -37,6 +50,10 @@ class UserProfileForm(FlaskForm):
     bio = TextAreaField('Bio', validators=[Optional()])
     image_url = StringField('Image URL', validators=[Optional()])
     header_image_url = StringField('Header Image URL', validators=[Optional()])
+    image_file = FileField('Upload Image',
+                           validators=[FileAllowed(['jpg', 'jpeg', 'png', 'webp', 'gif'])])
+    header_image_file = FileField('Upload Header Image',
+                                  validators=[FileAllowed(['jpg', 'jpeg', 'png', 'webp', 'gif'])])
     location = StringField('Location', validators=[Optional()])
     password = PasswordField('Password', validators=[Length(min=6), DataRequired()])
 
@@ -0,0 +1,65 @@
+"""Gunicorn settings (picked up automatically from the working directory).
+
+Timeline streams (/api/v1/timeline/stream) keep a connection open per viewer
+for up to STREAM_MAX_SECONDS, and under these threaded workers each one holds
+a thread the whole time. They are off unless TIMELINE_STREAM=1; turn them on
+only when they are served by the ASGI entry point (asgi.py, where an idle
+stream is a queue rather than a thread) or by gevent workers
+(`pip install gevent` and WEB_WORKER_CLASS=gevent).
+
+The app is imported and its caches warmed once in the master, and workers
+inherit them when they fork (see preload.py). WEB_PRELOAD=0 imports the app
+in each worker instead, which then warms its own caches.
+"""
+
+import gc
+import multiprocessing
+import os
+
+bind = os.environ.get('BIND', '0.0.0.0:' + os.environ.get('PORT', '8000'))
+workers = int(os.environ.get('WEB_CONCURRENCY', multiprocessing.cpu_count() * 2 + 1))
+worker_class = os.environ.get('WEB_WORKER_CLASS', 'gthread')
+threads = int(os.environ.get('WEB_THREADS', 32))
+worker_connections = int(os.environ.get('WEB_WORKER_CONNECTIONS', 1000))
+
+# Streams send a heartbeat every 15 seconds; keep idle sockets around longer.
+timeout = 60
+keepalive = 75
+
+preload_app = os.environ.get('WEB_PRELOAD', '1') != '0'
+
+# Log each worker's memory every this many requests (0 turns it off).
+MEMORY_REPORT_REQUESTS = int(os.environ.get('WEB_MEMORY_REPORT_REQUESTS', 1000))
+
+if preload_app:
+    # No collections in the master until the caches are frozen in
+    # when_ready: freed objects would leave holes in pages the workers share.
+    gc.disable()
+
+
+def when_ready(server):
+    # Runs in the master after the preloaded app is imported, before any fork.
+    if preload_app:
+        from app import app
+        from preload import preload, prepare_fork
+        server.log.info("Preloaded %s", preload(app))
+        prepare_fork()
+
+
+def post_fork(server, worker):
+    gc.enable()
+
+
+def post_worker_init(worker):
+    # Without preload_app the app was only just imported, in this worker.
+    if not preload_app:
+        from app import app
+        from preload import preload
+        worker.log.info("Preloaded %s", preload(app))
+
+
+def post_request(worker, req, environ, resp):
+    if MEMORY_REPORT_REQUESTS and worker.nr % MEMORY_REPORT_REQUESTS == 0:
+        from preload import format_memory, memory_report
+        worker.log.info("Worker %s after %s requests: %s", worker.pid, worker.nr,
+                        format_memory(memory_report()))
@@ -0,0 +1,79 @@
+"""Writing likes, and schema upgrades for the likes table.
+
+Likes record when they were made (`likes.timestamp`), so "messages liked by
+X" pages order by like time through ix_likes_user_id_timestamp.
+
+A user likes a message at most once: `insert_like` skips existing likes
+and conflicts on ux_likes_user_id_message_id, so concurrent requests add
+one row. On likes converted by `flask partitions convert` that index also
+includes the timestamp and cannot see a repeat, so `like_lock` serializes
+likes of one message by one user for the transaction instead.
+
+Databases created before likes.timestamp or the unique index existed are
+upgraded with:
+
+    flask likes migrate
+
+Likes made before then get their message's timestamp, the earliest they
+could have been made, and duplicate likes are removed.
+"""
+
+from datetime import datetime
+
+import click
+from flask.cli import AppGroup
+from sqlalchemy import DateTime, Integer, func, inspect, literal, select, text
+
+from models import db, Like, insert_ignore
+from partitions import create_with_partition_key, is_partitioned
+
+likes = Like.__table__
+
+likes_cli = AppGroup('likes', help='Maintain the likes table.')
+
+
+def insert_like(user_id, message_id):
+    """INSERT ... RETURNING id of a like, adding nothing if it already exists."""
+    exists = select(likes.c.id).where(likes.c.user_id == user_id,
+                                      likes.c.message_id == message_id).exists()
+    return insert_ignore(likes).from_select(
+        ['user_id', 'message_id', 'timestamp'],
+        select(literal(user_id, Integer), literal(message_id, Integer),
+               literal(datetime.utcnow(), DateTime)).where(~exists)
+    ).returning(likes.c.id)
+
+
+def like_lock(user_id, message_id):
+    """Lock taken before `insert_like` on partitioned likes (PostgreSQL only)."""
+    return select(func.pg_advisory_xact_lock(func.hashtext(f"like:{user_id}:{message_id}")))
+
+
+@likes_cli.command('migrate')
+def migrate_command():
+    """Add likes.timestamp and the unique index on an existing database."""
+    engine = db.engine
+    inspector = inspect(engine)
+    columns = {c['name'] for c in inspector.get_columns('likes')}
+    indexes = {i['name'] for i in inspector.get_indexes('likes')}
+    with engine.begin() as conn:
+        if 'timestamp' not in columns:
+            conn.execute(text("ALTER TABLE likes ADD COLUMN timestamp TIMESTAMP"))
+        filled = conn.execute(text(
+            "UPDATE likes SET timestamp = COALESCE("
+            "(SELECT messages.timestamp FROM messages WHERE messages.id = likes.message_id), "
+            ":now) WHERE timestamp IS NULL"), {'now': datetime.utcnow()}).rowcount
+        if engine.dialect.name == 'postgresql':
+            conn.execute(text("ALTER TABLE likes ALTER COLUMN timestamp SET NOT NULL"))
+        removed = conn.execute(text(
+            "DELETE FROM likes WHERE id NOT IN ("
+            "SELECT MIN(id) FROM likes GROUP BY user_id, message_id)")).rowcount
+        for index in likes.indexes:
+            if index.name in indexes:
+                continue
+            if (index.unique and engine.dialect.name == 'postgresql'
+                    and is_partitioned(conn, 'likes')):
+                create_with_partition_key(conn, index)
+            else:
+                index.create(conn)
+    click.echo(f"Backfilled timestamp for {filled} like(s).")
+    click.echo(f"Removed {removed} duplicate like(s).")
@@ -0,0 +1,244 @@
+"""Profile and header image storage with resized variants.
+
+Images are stored on local disk under MEDIA_ROOT using the SHA-256 of their
+bytes as the filename, so a file's URL never changes meaning and can be
+served with a one-year immutable Cache-Control. For each original a
+background worker writes a JPEG and a WebP copy at every width in VARIANTS
+(skipping widths larger than the original):
+
+    /media/ab/<digest>.jpg             original upload
+    /media/ab/<digest>-144.webp        'card' variant
+    /media/ab/<digest>-144.jpg         'card' variant, JPEG fallback
+
+Templates ask for a size with the `variant` filter,
+`{{ user.image_url|variant('card') }}`, which returns the matching variant
+once it exists (WebP when the browser accepts it) and the original URL
+otherwise, including for remote URLs that have not been imported yet.
+"""
+
+import hashlib
+import io
+import logging
+import os
+import queue
+import re
+import threading
+
+import click
+import requests
+from flask import Blueprint, abort, current_app, g, request, send_from_directory
+from PIL import Image, UnidentifiedImageError
+
+from models import db, User
+
+logger = logging.getLogger(__name__)
+
+media = Blueprint('media', __name__)
+
+# Name -> pixel width. Widths are about 2x the CSS size for high-DPI screens.
+VARIANTS = {
+    'thumb': 96,      # .timeline-image, navbar (48px)
+    'card': 144,      # .card-image (70px)
+    'avatar': 400,    # #profile-avatar (200px)
+    'hero': 640,      # .card-hero on /users and home cards
+}
+
+ALLOWED_FORMATS = {'JPEG': 'jpg', 'PNG': 'png', 'WEBP': 'webp', 'GIF': 'gif'}
+MAX_UPLOAD_BYTES = 5 * 1024 * 1024
+CACHE_SECONDS = 365 * 24 * 60 * 60
+
+MEDIA_URL_RE = re.compile(r'^/media/[0-9a-f]{2}/([0-9a-f]{64})\.\w+$')
+PREFIX_RE = re.compile(r'^[0-9a-f]{2}$')
+FILENAME_RE = re.compile(r'^[0-9a-f]{64}(-\d+)?\.(jpg|png|webp|gif)$')
+
+
+class MediaError(ValueError):
+    """Raised for uploads that are not acceptable images."""
+
+
+def media_root():
+    return current_app.config['MEDIA_ROOT']
+
+
+def _path(root, name):
+    return os.path.join(root, name[:2], name)
+
+
+def _variant_name(digest, width, ext):
+    return f"{digest}-{width}.{ext}"
+
+
+def _write_atomic(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, 'wb') as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+
+def store(data):
+    """Store image bytes by content hash; return the original's URL.
+
+    Raises MediaError if `data` is not a supported image.
+    """
+    if len(data) > MAX_UPLOAD_BYTES:
+        raise MediaError("Image is too large (5 MB max).")
+    try:
+        with Image.open(io.BytesIO(data)) as img:
+            img.verify()
+            ext = ALLOWED_FORMATS.get(img.format)
+    except (UnidentifiedImageError, OSError, SyntaxError):
+        raise MediaError("File is not a valid image.")
+    if ext is None:
+        raise MediaError("Images must be JPEG, PNG, WebP or GIF.")
+
+    digest = hashlib.sha256(data).hexdigest()
+    name = f"{digest}.{ext}"
+    path = _path(media_root(), name)
+    if not os.path.exists(path):
+        _write_atomic(path, data)
+    worker.enqueue(current_app._get_current_object(), name)
+    return f"/media/{name[:2]}/{name}"
+
+
+def save_upload(file):
+    """Store an uploaded FileStorage; return its URL, or None if no file."""
+    if not file or not getattr(file, 'filename', None):
+        return None
+    return store(file.read(MAX_UPLOAD_BYTES + 1))
+
+
+def make_variants(root, name):
+    """Write every JPEG/WebP variant of the stored original `name`."""
+    digest = name.split('.')[0]
+    with Image.open(_path(root, name)) as img:
+        img = img.convert('RGB')
+        for width in sorted(set(VARIANTS.values())):
+            if width > img.width:
+                continue
+            resized = img.resize((width, max(1, round(img.height * width / img.width))),
+                                 Image.LANCZOS)
+            for ext, fmt, options in (('webp', 'WEBP', {'quality': 80, 'method': 4}),
+                                      ('jpg', 'JPEG', {'quality': 82, 'optimize': True,
+                                                       'progressive': True})):
+                out = io.BytesIO()
+                resized.save(out, fmt, **options)
+                _write_atomic(_path(root, _variant_name(digest, width, ext)), out.getvalue())
+
+
+class MediaWorker:
+    """Background thread that generates variants for newly stored images.
+
+    The thread starts on first use in each process, so it survives gunicorn
+    forking workers after the app is imported.
+    """
+
+    def __init__(self):
+        self.queue = queue.Queue()
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def enqueue(self, app, name):
+        self._ensure_started()
+        self.queue.put((app.config['MEDIA_ROOT'], name))
+
+    def join(self):
+        """Block until every queued image has been processed."""
+        self.queue.join()
+
+    def _ensure_started(self):
+        with self._lock:
+            if self._thread is None or self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._thread = threading.Thread(target=self._run, name='media-worker',
+                                                daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            root, name = self.queue.get()
+            try:
+                make_variants(root, name)
+            except Exception:  # keep the worker alive for the next job
+                logger.exception("Could not process %s", name)
+            finally:
+                self.queue.task_done()
+
+
+worker = MediaWorker()
+
+# Variants seen on disk, so each is stat'ed at most once per process.
+_ready = set()
+
+
+def variant_url(url, size, webp=True):
+    """URL of the `size` variant of `url`, or `url` itself if there is none."""
+    match = MEDIA_URL_RE.match(url or '')
+    if match is None:
+        return url
+    digest = match.group(1)
+    width = VARIANTS[size]
+    for ext in (('webp', 'jpg') if webp else ('jpg',)):
+        name = _variant_name(digest, width, ext)
+        if name in _ready:
+            return f"/media/{name[:2]}/{name}"
+        if os.path.exists(_path(media_root(), name)):
+            _ready.add(name)
+            return f"/media/{name[:2]}/{name}"
+    return url
+
+
+@media.app_template_filter('variant')
+def variant_filter(url, size):
+    # Exact match only: `*/*` would also "accept" WebP for old browsers.
+    webp = bool(request) and any(m == 'image/webp' for m, _ in request.accept_mimetypes)
+    if request:
+        g.media_vary_accept = True
+    return variant_url(url, size, webp=webp)
+
+
+@media.after_app_request
+def vary_on_accept(resp):
+    """Pages that picked variants by the Accept header differ by it."""
+    if g.get('media_vary_accept'):
+        resp.vary.add('Accept')
+    return resp
+
+
+@media.route('/media/<string:prefix>/<string:filename>')
+def serve(prefix, filename):
+    """Serve a stored file. Content-addressed, so it is cached forever."""
+    if not (PREFIX_RE.match(prefix) and FILENAME_RE.match(filename)
+            and filename.startswith(prefix)):
+        abort(404)
+    resp = send_from_directory(media_root(), f"{prefix}/{filename}", max_age=CACHE_SECONDS)
+    resp.headers['Cache-Control'] = f'public, max-age={CACHE_SECONDS}, immutable'
+    return resp
+
+
+@media.cli.command('import-remote')
+@click.option('--limit', default=None, type=int, help='Only import this many users.')
+def import_remote(limit):
+    """Download users' remote profile/header images into local media."""
+    users = User.query.filter(User.image_url.like('http%') |
+                              User.header_image_url.like('http%')).limit(limit).all()
+    cache = {}
+    for user in users:
+        for column in ('image_url', 'header_image_url'):
+            url = getattr(user, column)
+            if not url or not url.startswith('http'):
+                continue
+            if url not in cache:
+                try:
+                    resp = requests.get(url, timeout=10)
+                    resp.raise_for_status()
+                    cache[url] = store(resp.content)
+                except (requests.RequestException, MediaError) as exc:
+                    click.echo(f"skip {url}: {exc}")
+                    cache[url] = None
+            if cache[url]:
+                setattr(user, column, cache[url])
+        db.session.commit()
+    worker.join()
+    click.echo(f"Imported images for {len(users)} users.")
@@ -1,7 +1,11 @@
-from datetime import datetime
+import sqlite3
+import unicodedata
+from datetime import datetime, timedelta
 from flask_bcrypt import Bcrypt
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy.orm import relationship, backref
+from sqlalchemy import event, select, func
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import relationship, backref, aliased, contains_eager, validates
 
 bcrypt = Bcrypt()
 db = SQLAlchemy()
@@ -9,10 +13,83 @@ db = SQLAlchemy()
 # Define the association table for followers and followings
 followers_following = db.Table(
     'followers_following',
-    db.Column('follower_id', db.Integer, db.ForeignKey('users.id', ondelete='CASCADE')),
-    db.Column('following_id', db.Integer, db.ForeignKey('users.id', ondelete='CASCADE'))
+    db.Column('follower_id', db.Integer, db.ForeignKey('users.id', ondelete='CASCADE'),
+              primary_key=True),
+    db.Column('following_id', db.Integer, db.ForeignKey('users.id', ondelete='CASCADE'),
+              primary_key=True)
 )
 
+# Serves follower lists and the fan-out of new messages to followers.
+db.Index('ix_followers_following_following_id', followers_following.c.following_id)
+
+# Materialized home timelines, read by the 'precomputed' plan in timeline.py.
+# No foreign key to messages: it may be partitioned (see partitions.py), and
+# readers join messages anyway, which skips deleted ones.
+timeline_entries = db.Table(
+    'timeline_entries',
+    db.Column('owner_id', db.Integer, db.ForeignKey('users.id', ondelete='CASCADE'),
+              primary_key=True),
+    db.Column('message_id', db.Integer, primary_key=True),
+    db.Column('timestamp', db.DateTime, nullable=False),
+    db.Index('ix_timeline_entries_owner_id_timestamp', 'owner_id', 'timestamp'),
+)
+
+# One row per recipient and group of similar events: a new unread like of
+# message 7 bumps the unread ('like', 7) row instead of adding one, so "12
+# people liked your warble" is a single row. See notifications.py.
+notifications = db.Table(
+    'notifications',
+    db.Column('id', db.Integer, primary_key=True),
+    db.Column('user_id', db.Integer, db.ForeignKey('users.id', ondelete='CASCADE'),
+              nullable=False),
+    db.Column('kind', db.SmallInteger, nullable=False),
+    # The message liked or mentioned in; 0 for follows.
+    db.Column('subject_id', db.Integer, nullable=False),
+    # The most recent actor, and how many events the row stands for.
+    db.Column('actor_id', db.Integer, db.ForeignKey('users.id', ondelete='CASCADE'),
+              nullable=False),
+    db.Column('actor_count', db.Integer, nullable=False),
+    db.Column('updated_at', db.DateTime, nullable=False),
+    db.Column('read_at', db.DateTime),
+    # The /notifications page, newest first.
+    db.Index('ix_notifications_user_id_updated_at', 'user_id', 'updated_at', 'id'),
+    # The group new events are added to, and the unread count.
+    db.Index('ux_notifications_unread', 'user_id', 'kind', 'subject_id', unique=True,
+             postgresql_where=db.text('read_at IS NULL'),
+             sqlite_where=db.text('read_at IS NULL')),
+)
+
+# Most follow/unfollow batches are far smaller; this bounds one statement.
+MAX_FOLLOW_BATCH = 1000
+
+# Granularity of User.last_active_at.
+ACTIVE_RESOLUTION = timedelta(minutes=5)
+
+
+def normalize_username(username):
+    """Case- and width-folded form of `username` that uniqueness and lookups use."""
+    return unicodedata.normalize('NFKC', username).casefold()
+
+
+def _username_key_default(context):
+    return normalize_username(context.get_current_parameters()['username'])
+
+
+def insert_ignore(table):
+    """INSERT ... ON CONFLICT DO NOTHING for the current database."""
+    if db.engine.dialect.name == 'sqlite':
+        from sqlalchemy.dialects.sqlite import insert
+    else:
+        from sqlalchemy.dialects.postgresql import insert
+    return insert(table).on_conflict_do_nothing()
+
+
+@event.listens_for(Engine, 'connect')
+def _enable_sqlite_foreign_keys(dbapi_connection, connection_record):
+    """SQLite ignores foreign keys (and ON DELETE CASCADE) unless asked."""
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        dbapi_connection.execute("PRAGMA foreign_keys = ON")
+
 
 # from sqlalchemy import ForeignKeyConstraint
 
@@ -51,16 +128,28 @@ class Like(db.Model):
         db.ForeignKey('messages.id', ondelete='cascade')
     )
 
+    timestamp = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
     liker = db.relationship('User', backref='likes')  # Change 'user' to 'liker'
     message = db.relationship('Message', backref='likes')
 
+    # Serves "messages liked by user X, most recent like first".
+    # A user likes a message once; see likes.py.
+    __table_args__ = (
+        db.Index('ix_likes_user_id_timestamp', 'user_id', 'timestamp'),
+        db.Index('ux_likes_user_id_message_id', 'user_id', 'message_id', unique=True),
+    )
+
 class User(db.Model):
     """User in the system."""
 
     __tablename__ = 'users'
 
     id = db.Column(db.Integer, primary_key=True)
-    username = db.Column(db.String(80), unique=True, nullable=False)
 
     email = db.Column(
         db.Text,
@@ -74,6 +163,17 @@ class User(db.Model):
         unique=True,
     )
 
+    # normalize_username(username): "Alice" and "alice" are the same user.
+    # Set by `_set_username_key` on ORM changes and by the default on Core
+    # inserts that leave it out.
+    username_key = db.Column(
+        db.Text,
+        nullable=False,
+        unique=True,
+        index=True,
+        default=_username_key_default,
+    )
+
     image_url = db.Column(
         db.Text,
         default="/static/images/default-pic.png",
@@ -97,9 +197,26 @@ class User(db.Model):
         nullable=False,
     )
 
+    # When the user last posted (or signed up); orders the /users directory.
+    last_active_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+    # "Active recently" directory pages, newest first with id as tiebreaker.
+    __table_args__ = (
+        db.Index('ix_users_last_active_at_id', 'last_active_at', 'id'),
+    )
+
 
     messages = db.relationship('Message', backref='user', lazy='dynamic', cascade='all, delete-orphan')
 
+    @validates('username')
+    def _set_username_key(self, key, username):
+        self.username_key = normalize_username(username)
+        return username
+
     # # Define the 'likes' relationship with cascade option
     # user_likes = db.relationship('Like', backref='user', lazy='dynamic', cascade='all, delete-orphan')
 
@@ -148,7 +265,70 @@ class User(db.Model):
             self.following.remove(user)
             user.followers.remove(self)  # Remove the reverse relationship
             return self
-        
+
+    def _resolve_follow_targets(self, ids=(), usernames=()):
+        """Ids of existing users matching `ids` or `usernames`, minus self."""
+        from usernames import username_ids
+        ids = {int(i) for i in ids}
+        usernames = set(usernames)
+        if len(ids) + len(usernames) > MAX_FOLLOW_BATCH:
+            raise ValueError(f"At most {MAX_FOLLOW_BATCH} users per batch.")
+        if usernames:
+            ids.update(username_ids.resolve(usernames).values())
+        if not ids:
+            return []
+        stmt = select(User.id).where(User.id.in_(ids))
+        return [i for i in db.session.execute(stmt).scalars() if i != self.id]
+
+    def follow_many(self, ids=(), usernames=()):
+        """Follow every user in `ids`/`usernames` with one multi-row INSERT.
+
+        Already-followed and unknown users are skipped. Returns the number of
+        new follows. The caller commits.
+        """
+        target_ids = self._resolve_follow_targets(ids, usernames)
+        if not target_ids:
+            return 0
+        from events import stage
+        from notifications import FOLLOW, notify
+        from profiles import invalidate
+        followed = db.session.execute(
+            insert_ignore(followers_following).values(
+                [{'follower_id': self.id, 'following_id': i} for i in target_ids])
+            .returning(followers_following.c.following_id)).scalars().all()
+        if followed:
+            self.reset_timeline()
+            stage('follow', follower_id=self.id, following_ids=followed)
+            notify(FOLLOW, followed, self.id)
+            invalidate(self.id, *followed)
+        return len(followed)
+
+    def unfollow_many(self, ids=(), usernames=()):
+        """Unfollow every user in `ids`/`usernames` with one DELETE.
+
+        Returns the number of follows removed. The caller commits.
+        """
+        target_ids = self._resolve_follow_targets(ids, usernames)
+        if not target_ids:
+            return 0
+        from events import stage
+        from profiles import invalidate
+        unfollowed = db.session.execute(
+            followers_following.delete().where(
+                followers_following.c.follower_id == self.id,
+                followers_following.c.following_id.in_(target_ids))
+            .returning(followers_following.c.following_id)).scalars().all()
+        if unfollowed:
+            self.reset_timeline()
+            stage('unfollow', follower_id=self.id, following_ids=unfollowed)
+            invalidate(self.id, *unfollowed)
+        return len(unfollowed)
+
+    def reset_timeline(self):
+        """Drop the materialized timeline; it is rebuilt on the next read."""
+        db.session.execute(timeline_entries.delete()
+                           .where(timeline_entries.c.owner_id == self.id))
+
     @classmethod
     def signup(cls, username, email, password, image_url):
         """Sign up user.
@@ -179,7 +359,7 @@ class User(db.Model):
         If can't find matching user (or if password is wrong), returns False.
         """
 
-        user = cls.query.filter_by(username=username).first()
+        user = cls.query.filter_by(username_key=normalize_username(username)).first()
 
         if user:
             is_auth = bcrypt.check_password_hash(user.password, password)
@@ -229,6 +409,34 @@ class Message(db.Model):
         back_populates='user_liked_messages'
     )
 
+    # Client-supplied key that makes retried posts idempotent; see posting.py.
+    idempotency_key = db.Column(
+        db.String(64),
+    )
+
+    # Set when the author deletes the message; the row and its likes are
+    # removed later by `flask messages purge` (see deletes.py). Every read
+    # filters on `deleted_at IS NULL`.
+    deleted_at = db.Column(
+        db.DateTime,
+    )
+
+    # Newest live messages per author: profiles and the per-followee timeline
+    # plans. Deleted messages waiting for the purge are indexed separately.
+    # Idempotency keys are unique per author; keyless messages aren't indexed.
+    __table_args__ = (
+        db.Index('ix_messages_user_id_timestamp', 'user_id', 'timestamp',
+                 postgresql_where=db.text('deleted_at IS NULL'),
+                 sqlite_where=db.text('deleted_at IS NULL')),
+        db.Index('ix_messages_deleted_at', 'deleted_at',
+                 postgresql_where=db.text('deleted_at IS NOT NULL'),
+                 sqlite_where=db.text('deleted_at IS NOT NULL')),
+        db.Index('ux_messages_user_id_idempotency_key', 'user_id', 'idempotency_key',
+                 unique=True,
+                 postgresql_where=db.text('idempotency_key IS NOT NULL'),
+                 sqlite_where=db.text('idempotency_key IS NOT NULL')),
+    )
+
     def __repr__(self):
         return f"<Message #{self.id}: {self.text[:20]}..."
 
@@ -240,6 +448,28 @@ class Message(db.Model):
     def is_liked_by(self, user):
         return Like.query.filter_by(message_id=self.id, user_id=user.id).first() is not None
 
+    @classmethod
+    def liked_by(cls, user_id, page=1, per_page=20):
+        """One page of messages liked by `user_id`, most recently liked first.
+
+        Returns (rows, has_next). Each row is (message, liked_at, like_count),
+        with the message's author already loaded, all from a single query.
+        """
+        other_likes = aliased(Like)
+        like_count = (select(func.count(other_likes.id))
+                      .where(other_likes.message_id == cls.id)
+                      .scalar_subquery())
+        stmt = (select(cls, Like.timestamp.label('liked_at'), like_count.label('like_count'))
+                .join(Like, Like.message_id == cls.id)
+                .join(cls.user)
+                .options(contains_eager(cls.user))
+                .where(Like.user_id == user_id, cls.deleted_at.is_(None))
+                .order_by(Like.timestamp.desc(), Like.id.desc())
+                .offset((page - 1) * per_page)
+                .limit(per_page + 1))
+        rows = db.session.execute(stmt).all()
+        return rows[:per_page], len(rows) > per_page
+
 #IMPLEMENT INTO APP- USING FOR TESTING
     @classmethod
     def create(cls, text, user_id):
@@ -0,0 +1,316 @@
+"""Notifications: new followers, likes of your warbles, and @mentions.
+
+Similar events are aggregated as they are written. A user's unread
+notifications hold at most one row per (kind, subject) -- for example
+("like", message 7) -- which each new event updates with an upsert: the
+count goes up and the newest actor replaces the previous one, so "12
+people liked your warble" is one row. Once read, a row is left as it is,
+and the next event starts a new group. The count is of events, so a like
+that is taken back and given again counts twice.
+
+`notify()` is called in the transaction that made the change. By default
+the rows are written right there. With NOTIFY_FLUSH_INTERVAL set, they are
+handed to `notification_writer` when the transaction commits instead. Its
+thread coalesces everything that arrives within the interval and writes it
+with one multi-row upsert per flush, so a burst of likes on a popular
+warble costs one statement instead of one per like.
+
+Unread counts (shown in the navbar) are served from `unread_counts`, a
+ReadThroughCache that writes and reads invalidate. The /notifications page
+is a single query on (user_id, updated_at, id), keyset-paginated, joining
+the actor and, for likes and mentions, the message.
+"""
+
+import logging
+import os
+import re
+import threading
+import time
+from datetime import datetime
+
+from sqlalchemy import and_, event, func, or_, select, tuple_, update
+from sqlalchemy.orm import Session
+
+from cache import ReadThroughCache
+from models import db, Message, User, notifications
+
+FOLLOW = 1
+LIKE = 2
+MENTION = 3
+
+NOTIFICATIONS_PAGE_SIZE = 20
+UNREAD_TTL = 30
+
+# Failed flushes in a row after which the pending groups are dropped.
+FLUSH_ATTEMPTS = 3
+
+# @name at the start of the text or after a non-word character.
+MENTION_RE = re.compile(r'(?<![\w@])@(\w+)')
+
+unread_counts = ReadThroughCache(ttl=UNREAD_TTL, stale_ttl=0)
+
+logger = logging.getLogger(__name__)
+
+nc = notifications.c
+
+
+def mentions(text):
+    """Usernames mentioned in `text`, in order, without repeats."""
+    return list(dict.fromkeys(MENTION_RE.findall(text or '')))
+
+
+def aggregate(events, groups=None):
+    """Fold (user_id, kind, subject_id, actor_id, at) events into `groups`.
+
+    `groups` maps (user_id, kind, subject_id) to [count, actor_id, at]; the
+    latest event's actor wins.
+    """
+    groups = {} if groups is None else groups
+    for user_id, kind, subject_id, actor_id, at in events:
+        group = groups.get((user_id, kind, subject_id))
+        if group is None:
+            groups[(user_id, kind, subject_id)] = [1, actor_id, at]
+        else:
+            group[0] += 1
+            if at >= group[2]:
+                group[1], group[2] = actor_id, at
+    return groups
+
+
+def upsert_statement(dialect):
+    """INSERT adding to the matching unread group, for `dialect`."""
+    if dialect == 'sqlite':
+        from sqlalchemy.dialects.sqlite import insert
+    else:
+        from sqlalchemy.dialects.postgresql import insert
+    stmt = insert(notifications)
+    return stmt.on_conflict_do_update(
+        index_elements=[nc.user_id, nc.kind, nc.subject_id],
+        index_where=nc.read_at.is_(None),
+        set_={'actor_count': nc.actor_count + stmt.excluded.actor_count,
+              'actor_id': stmt.excluded.actor_id,
+              'updated_at': stmt.excluded.updated_at})
+
+
+def upsert_rows(groups):
+    """Parameter rows for `upsert_statement`, in key order so writers lock alike."""
+    return [{'user_id': user_id, 'kind': kind, 'subject_id': subject_id,
+             'actor_id': actor_id, 'actor_count': count, 'updated_at': at}
+            for (user_id, kind, subject_id), (count, actor_id, at) in sorted(groups.items())]
+
+
+def write_groups(groups):
+    """Upsert `groups` in the current transaction; return the recipients."""
+    if groups:
+        db.session.execute(upsert_statement(db.engine.dialect.name), upsert_rows(groups))
+    return {user_id for user_id, _, _ in groups}
+
+
+def notification_events(kind, recipients, actor_id, subject_id=0):
+    """Events for `aggregate`; the actor is never notified of their own action."""
+    now = datetime.utcnow()
+    return [(user_id, kind, subject_id, actor_id, now)
+            for user_id in set(recipients) if user_id != actor_id]
+
+
+def notify(kind, recipients, actor_id, subject_id=0):
+    """Tell each of `recipients` that `actor_id` did `kind` (to `subject_id`).
+
+    The caller commits.
+    """
+    events = notification_events(kind, recipients, actor_id, subject_id)
+    if not events:
+        return
+    if notification_writer.enabled:
+        # Begin the transaction if nothing has yet, so that rolling it back
+        # drops the staged events too.
+        db.session.connection()
+        db.session.info.setdefault('notifications', []).extend(events)
+    else:
+        invalidate_unread(*write_groups(aggregate(events)))
+
+
+def notify_mentions(posts):
+    """Notify users @mentioned in newly written `posts` (see posting.py)."""
+    from usernames import username_ids
+    names = {name: post for post in posts for name in mentions(post.text)}
+    if not names:
+        return
+    ids = username_ids.resolve(names)
+    for name, user_id in ids.items():
+        post = names[name]
+        notify(MENTION, [user_id], post.user_id, post.id)
+
+
+##############################################################################
+# Batched writes
+
+class NotificationWriter:
+    """Thread that writes notifications from committed transactions in batches.
+
+    Like the media worker, the thread starts on first use in each process.
+    With `interval` 0 there is no thread and `flush()` is up to the caller.
+
+    When a flush fails, its groups go back into the pending ones (merged with
+    whatever arrived meanwhile) and are tried again with the next flush.
+    After FLUSH_ATTEMPTS failures in a row they are logged and dropped, so a
+    batch the database keeps rejecting cannot hold up later notifications.
+    """
+
+    def __init__(self, interval=0.0):
+        self.app = None
+        self.interval = interval
+        self.flushes = 0
+        self.failures = 0
+        self._groups = {}
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+
+    @property
+    def enabled(self):
+        return self.app is not None
+
+    def add(self, events):
+        if self.interval > 0:
+            self._ensure_started()
+        with self._lock:
+            aggregate(events, self._groups)
+
+    def flush(self):
+        """Write everything pending in one transaction; return the rows written."""
+        with self._lock:
+            groups, self._groups = self._groups, {}
+        if not groups:
+            return 0
+        try:
+            recipients = write_groups(groups)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            self._retry(groups)
+            raise
+        self.failures = 0
+        for user_id in recipients:
+            unread_counts.delete(unread_key(user_id))
+        self.flushes += 1
+        return len(groups)
+
+    def _retry(self, groups):
+        self.failures += 1
+        if self.failures >= FLUSH_ATTEMPTS:
+            logger.error("Dropping %d notification group(s) after %d failed flushes",
+                         len(groups), self.failures)
+            self.failures = 0
+            return
+        with self._lock:
+            for key, (count, actor_id, at) in groups.items():
+                group = self._groups.get(key)
+                if group is None:
+                    self._groups[key] = [count, actor_id, at]
+                else:
+                    group[0] += count
+                    if at > group[2]:
+                        group[1], group[2] = actor_id, at
+
+    def _ensure_started(self):
+        with self._lock:
+            if self._thread is None or self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._groups = {}
+                self._thread = threading.Thread(target=self._run, name='notifications',
+                                                daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        with self.app.app_context():
+            while True:
+                time.sleep(self.interval)
+                try:
+                    self.flush()
+                except Exception:  # keep the writer alive for the next batch
+                    logger.exception("Could not write a batch of notifications")
+                finally:
+                    db.session.remove()
+
+
+notification_writer = NotificationWriter()
+
+
+@event.listens_for(Session, 'after_commit')
+def _hand_over_notifications(session):
+    events = session.info.pop('notifications', None)
+    if events:
+        notification_writer.add(events)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _drop_notifications(session):
+    session.info.pop('notifications', None)
+
+
+##############################################################################
+# Reading
+
+def unread_key(user_id):
+    return f"unread:{user_id}"
+
+
+def unread_count(user_id):
+    """Unread notification groups of `user_id`, from the cache."""
+    return unread_counts.get(unread_key(user_id), lambda: db.session.execute(
+        select(func.count()).select_from(notifications)
+        .where(nc.user_id == user_id, nc.read_at.is_(None))).scalar())
+
+
+def invalidate_unread(*user_ids):
+    """Drop the cached unread counts of `user_ids` once the transaction commits."""
+    if unread_counts.enabled:
+        db.session.info.setdefault('stale_unread', set()).update(user_ids)
+
+
+@event.listens_for(Session, 'after_commit')
+def _drop_stale_unread(session):
+    for user_id in session.info.pop('stale_unread', ()):
+        unread_counts.delete(unread_key(user_id))
+
+
+@event.listens_for(Session, 'after_rollback')
+def _keep_unread(session):
+    session.info.pop('stale_unread', None)
+
+
+def notifications_page(user_id, cursor=None, limit=NOTIFICATIONS_PAGE_SIZE):
+    """One page of `user_id`'s notifications after `cursor`, newest first.
+
+    Returns (rows, next_cursor). Rows carry the notification columns, the
+    actor's username and image, and `text` of the liked or mentioning
+    message. Likes and mentions of deleted messages are left out.
+    """
+    actor = User.__table__.c
+    stmt = (select(nc.id, nc.kind, nc.subject_id, nc.actor_id, nc.actor_count, nc.updated_at,
+                   nc.read_at, actor.username, actor.image_url, Message.text)
+            .select_from(notifications)
+            .join(User.__table__, actor.id == nc.actor_id)
+            .outerjoin(Message, and_(Message.id == nc.subject_id, nc.kind != FOLLOW,
+                                     Message.deleted_at.is_(None)))
+            .where(nc.user_id == user_id, or_(nc.kind == FOLLOW, Message.id.is_not(None))))
+    if cursor:
+        stmt = stmt.where(tuple_(nc.updated_at, nc.id) < tuple_(*cursor))
+    rows = db.session.execute(
+        stmt.order_by(nc.updated_at.desc(), nc.id.desc()).limit(limit + 1)).all()
+    next_cursor = (rows[limit - 1].updated_at, rows[limit - 1].id) if len(rows) > limit else None
+    return rows[:limit], next_cursor
+
+
+def mark_read(user_id, ids):
+    """Mark `user_id`'s notifications `ids` read. The caller commits."""
+    if not ids:
+        return 0
+    result = db.session.execute(update(notifications)
+                                .where(nc.user_id == user_id, nc.id.in_(ids),
+                                       nc.read_at.is_(None))
+                                .values(read_at=datetime.utcnow()))
+    if result.rowcount:
+        invalidate_unread(user_id)
+    return result.rowcount
@@ -0,0 +1,347 @@
+"""Monthly time-range partitions for messages and likes, plus the archive.
+
+On PostgreSQL, `flask partitions convert` turns `messages` and `likes` into
+tables declaratively partitioned on their `timestamp` column:
+
+    messages                    PARTITION BY RANGE (timestamp)
+      messages_y2023m09         FROM ('2023-09-01') TO ('2023-10-01')
+      messages_y2023m10         FROM ('2023-10-01') TO ('2023-11-01')
+      messages_default          DEFAULT
+
+A query that bounds `timestamp` only scans the partitions in range, so on
+partitioned tables the timeline queries go through `newest_first`, which
+looks at the last week first and only widens the window when that does not
+fill the page. Unpartitioned tables are read in one query. Whether the
+tables are partitioned is looked up once per engine (`partitioned`), so
+restart the app after converting.
+
+Postgres requires the primary key of a partitioned table to contain the
+partition key, so the keys become (id, timestamp) and `likes.message_id`
+can no longer have a foreign key to `messages`. Ids still come from the
+original sequences and stay unique. The same goes for unique indexes:
+`ux_messages_user_id_idempotency_key` becomes (user_id, idempotency_key,
+timestamp), which no longer catches a repeated key, so posting.py checks
+for one itself on partitioned tables.
+
+`flask partitions ensure` (run it daily from cron) creates the partitions
+for the coming months. `flask partitions archive` writes every partition
+older than ARCHIVE_AFTER_MONTHS to a Parquet file under ARCHIVE_ROOT and
+drops it; `archived_messages` reads those files for profile history. The
+files are sorted by user_id, so the Parquet row-group statistics let a
+reader skip everything but one user's rows.
+"""
+
+import os
+import re
+from datetime import datetime, timedelta
+
+import click
+from flask import current_app
+from flask.cli import AppGroup
+from sqlalchemy import Boolean, DateTime, Integer, text
+
+from models import db, Message
+
+try:
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+    import pyarrow.parquet as pq
+except ImportError:  # pragma: no cover - only needed for the archive
+    pa = None
+
+PARTITIONED_TABLES = ('messages', 'likes')
+
+# Timeline queries look back this far first, then widen; None is unbounded.
+TIMELINE_WINDOWS = (timedelta(days=7), timedelta(days=90), None)
+
+# Rows fetched per round trip while exporting a partition.
+ARCHIVE_BATCH_ROWS = 10_000
+
+PARTITION_RE = re.compile(r'^(\w+)_y(\d{4})m(\d{2})$')
+
+partitions_cli = AppGroup('partitions', help='Manage message/like partitions.')
+
+
+##############################################################################
+# Partition-aware reads
+
+def windowed(stmt, upper=None):
+    """Yield (is_last, stmt bounded to ever wider windows ending at `upper`)."""
+    upper = upper or datetime.utcnow()
+    for window in TIMELINE_WINDOWS:
+        if window is None:
+            yield True, stmt
+        else:
+            yield False, stmt.where(Message.timestamp >= upper - window)
+
+
+def newest_first(execute, stmt, limit, upper=None):
+    """Run a newest-first message query, scanning as few partitions as possible.
+
+    `execute(stmt)` returns a list of rows. Any window holding `limit` rows
+    already contains the newest `limit` rows overall, so wider windows are
+    only tried when a narrower one comes up short.
+    """
+    for last, bounded in windowed(stmt, upper):
+        rows = execute(bounded)
+        if last or len(rows) >= limit:
+            return rows
+
+
+def archived_messages(root, user_id, before=None, limit=20):
+    """Archived messages by `user_id`, newest first, as dicts.
+
+    `before` is an optional (timestamp, id) keyset bound.
+    """
+    path = os.path.join(root, 'messages')
+    if not os.path.isdir(path):
+        return []
+    if pa is None:
+        raise RuntimeError("pyarrow is required to read the message archive.")
+    condition = ds.field('user_id') == user_id
+    if before is not None:
+        ts, msg_id = before
+        condition &= ((ds.field('timestamp') < pa.scalar(ts, pa.timestamp('us'))) |
+                      ((ds.field('timestamp') == pa.scalar(ts, pa.timestamp('us'))) &
+                       (ds.field('id') < msg_id)))
+    table = ds.dataset(path, format='parquet').to_table(
+        columns=['id', 'text', 'timestamp', 'user_id'], filter=condition)
+    table = table.sort_by([('timestamp', 'descending'), ('id', 'descending')])
+    return table.slice(0, limit).to_pylist()
+
+
+##############################################################################
+# DDL
+
+def month_start(dt):
+    return datetime(dt.year, dt.month, 1)
+
+
+def add_months(dt, months):
+    index = dt.year * 12 + dt.month - 1 + months
+    return datetime(index // 12, index % 12 + 1, 1)
+
+
+def partition_name(table, start):
+    return f"{table}_y{start.year}m{start.month:02d}"
+
+
+def is_partitioned(conn, table):
+    relkind = conn.execute(text("SELECT relkind FROM pg_class WHERE oid = to_regclass(:t)"),
+                           {'t': table}).scalar()
+    return relkind == 'p'
+
+
+# (engine, table) -> whether the table is partitioned, for `partitioned`.
+_partitioned = {}
+
+
+def partitioned(conn, table='messages'):
+    """`is_partitioned`, looked up once per engine; always False off PostgreSQL."""
+    key = (conn.engine, table)
+    found = _partitioned.get(key)
+    if found is None:
+        found = conn.dialect.name == 'postgresql' and is_partitioned(conn, table)
+        _partitioned[key] = found
+    return found
+
+
+def forget_partitioned():
+    """Look the partitioning up again on next use (after convert or in tests)."""
+    _partitioned.clear()
+
+
+def list_partitions(conn, table):
+    """[(name, start, end)] of the monthly partitions of `table`, oldest first."""
+    names = conn.execute(text(
+        "SELECT c.relname FROM pg_inherits i "
+        "JOIN pg_class c ON c.oid = i.inhrelid "
+        "WHERE i.inhparent = to_regclass(:t)"), {'t': table}).scalars()
+    found = []
+    for name in names:
+        match = PARTITION_RE.match(name)
+        if match and match.group(1) == table:
+            start = datetime(int(match.group(2)), int(match.group(3)), 1)
+            found.append((name, start, add_months(start, 1)))
+    return sorted(found, key=lambda p: p[1])
+
+
+def create_partition(conn, table, start):
+    """Create the month partition of `table` starting at `start`, if missing.
+
+    Rows that already landed in the default partition for that month are
+    moved into the new one.
+    """
+    name = partition_name(table, start)
+    if conn.execute(text("SELECT to_regclass(:n)"), {'n': name}).scalar() is not None:
+        return False
+    end = add_months(start, 1)
+    bounds = {'start': start, 'end': end}
+    conn.execute(text(
+        f"CREATE TABLE {name} (LIKE {table} INCLUDING DEFAULTS INCLUDING CONSTRAINTS)"))
+    conn.execute(text(
+        f"WITH moved AS (DELETE FROM {table}_default "
+        f"WHERE timestamp >= :start AND timestamp < :end RETURNING *) "
+        f"INSERT INTO {name} SELECT * FROM moved"), bounds)
+    conn.execute(text(
+        f"ALTER TABLE {table} ATTACH PARTITION {name} "
+        f"FOR VALUES FROM ('{start.isoformat()}') TO ('{end.isoformat()}')"))
+    return True
+
+
+def ensure_partitions(conn, months_ahead=3, now=None):
+    """Create monthly partitions up to `months_ahead` months from now."""
+    first = month_start(now or datetime.utcnow())
+    created = []
+    for table in PARTITIONED_TABLES:
+        if not is_partitioned(conn, table):
+            continue
+        for i in range(months_ahead + 1):
+            start = add_months(first, i)
+            if create_partition(conn, table, start):
+                created.append(partition_name(table, start))
+    return created
+
+
+def create_with_partition_key(conn, index):
+    """Create unique `index` on a partitioned table, with `timestamp` appended."""
+    columns = ', '.join([c.name for c in index.columns] + ['timestamp'])
+    where = index.dialect_options['postgresql']['where']
+    conn.execute(text(f"CREATE UNIQUE INDEX {index.name} ON {index.table.name} ({columns})"
+                      + (f" WHERE {where}" if where is not None else "")))
+
+
+def convert_tables(conn, months_ahead=3, now=None):
+    """Rebuild `messages` and `likes` as partitioned tables, keeping all rows.
+
+    Runs inside the caller's transaction; the tables are locked meanwhile.
+    """
+    now = now or datetime.utcnow()
+    conn.execute(text(f"LOCK TABLE {', '.join(PARTITIONED_TABLES)} IN ACCESS EXCLUSIVE MODE"))
+    for table in PARTITIONED_TABLES:
+        old = f"{table}_unpartitioned"
+        conn.execute(text(f"ALTER TABLE {table} RENAME TO {old}"))
+        conn.execute(text(
+            f"CREATE TABLE {table} (LIKE {old} INCLUDING DEFAULTS INCLUDING CONSTRAINTS) "
+            f"PARTITION BY RANGE (timestamp)"))
+        conn.execute(text(f"CREATE TABLE {table}_default PARTITION OF {table} DEFAULT"))
+        oldest = conn.execute(text(f"SELECT min(timestamp) FROM {old}")).scalar() or now
+        start = month_start(oldest)
+        while start <= month_start(now):
+            create_partition(conn, table, start)
+            start = add_months(start, 1)
+        conn.execute(text(f"INSERT INTO {table} SELECT * FROM {old}"))
+        conn.execute(text(f"ALTER SEQUENCE {table}_id_seq OWNED BY {table}.id"))
+
+    # Drop the originals before re-adding keys and indexes, which reuse their names.
+    for table in reversed(PARTITIONED_TABLES):
+        conn.execute(text(f"DROP TABLE {table}_unpartitioned"))
+    for table in PARTITIONED_TABLES:
+        conn.execute(text(f"ALTER TABLE {table} ADD PRIMARY KEY (id, timestamp)"))
+        conn.execute(text(f"ALTER TABLE {table} ADD FOREIGN KEY (user_id) "
+                          f"REFERENCES users (id) ON DELETE CASCADE"))
+        for index in db.metadata.tables[table].indexes:
+            # Unique indexes must include the partition key to be allowed.
+            if index.unique and 'timestamp' not in index.columns:
+                create_with_partition_key(conn, index)
+            else:
+                index.create(conn)
+    ensure_partitions(conn, months_ahead, now)
+    forget_partitioned()
+
+
+##############################################################################
+# Archive
+
+def arrow_type(column):
+    if isinstance(column.type, Integer):
+        return pa.int64()
+    if isinstance(column.type, DateTime):
+        return pa.timestamp('us')
+    if isinstance(column.type, Boolean):
+        return pa.bool_()
+    return pa.string()
+
+
+def export_partition(conn, table, name, path):
+    """Write partition `name` of `table` to Parquet at `path`; return the row count."""
+    columns = db.metadata.tables[table].columns
+    schema = pa.schema([(c.name, arrow_type(c)) for c in columns])
+    select_list = ', '.join(f'"{c.name}"' for c in columns)
+    result = conn.execute(
+        text(f'SELECT {select_list} FROM {name} ORDER BY user_id, "timestamp"'),
+        execution_options={'stream_results': True})
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    count = 0
+    with pq.ParquetWriter(tmp, schema, compression='zstd') as writer:
+        for chunk in result.partitions(ARCHIVE_BATCH_ROWS):
+            writer.write_batch(pa.RecordBatch.from_pylist(
+                [dict(row._mapping) for row in chunk], schema=schema))
+            count += len(chunk)
+    os.replace(tmp, path)
+    return count
+
+
+def archive_partitions(conn, root, before):
+    """Export and drop every partition that ends on or before `before`."""
+    if pa is None:
+        raise RuntimeError("pyarrow is required to archive partitions.")
+    archived = []
+    for table in PARTITIONED_TABLES:
+        if not is_partitioned(conn, table):
+            continue
+        for name, start, end in list_partitions(conn, table):
+            if end > before:
+                continue
+            count = export_partition(conn, table, name,
+                                     os.path.join(root, table, f"{name}.parquet"))
+            conn.execute(text(f"ALTER TABLE {table} DETACH PARTITION {name}"))
+            conn.execute(text(f"DROP TABLE {name}"))
+            archived.append((name, count))
+    return archived
+
+
+##############################################################################
+# CLI
+
+def _postgres_engine():
+    if db.engine.dialect.name != 'postgresql':
+        raise click.ClickException("Partitioning requires PostgreSQL.")
+    return db.engine
+
+
+@partitions_cli.command('convert')
+@click.option('--months-ahead', default=3, help='Future months to create.')
+def convert_command(months_ahead):
+    """Convert messages and likes to monthly partitioned tables."""
+    engine = _postgres_engine()
+    with engine.begin() as conn:
+        if is_partitioned(conn, 'messages'):
+            raise click.ClickException("Tables are already partitioned.")
+        convert_tables(conn, months_ahead)
+    click.echo("Converted messages and likes to partitioned tables.")
+
+
+@partitions_cli.command('ensure')
+@click.option('--months-ahead', default=3, help='Future months to create.')
+def ensure_command(months_ahead):
+    """Create the partitions for the coming months."""
+    with _postgres_engine().begin() as conn:
+        created = ensure_partitions(conn, months_ahead)
+    click.echo(f"Created {len(created)} partition(s).")
+
+
+@partitions_cli.command('archive')
+@click.option('--months', default=None, type=int,
+              help='Archive partitions older than this many months.')
+def archive_command(months):
+    """Move cold partitions to Parquet files under ARCHIVE_ROOT."""
+    months = months if months is not None else current_app.config['ARCHIVE_AFTER_MONTHS']
+    before = add_months(month_start(datetime.utcnow()), -months)
+    with _postgres_engine().begin() as conn:
+        archived = archive_partitions(conn, current_app.config['ARCHIVE_ROOT'], before)
+    for name, count in archived:
+        click.echo(f"{name}: {count} rows archived")
+    click.echo(f"Archived {len(archived)} partition(s).")
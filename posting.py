@@ -0,0 +1,304 @@
+"""Writing new messages.
+
+Every post goes through `post_message()`, which inserts the message and then
+does everything a new message implies (precomputed timelines, the author's
+last_active_at, the event log, @mention notifications, the profile and
+recent-message caches, live timeline streams).
+
+Idempotency: a post may carry a client-supplied key (the message form's
+hidden field, or the API's Idempotency-Key header). Keys are unique per
+author (`ux_messages_user_id_idempotency_key`), the insert skips conflicts,
+and a repeated key returns the message the first request created instead of
+a duplicate. On tables converted by `flask partitions convert` the index
+also includes the timestamp, so it cannot see a repeat; there each key is
+locked for the transaction (a Postgres advisory lock) and looked up before
+the insert.
+
+Group commit: with POST_GROUP_COMMIT on, posts from concurrent requests are
+handed to a writer thread that collects them for up to
+POST_GROUP_COMMIT_WINDOW seconds (or POST_GROUP_COMMIT_MAX posts) and
+writes the whole batch with one multi-row INSERT and one commit, so a burst
+of N warbles costs one fsync instead of N. Each request waits for its
+batch, then answers as usual. If a batch fails before it commits, its posts
+are written again one at a time, so only the post that caused it fails.
+Off by default; see benchmarks/bench_posting.py.
+
+Once the commit has gone through, posts count as written: an error in what
+follows (the session's after-commit hooks, the recent-message cache, live
+streams) is logged rather than reported to the poster, who would otherwise
+retry a message that already exists.
+
+Databases created before idempotency keys existed are upgraded with:
+
+    flask posts migrate
+"""
+
+import logging
+import os
+import queue
+import threading
+import time
+from datetime import datetime
+
+import click
+from flask.cli import AppGroup
+from sqlalchemy import event, insert, inspect, select, text, tuple_, update
+from sqlalchemy.orm import Session
+
+from broker import broker
+from events import stage
+from models import db, User, Message, ACTIVE_RESOLUTION, insert_ignore
+from notifications import notify_mentions
+from partitions import create_with_partition_key, is_partitioned, partitioned
+from profiles import invalidate as invalidate_profiles
+from recent import recent_messages
+from timeline import fan_out
+
+IDEMPOTENCY_KEY_MAX = 64
+GROUP_COMMIT_WINDOW = 0.002
+GROUP_COMMIT_MAX = 200
+GROUP_COMMIT_TIMEOUT = 30
+
+messages = Message.__table__
+
+logger = logging.getLogger(__name__)
+
+posts_cli = AppGroup('posts', help='Maintain message idempotency keys.')
+
+
+class Post:
+    """One message to write, and once written its id and whether it is new."""
+
+    __slots__ = ('user_id', 'text', 'key', 'timestamp', 'id', 'created', 'error', 'done')
+
+    def __init__(self, user_id, text, key=None):
+        self.user_id = user_id
+        self.text = text
+        self.key = key or None
+        self.timestamp = datetime.utcnow()
+        self.id = None
+        self.created = False
+        self.error = None
+        self.done = None
+
+
+def insert_posts(posts):
+    """Insert `posts` in the current transaction, setting `id` and `created`.
+
+    A post whose key was already used by its author (earlier, or earlier in
+    this batch) gets that message's id, text and timestamp instead.
+    """
+    plain = [p for p in posts if p.key is None]
+    first = {}
+    for p in posts:
+        if p.key is not None:
+            first.setdefault((p.user_id, p.key), p)
+
+    if plain:
+        ids = db.session.execute(
+            insert(messages).returning(messages.c.id, sort_by_parameter_order=True),
+            [{'user_id': p.user_id, 'text': p.text, 'timestamp': p.timestamp}
+             for p in plain]).scalars().all()
+        for p, id in zip(plain, ids):
+            p.id, p.created = id, True
+
+    new = list(first.values())
+    if first and keys_need_lock():
+        taken = claim_keys(list(first))
+        new = [p for k, p in first.items() if k not in taken]
+    if new:
+        inserted = db.session.execute(
+            insert_ignore(messages).returning(messages.c.id, messages.c.user_id,
+                                              messages.c.idempotency_key),
+            [{'user_id': p.user_id, 'text': p.text, 'timestamp': p.timestamp,
+              'idempotency_key': p.key} for p in new]).all()
+        for id, user_id, key in inserted:
+            p = first[(user_id, key)]
+            p.id, p.created = id, True
+    if first:
+        existing = [k for k, p in first.items() if not p.created]
+        if existing:
+            rows = db.session.execute(
+                select(messages.c.user_id, messages.c.idempotency_key, messages.c.id,
+                       messages.c.text, messages.c.timestamp)
+                .where(tuple_(messages.c.user_id, messages.c.idempotency_key).in_(existing)))
+            for user_id, key, id, text, timestamp in rows:
+                p = first[(user_id, key)]
+                p.id, p.text, p.timestamp = id, text, timestamp
+        for p in posts:
+            original = first.get((p.user_id, p.key))
+            if original is not None and original is not p:
+                p.id, p.text, p.timestamp = original.id, original.text, original.timestamp
+
+
+def keys_need_lock():
+    """Whether the idempotency index cannot catch repeated keys (partitioned messages)."""
+    return partitioned(db.session.connection())
+
+
+def claim_keys(keys):
+    """Lock (user_id, key) pairs until the transaction ends; return those already used."""
+    db.session.execute(
+        text("SELECT pg_advisory_xact_lock(hashtext(k)) FROM unnest(:keys) AS k ORDER BY k"),
+        {'keys': sorted(f"{user_id}:{key}" for user_id, key in keys)})
+    return set(db.session.execute(
+        select(messages.c.user_id, messages.c.idempotency_key)
+        .where(tuple_(messages.c.user_id, messages.c.idempotency_key).in_(keys))).all())
+
+
+def write_batch(posts):
+    """Insert `posts`, commit once, then update caches and streams."""
+    insert_posts(posts)
+    created = [p for p in posts if p.created]
+    for p in created:
+        fan_out(p)
+        stage('message', message_id=p.id, user_id=p.user_id)
+    notify_mentions(created)
+    if created:
+        authors = {p.user_id for p in created}
+        invalidate_profiles(*authors)
+        now = max(p.timestamp for p in created)
+        db.session.execute(update(User)
+                           .where(User.id.in_(authors),
+                                  User.last_active_at < now - ACTIVE_RESOLUTION)
+                           .values(last_active_at=now),
+                           execution_options={'synchronize_session': False})
+    db.session.info['posts_committed'] = False
+    try:
+        db.session.commit()
+    except Exception:
+        if not db.session.info.pop('posts_committed', False):
+            db.session.rollback()
+            raise
+        # A hook raising leaves the committed transaction open; only close() ends it.
+        db.session.close()
+        logger.exception("Committed %d messages, but an after-commit hook failed", len(created))
+    db.session.info.pop('posts_committed', None)
+    try:
+        for p in created:
+            recent_messages.add(p.user_id, p.id, p.timestamp, p.text)
+            broker.publish(p.user_id, p.id)
+    except Exception:
+        logger.exception("Could not announce %d new messages", len(created))
+
+
+@event.listens_for(Session, 'after_commit', insert=True)
+def _mark_committed(session):
+    # Runs before the other after_commit hooks, so write_batch knows the
+    # commit went through even if one of them raises.
+    if 'posts_committed' in session.info:
+        session.info['posts_committed'] = True
+
+
+class GroupCommitWriter:
+    """Thread that writes posts from concurrent requests in shared transactions."""
+
+    def __init__(self, window=GROUP_COMMIT_WINDOW, max_batch=GROUP_COMMIT_MAX):
+        self.app = None
+        self.window = window
+        self.max_batch = max_batch
+        self.batches = 0
+        self.posts = 0
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+
+    @property
+    def enabled(self):
+        return self.app is not None
+
+    def submit(self, post):
+        """Queue `post` and wait until its batch is committed."""
+        self._ensure_started()
+        post.done = threading.Event()
+        self._queue.put(post)
+        if not post.done.wait(GROUP_COMMIT_TIMEOUT):
+            raise TimeoutError("Message was not written in time.")
+        if post.error is not None:
+            raise post.error
+
+    def _ensure_started(self):
+        with self._lock:
+            if self._thread is None or self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._queue = queue.Queue()
+                self._thread = threading.Thread(target=self._run, name='group-commit',
+                                                daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        with self.app.app_context():
+            while True:
+                batch = [self._queue.get()]
+                deadline = time.monotonic() + self.window
+                while len(batch) < self.max_batch:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    try:
+                        batch.append(self._queue.get(timeout=remaining))
+                    except queue.Empty:
+                        break
+                self._write(batch)
+
+    def _write(self, batch):
+        try:
+            self._attempt(batch)
+        finally:
+            for post in batch:
+                post.done.set()
+
+    def _attempt(self, batch):
+        saved = [(post.text, post.timestamp) for post in batch]
+        try:
+            write_batch(batch)
+        except Exception as err:
+            db.session.rollback()
+            for post, (text, timestamp) in zip(batch, saved):
+                post.text, post.timestamp, post.id, post.created = text, timestamp, None, False
+            if len(batch) == 1:
+                batch[0].error = err
+                return
+            logger.exception("Could not write a batch of %d posts; retrying one at a time",
+                             len(batch))
+            for post in batch:
+                self._attempt([post])
+            return
+        self.batches += 1
+        self.posts += len(batch)
+
+
+group_writer = GroupCommitWriter()
+
+
+def post_message(user_id, text, key=None):
+    """Write a message by `user_id`; return its Post (`created` is False for a repeated key)."""
+    post = Post(user_id, text, key)
+    if group_writer.enabled:
+        group_writer.submit(post)
+    else:
+        write_batch([post])
+    return post
+
+
+@posts_cli.command('migrate')
+def migrate_command():
+    """Add messages.idempotency_key and its unique index on an existing database."""
+    engine = db.engine
+    inspector = inspect(engine)
+    columns = {c['name'] for c in inspector.get_columns('messages')}
+    indexes = {i['name'] for i in inspector.get_indexes('messages')}
+    with engine.begin() as conn:
+        if 'idempotency_key' not in columns:
+            conn.execute(text(f"ALTER TABLE messages ADD COLUMN idempotency_key "
+                              f"VARCHAR({IDEMPOTENCY_KEY_MAX})"))
+        for index in messages.indexes:
+            if index.name != 'ux_messages_user_id_idempotency_key' or index.name in indexes:
+                continue
+            if engine.dialect.name == 'postgresql' and is_partitioned(conn, 'messages'):
+                create_with_partition_key(conn, index)
+            else:
+                index.create(conn)
+    click.echo("messages.idempotency_key is in place.")
+
@@ -0,0 +1,165 @@
+"""Warming the per-process caches before gunicorn forks its workers.
+
+gunicorn.conf.py turns on preload_app, so the app is imported once in the
+master, and calls `preload(app)` there before any worker starts:
+
+    templates        every template, compiled into the Jinja cache
+    profile_cache    the first profile page of the PRELOAD_AUTHORS most
+                     followed users
+    recent_messages  the same authors' newest messages, for their profiles
+                     and the merge timeline plan
+    username_ids     their usernames
+
+Workers inherit these through fork() and share the memory pages until
+something writes to them. The caches already hold compact tuples and
+slotted objects, never ORM instances, so there is little to copy. Two
+things keep the pages shared. `prepare_fork()` closes the master's database
+connections, so no worker inherits a socket. It also calls `gc.freeze()`, so
+that collections in the workers skip everything loaded so far; the garbage
+collector writes to the header of every object it visits, which would copy
+each page it touched. gunicorn.conf.py keeps collection off in the master
+until then, so freed objects do not leave holes that later allocations fill.
+
+Cached entries still expire (PROFILE_CACHE_TTL, RECENT_TTL), after which
+each worker refreshes its own copy; the preload only saves the cold start.
+With WEB_PRELOAD=0 every worker warms its own caches after it boots.
+
+`memory_report()` reads a process's RSS, PSS (RSS with each shared page
+split among the processes sharing it) and private memory from /proc.
+gunicorn logs it for each worker every WEB_MEMORY_REPORT_REQUESTS requests,
+and
+
+    flask preload memory <gunicorn master pid>
+
+prints it for the master and each of its workers.
+"""
+
+import gc
+import os
+import time
+
+import click
+from flask import current_app
+from flask.cli import AppGroup
+from sqlalchemy import func, select
+
+from models import db, User, followers_following
+from profiles import profile_cache, profile_key, profile_payload
+from recent import recent_messages
+from timeline import cached_streams
+from usernames import username_ids
+
+PRELOAD_AUTHORS = 200
+
+# smaps_rollup fields (in kB) behind each figure of `memory_report`.
+MEMORY_FIELDS = {
+    'rss': ('Rss',),
+    'pss': ('Pss',),
+    'shared': ('Shared_Clean', 'Shared_Dirty'),
+    'private': ('Private_Clean', 'Private_Dirty'),
+}
+
+preload_cli = AppGroup('preload', help='Warm caches and inspect worker memory.')
+
+
+def hot_authors(limit=PRELOAD_AUTHORS):
+    """[(user_id, username)] of the `limit` most followed users."""
+    ff = followers_following.c
+    followers = (select(ff.following_id, func.count().label('followers'))
+                 .group_by(ff.following_id)
+                 .order_by(func.count().desc())
+                 .limit(limit)
+                 .subquery())
+    return db.session.execute(
+        select(User.id, User.username)
+        .join(followers, followers.c.following_id == User.id)
+        .order_by(followers.c.followers.desc())).all()
+
+
+def preload(app, authors=None):
+    """Fill this process's caches; return what was loaded."""
+    started = time.perf_counter()
+    authors = app.config['PRELOAD_AUTHORS'] if authors is None else authors
+    for name in app.jinja_env.list_templates():
+        app.jinja_env.get_template(name)
+    hot = hot_authors(authors) if authors else []
+    ids = [user_id for user_id, _ in hot]
+    if profile_cache.enabled:
+        for user_id in ids:
+            profile_cache.get(profile_key(user_id), lambda: profile_payload(user_id))
+    if recent_messages.enabled and ids:
+        cached_streams(ids, 1)
+    username_ids.resolve([username for _, username in hot])
+    return {'templates': len(app.jinja_env.cache or ()), 'authors': len(ids),
+            'recent_bytes': recent_messages.stats()['bytes'],
+            'seconds': round(time.perf_counter() - started, 3)}
+
+
+def prepare_fork():
+    """Make what this process has loaded safe and cheap to share with children."""
+    db.session.remove()
+    db.engine.dispose()
+    gc.freeze()
+
+
+def memory_report(pid='self'):
+    """{'rss', 'pss', 'shared', 'private'} of process `pid` in bytes, or {}.
+
+    Needs Linux's /proc/<pid>/smaps_rollup; returns {} without it.
+    """
+    try:
+        with open(f"/proc/{pid}/smaps_rollup") as f:
+            kb = {}
+            for line in f:
+                name, _, rest = line.partition(':')
+                parts = rest.split()
+                if len(parts) == 2 and parts[1] == 'kB':
+                    kb[name] = int(parts[0])
+    except (FileNotFoundError, PermissionError):
+        return {}
+    return {figure: sum(kb.get(name, 0) for name in names) * 1024
+            for figure, names in MEMORY_FIELDS.items()}
+
+
+def format_memory(report):
+    if not report:
+        return "memory figures unavailable"
+    return '  '.join(f"{figure} {report[figure] / 2**20:.1f} MiB" for figure in MEMORY_FIELDS)
+
+
+def child_pids(pid):
+    """Pids of the processes whose parent is `pid`, from /proc."""
+    children = []
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as f:
+                # The command name may contain spaces; fields after it do not.
+                fields = f.read().rsplit(')', 1)[1].split()
+        except (FileNotFoundError, ProcessLookupError):
+            continue
+        if int(fields[1]) == pid:
+            children.append(int(entry))
+    return sorted(children)
+
+
+@preload_cli.command('run')
+@click.option('--authors', default=None, type=int,
+              help='Most followed users to warm (default: PRELOAD_AUTHORS).')
+def run_command(authors):
+    """Warm the caches in this process and show what it cost."""
+    before = memory_report()
+    loaded = preload(current_app, authors)
+    click.echo(', '.join(f"{name} {value}" for name, value in loaded.items()))
+    click.echo(f"before: {format_memory(before)}")
+    click.echo(f"after:  {format_memory(memory_report())}")
+
+
+@preload_cli.command('memory')
+@click.argument('master', type=int)
+def memory_command(master):
+    """Memory of a gunicorn master and each of its workers."""
+    click.echo(f"master {master}: {format_memory(memory_report(master))}")
+    for pid in child_pids(master):
+        click.echo(f"worker {pid}: {format_memory(memory_report(pid))}")
@@ -0,0 +1,259 @@
+"""Data for the user profile page.
+
+Loads exactly what users/show.html renders, in two queries however long the
+page is:
+
+    counters   messages, following and followers of the profile user, and
+               whether the viewer follows them
+    messages   one page of the user's messages, newest first, each with its
+               like count and whether the viewer liked it; when the user's
+               newest messages are in `recent_messages`, only the like
+               counts, by message id
+
+The profile user and the viewer (g.user) are already loaded by the route.
+
+The first page is what popular profiles get hit for, so `cached_profile`
+serves it from `profile_cache` instead: the user's header fields, counters
+and messages are cached per user (without anything viewer-specific), and the
+viewer's follow and like state is added by one small query. Entries are
+dropped after the commit of anything that changes them (`invalidate`); like
+counts are left to expire with PROFILE_CACHE_TTL so a popular message does
+not keep flushing its author's profile.
+"""
+
+from datetime import datetime
+
+from flask import abort
+from sqlalchemy import event, exists, func, literal, select, union_all
+from sqlalchemy.orm import Session, aliased
+
+from cache import ReadThroughCache
+from models import db, User, Message, Like, followers_following
+from readmodels import Author, MessageCard, message_card_select, message_cards
+from recent import recent_messages
+
+PROFILE_PAGE_SIZE = 20
+
+
+def live_message_count(user_id):
+    """Scalar subquery counting `user_id`'s messages that are not deleted."""
+    return (select(func.count(Message.id))
+            .where(Message.user_id == user_id, Message.deleted_at.is_(None))
+            .scalar_subquery())
+
+
+def live_liked_count(user_id):
+    """Scalar subquery counting the messages `user_id` liked that are not deleted."""
+    return (select(func.count(Like.id))
+            .join(Message, Message.id == Like.message_id)
+            .where(Like.user_id == user_id, Message.deleted_at.is_(None))
+            .scalar_subquery())
+
+
+def home_counters(user_id):
+    """(messages, liked messages) for the home page's sidebar."""
+    stmt = select(live_message_count(user_id), live_liked_count(user_id))
+    return tuple(db.session.execute(stmt).one())
+
+
+def counters(user_id, viewer_id=None):
+    """(messages, following, followers, viewer_follows) for `user_id`."""
+    ff = followers_following.c
+    if viewer_id is None:
+        viewer_follows = literal(False)
+    else:
+        viewer_follows = exists().where(ff.follower_id == viewer_id,
+                                        ff.following_id == user_id)
+    stmt = select(
+        live_message_count(user_id),
+        select(func.count()).select_from(followers_following)
+        .where(ff.follower_id == user_id).scalar_subquery(),
+        select(func.count()).select_from(followers_following)
+        .where(ff.following_id == user_id).scalar_subquery(),
+        viewer_follows,
+    )
+    return tuple(db.session.execute(stmt).one())
+
+
+def like_columns(viewer_id=None):
+    """(like_count, liked) columns for each Message row."""
+    likes = aliased(Like)
+    like_count = (select(func.count(likes.id))
+                  .where(likes.message_id == Message.id)
+                  .scalar_subquery())
+    if viewer_id is None:
+        liked = literal(False)
+    else:
+        liked = exists().where(Like.message_id == Message.id, Like.user_id == viewer_id)
+    return like_count.label('like_count'), liked.label('liked')
+
+
+def cached_messages_page(user, viewer_id, page, per_page):
+    """`messages_page` from the user's `recent_messages` buffer, or None if not cached.
+
+    Only the like counts come from the database, looked up by id. Messages
+    deleted in another worker since the buffer was loaded are left out.
+    """
+    start = (page - 1) * per_page
+    items = recent_messages.get(user.id, start + per_page + 1)
+    if items is None:
+        return None
+    items = items[start:]
+    rows = db.session.execute(
+        select(Message.id, *like_columns(viewer_id))
+        .where(Message.id.in_([msg_id for msg_id, _, _ in items]),
+               Message.deleted_at.is_(None))).all()
+    likes = {row.id: (row.like_count, row.liked) for row in rows}
+    author = Author(user.id, user.username, user.image_url)
+    page_rows = [(MessageCard(msg_id, text, timestamp, user.id, author), *likes[msg_id])
+                 for msg_id, timestamp, text in items if msg_id in likes]
+    return page_rows[:per_page], len(items) > per_page
+
+
+def messages_page(user, viewer_id=None, page=1, per_page=PROFILE_PAGE_SIZE):
+    """One page of `user`'s messages, newest first.
+
+    Returns (rows, has_next). Each row is (MessageCard, like_count, liked),
+    where `liked` says whether `viewer_id` liked the message. Pages within
+    the user's warm `recent_messages` buffer are served from it.
+    """
+    if recent_messages.enabled:
+        cached = cached_messages_page(user, viewer_id, page, per_page)
+        if cached is not None:
+            return cached
+    like_count, liked = like_columns(viewer_id)
+    stmt = (message_card_select(with_author=False)
+            .add_columns(like_count, liked)
+            .where(Message.user_id == user.id)
+            .order_by(Message.timestamp.desc(), Message.id.desc())
+            .offset((page - 1) * per_page)
+            .limit(per_page + 1))
+    rows = db.session.execute(stmt).all()
+    cards = message_cards(rows[:per_page], author=user)
+    return ([(card, row.like_count, row.liked) for card, row in zip(cards, rows)],
+            len(rows) > per_page)
+
+
+def load_profile(user, viewer=None, page=1, per_page=PROFILE_PAGE_SIZE):
+    """Template context for users/show.html."""
+    viewer_id = viewer.id if viewer else None
+    message_count, following_count, followers_count, viewer_follows = counters(user.id, viewer_id)
+    messages, has_next = messages_page(user, viewer_id, page, per_page)
+    return {
+        'user': user,
+        'is_own_profile': viewer_id == user.id,
+        'message_count': message_count,
+        'following_count': following_count,
+        'followers_count': followers_count,
+        'viewer_follows': viewer_follows,
+        'messages': messages,
+        'page': page,
+        'has_next': has_next,
+    }
+
+
+##############################################################################
+# Cached first page
+
+USER_FIELDS = ('id', 'username', 'image_url', 'header_image_url', 'bio', 'location')
+
+profile_cache = ReadThroughCache()
+
+
+class ProfileUser:
+    """Header fields of a cached profile, shaped like the User the templates expect."""
+
+    __slots__ = USER_FIELDS
+
+    def __init__(self, fields):
+        for name in USER_FIELDS:
+            setattr(self, name, fields[name])
+
+
+class ProfileMessage:
+    __slots__ = ('id', 'text', 'timestamp', 'user')
+
+    def __init__(self, id, text, timestamp, user):
+        self.id = id
+        self.text = text
+        self.timestamp = datetime.fromisoformat(timestamp)
+        self.user = user
+
+
+def profile_key(user_id):
+    return f"profile:{user_id}"
+
+
+def profile_payload(user_id):
+    """The viewer-independent first page of `user_id`'s profile, JSON-ready."""
+    user = db.session.get(User, user_id)
+    if user is None:
+        abort(404)
+    message_count, following_count, followers_count, _ = counters(user_id)
+    rows, has_next = messages_page(user)
+    return {
+        'user': {name: getattr(user, name) for name in USER_FIELDS},
+        'counts': [message_count, following_count, followers_count],
+        'messages': [[m.id, m.text, m.timestamp.isoformat(), like_count]
+                     for m, like_count, _ in rows],
+        'has_next': has_next,
+    }
+
+
+def viewer_state(viewer_id, user_id, message_ids):
+    """(viewer follows user_id, ids in message_ids the viewer liked), one query."""
+    ff = followers_following.c
+    stmt = union_all(
+        select(literal('follow'), literal(None))
+        .where(exists().where(ff.follower_id == viewer_id, ff.following_id == user_id)),
+        select(literal('like'), Like.message_id)
+        .where(Like.user_id == viewer_id, Like.message_id.in_(message_ids)),
+    )
+    follows, liked = False, set()
+    for kind, message_id in db.session.execute(stmt):
+        if kind == 'follow':
+            follows = True
+        else:
+            liked.add(message_id)
+    return follows, liked
+
+
+def cached_profile(user_id, viewer=None):
+    """Template context for the first page of users/show.html, from the cache."""
+    payload = profile_cache.get(profile_key(user_id), lambda: profile_payload(user_id))
+    user = ProfileUser(payload['user'])
+    message_count, following_count, followers_count = payload['counts']
+    viewer_id = viewer.id if viewer else None
+    viewer_follows, liked = False, set()
+    if viewer_id is not None and viewer_id != user_id:
+        viewer_follows, liked = viewer_state(viewer_id, user_id,
+                                             [m[0] for m in payload['messages']])
+    return {
+        'user': user,
+        'is_own_profile': viewer_id == user_id,
+        'message_count': message_count,
+        'following_count': following_count,
+        'followers_count': followers_count,
+        'viewer_follows': viewer_follows,
+        'messages': [(ProfileMessage(id, text, ts, user), like_count, id in liked)
+                     for id, text, ts, like_count in payload['messages']],
+        'page': 1,
+        'has_next': payload['has_next'],
+    }
+
+
+def invalidate(*user_ids):
+    """Drop the cached profiles of `user_ids` once the current transaction commits."""
+    if profile_cache.enabled:
+        db.session.info.setdefault('stale_profiles', set()).update(user_ids)
+
+
+@event.listens_for(Session, 'after_commit')
+def _drop_stale(session):
+    for user_id in session.info.pop('stale_profiles', ()):
+        profile_cache.delete(profile_key(user_id))
+
+
+@event.listens_for(Session, 'after_rollback')
+def _keep_fresh(session):
+    session.info.pop('stale_profiles', None)
@@ -0,0 +1,185 @@
+"""Sampled per-request CPU profiling.
+
+Off unless PROFILE_SAMPLE_RATE is above 0, in which case that fraction of
+requests is profiled and the results are aggregated per endpoint into
+PROFILE_DIR:
+
+    PROFILE_MODE=sample    A background thread records the stack of each
+                           profiled request every PROFILE_INTERVAL seconds.
+                           Writes <endpoint>.<pid>.folded in the collapsed
+                           format flamegraph.pl, speedscope and inferno read.
+    PROFILE_MODE=cprofile  Deterministic cProfile of the request. Writes
+                           <endpoint>.<pid>.prof (pstats; snakeviz, flameprof).
+
+    PROFILE_SAMPLE_RATE=0.01 gunicorn app:app
+    flamegraph.pl profiles/users_show.*.folded > users_show.svg
+
+Results accumulate in memory and the files of endpoints with new samples
+are rewritten at most every PROFILE_FLUSH_INTERVAL seconds, and once more
+when the process exits.
+
+When disabled no hooks are installed, so requests pay nothing.
+"""
+
+import atexit
+import cProfile
+import os
+import pstats
+import random
+import sys
+import threading
+import time
+from collections import Counter
+
+from flask import g, request
+
+
+def frame_name(code):
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+def collapse(frame):
+    """The stack ending at `frame`, outermost first, in collapsed format."""
+    names = []
+    while frame is not None:
+        names.append(frame_name(frame.f_code).replace(';', ':'))
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+
+class Sampler:
+    """Thread that samples the stacks of the threads registered with it.
+
+    Started on first use in each process, so it survives gunicorn's fork.
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self._active = {}
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+
+    def start(self):
+        """Start sampling the calling thread."""
+        self._ensure_started()
+        with self._lock:
+            self._active[threading.get_ident()] = Counter()
+
+    def stop(self):
+        """Stop sampling the calling thread; return its stack counts."""
+        with self._lock:
+            return self._active.pop(threading.get_ident(), Counter())
+
+    def _ensure_started(self):
+        with self._lock:
+            if self._thread is None or self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._active = {}
+                self._thread = threading.Thread(target=self._run, name='profile-sampler',
+                                                daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            with self._lock:
+                if not self._active:
+                    continue
+                frames = sys._current_frames()
+                for ident, counts in self._active.items():
+                    frame = frames.get(ident)
+                    if frame is not None:
+                        counts[collapse(frame)] += 1
+
+
+class Profiler:
+    """Profile a sample of an app's requests and aggregate them per endpoint."""
+
+    def __init__(self, directory, rate, mode='sample', interval=0.005, flush_interval=10):
+        if mode not in ('sample', 'cprofile'):
+            raise ValueError(f"Unknown PROFILE_MODE: {mode}")
+        self.directory = directory
+        self.rate = rate
+        self.mode = mode
+        self.sampler = Sampler(interval) if mode == 'sample' else None
+        self.flush_interval = flush_interval
+        self.stacks = {}
+        self.stats = {}
+        self._dirty = set()
+        self._flushed = time.monotonic()
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        # Run before every other hook, so rate limiting and g.user are included.
+        app.before_request_funcs.setdefault(None, []).insert(0, self.start)
+        app.teardown_request(self.finish)
+        atexit.register(self.flush)
+
+    def start(self):
+        if random.random() >= self.rate:
+            return
+        if self.sampler is not None:
+            self.sampler.start()
+            g.profile = True
+        else:
+            g.profile = cProfile.Profile()
+            g.profile.enable()
+
+    def finish(self, exc=None):
+        profile = g.pop('profile', None)
+        if profile is None:
+            return
+        endpoint = request.endpoint or 'unmatched'
+        if self.sampler is not None:
+            counts = self.sampler.stop()
+            with self._lock:
+                self.stacks.setdefault(endpoint, Counter()).update(counts)
+                self._dirty.add(endpoint)
+        else:
+            profile.disable()
+            with self._lock:
+                if endpoint in self.stats:
+                    self.stats[endpoint].add(profile)
+                else:
+                    self.stats[endpoint] = pstats.Stats(profile)
+                self._dirty.add(endpoint)
+        if time.monotonic() - self._flushed >= self.flush_interval:
+            self.flush()
+
+    def path(self, endpoint, ext):
+        return os.path.join(self.directory, f"{endpoint}.{os.getpid()}.{ext}")
+
+    def flush(self):
+        """Write the files of endpoints profiled since the last flush."""
+        with self._lock:
+            self._flushed = time.monotonic()
+            dirty, self._dirty = self._dirty, set()
+            if not dirty:
+                return
+            os.makedirs(self.directory, exist_ok=True)
+            for endpoint in dirty:
+                if self.sampler is not None:
+                    totals = self.stacks[endpoint]
+                    lines = ''.join(f"{stack} {n}\n" for stack, n in totals.most_common())
+                    self._write(self.path(endpoint, 'folded'), lines.encode())
+                else:
+                    self.stats[endpoint].dump_stats(self.path(endpoint, 'prof'))
+
+    def _write(self, path, data):
+        tmp = f"{path}.tmp"
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, path)
+
+
+def init_profiling(app):
+    """Install a Profiler on `app` if PROFILE_SAMPLE_RATE is above 0."""
+    rate = app.config['PROFILE_SAMPLE_RATE']
+    if rate <= 0:
+        return None
+    profiler = Profiler(app.config['PROFILE_DIR'], rate, app.config['PROFILE_MODE'],
+                        app.config['PROFILE_INTERVAL'],
+                        app.config['PROFILE_FLUSH_INTERVAL'])
+    profiler.init_app(app)
+    return profiler
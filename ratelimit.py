@@ -0,0 +1,174 @@
+"""Token-bucket rate limiting for write-heavy and expensive routes.
+
+Policies are configured per endpoint (see DEFAULT_POLICIES, overridable with
+app.config['RATE_LIMITS']) and keyed either by the logged-in user id or by
+client IP. A check is a single dict lookup and some arithmetic, and it runs
+in `add_user_to_g` before the user is loaded, so a throttled request never
+touches the database or bcrypt. IP policies are checked before the session is
+even read. A request only uses up tokens when every policy allows it.
+
+`MemoryBackend` keeps buckets per worker process. `RedisBackend` keeps them in
+a shared store so limits hold across workers; it only needs a redis-py style
+client with `register_script()`.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+
+class Policy:
+    """Allow `limit` requests per `period` seconds for one key scope.
+
+    `scope` is 'user' or 'ip'. `burst` defaults to `limit`. When `methods` is
+    given, only those HTTP methods are counted (e.g. POST for form routes).
+    """
+
+    def __init__(self, limit, period, scope='user', methods=None, burst=None):
+        if scope not in ('user', 'ip'):
+            raise ValueError(f"Unknown rate limit scope: {scope}")
+        self.rate = limit / period
+        self.burst = burst or limit
+        self.scope = scope
+        self.methods = frozenset(methods) if methods else None
+
+    def applies_to(self, method):
+        return self.methods is None or method in self.methods
+
+
+DEFAULT_POLICIES = {
+    'login': [Policy(10, 60, 'ip', methods=('POST',))],
+    'signup': [Policy(5, 60, 'ip', methods=('POST',))],
+    'like': [Policy(60, 60, 'user'), Policy(120, 60, 'ip')],
+    'unlike': [Policy(60, 60, 'user'), Policy(120, 60, 'ip')],
+    'add_follow': [Policy(30, 60, 'user'), Policy(60, 60, 'ip')],
+    'messages_add': [Policy(20, 60, 'user', methods=('POST',)),
+                     Policy(40, 60, 'ip', methods=('POST',))],
+    'import_follows': [Policy(5, 60, 'user', methods=('POST',))],
+    'api.bulk_follow': [Policy(10, 60, 'user'), Policy(20, 60, 'ip')],
+    'api.bulk_unfollow': [Policy(10, 60, 'user'), Policy(20, 60, 'ip')],
+    'api.create_message': [Policy(20, 60, 'user'), Policy(40, 60, 'ip')],
+    'api.like_message': [Policy(60, 60, 'user'), Policy(120, 60, 'ip')],
+    'api.unlike_message': [Policy(60, 60, 'user'), Policy(120, 60, 'ip')],
+}
+
+
+class MemoryBackend:
+    """Per-process buckets, least recently used evicted past `max_keys`."""
+
+    def __init__(self, max_keys=100_000):
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, key, rate, burst, now):
+        """Take one token from `key`; return (allowed, tokens_left)."""
+        with self._lock:
+            state = self._buckets.get(key)
+            if state is None:
+                tokens = burst
+                if len(self._buckets) >= self.max_keys:
+                    self._buckets.popitem(last=False)
+            else:
+                tokens = min(burst, state[0] + (now - state[1]) * rate)
+                self._buckets.move_to_end(key)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            self._buckets[key] = (tokens, now)
+            return allowed, tokens
+
+    def refund(self, key, burst):
+        """Give back a token taken from `key`."""
+        with self._lock:
+            state = self._buckets.get(key)
+            if state is not None:
+                self._buckets[key] = (min(burst, state[0] + 1), state[1])
+
+    def clear(self):
+        with self._lock:
+            self._buckets.clear()
+
+
+TAKE_SCRIPT = """
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local tokens = tonumber(state[1]) or burst
+local ts = tonumber(state[2]) or now
+tokens = math.min(burst, tokens + (now - ts) * rate)
+local allowed = 0
+if tokens >= 1 then
+  tokens = tokens - 1
+  allowed = 1
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+return {allowed, tostring(tokens)}
+"""
+
+REFUND_SCRIPT = """
+local tokens = tonumber(redis.call('HGET', KEYS[1], 'tokens'))
+if tokens then
+  redis.call('HSET', KEYS[1], 'tokens', tostring(math.min(tonumber(ARGV[1]), tokens + 1)))
+end
+"""
+
+
+class RedisBackend:
+    """Buckets shared by all workers, updated atomically by a Lua script."""
+
+    def __init__(self, client, prefix='warbler:rl:'):
+        self.prefix = prefix
+        self._take = client.register_script(TAKE_SCRIPT)
+        self._refund = client.register_script(REFUND_SCRIPT)
+
+    def take(self, key, rate, burst, now):
+        allowed, tokens = self._take(keys=[self.prefix + key], args=[rate, burst, now])
+        return bool(allowed), float(tokens)
+
+    def refund(self, key, burst):
+        self._refund(keys=[self.prefix + key], args=[burst])
+
+
+class RateLimiter:
+    """Check requests against the configured per-endpoint policies."""
+
+    def __init__(self, policies=None, backend=None):
+        self.policies = dict(DEFAULT_POLICIES if policies is None else policies)
+        self.backend = backend or MemoryBackend()
+
+    def check(self, endpoint, method, user_id, ip):
+        """Consume a token from each of the policies for this request.
+
+        Returns None if allowed, else the number of seconds to wait; a
+        rejected request gives back the tokens it took. `user_id` may be a
+        callable, which is only called once the IP policies have passed.
+        """
+        policies = self.policies.get(endpoint)
+        if not policies:
+            return None
+
+        now = time.time()
+        taken = []
+        ordered = sorted(enumerate(policies), key=lambda item: item[1].scope != 'ip')
+        for index, policy in ordered:
+            if not policy.applies_to(method):
+                continue
+            if policy.scope == 'user' and callable(user_id):
+                user_id = user_id()
+            ident = user_id if policy.scope == 'user' else ip
+            if ident is None:
+                continue
+            key = f"{endpoint}:{index}:{policy.scope}:{ident}"
+            allowed, tokens = self.backend.take(key, policy.rate, policy.burst, now)
+            if not allowed:
+                for taken_key, burst in taken:
+                    self.backend.refund(taken_key, burst)
+                return max(1, int((1 - tokens) / policy.rate + 0.999))
+            taken.append((key, policy.burst))
+        return None
+
+
+limiter = RateLimiter()
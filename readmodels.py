@@ -0,0 +1,81 @@
+"""Read models for pages that list messages.
+
+The home timeline and profile pages show each message's id, text and
+timestamp and its author's id, username and image. Loaded as `Message` and
+`User` instances, every row also gets instance state, an identity-map entry,
+attribute instrumentation and all the other columns (bio, header image,
+password hash ...), and `msg.user` goes back through the session. These
+slotted classes are built from Core `select()` rows of just the displayed
+columns instead, and each author is built once per page however many of
+their messages it shows:
+
+    rows = db.session.execute(message_card_select().where(...)).all()
+    cards = message_cards(rows)
+    cards[0].user.username
+
+Cards are read-only snapshots: nothing tracks them and they cannot lazy-load.
+benchmarks/bench_readmodels.py compares them with the ORM on 100-message
+pages.
+"""
+
+from sqlalchemy import select
+
+from models import Message, User
+
+MESSAGE_CARD_COLUMNS = (Message.id, Message.text, Message.timestamp, Message.user_id)
+AUTHOR_COLUMNS = (User.username, User.image_url)
+
+
+class Author:
+    """The fields of a message's author that message lists show."""
+
+    __slots__ = ('id', 'username', 'image_url')
+
+    def __init__(self, id, username, image_url):
+        self.id = id
+        self.username = username
+        self.image_url = image_url
+
+
+class MessageCard:
+    """A message as message lists show it, shaped like `Message` for the templates."""
+
+    __slots__ = ('id', 'text', 'timestamp', 'user_id', 'user')
+
+    def __init__(self, id, text, timestamp, user_id, user):
+        self.id = id
+        self.text = text
+        self.timestamp = timestamp
+        self.user_id = user_id
+        self.user = user
+
+
+def message_card_select(with_author=True):
+    """Core select of the columns `message_cards` needs, with live messages only.
+
+    Without `with_author` the users join is left out; pass the author to
+    `message_cards` instead.
+    """
+    columns = MESSAGE_CARD_COLUMNS + (AUTHOR_COLUMNS if with_author else ())
+    stmt = select(*columns).select_from(Message)
+    if with_author:
+        stmt = stmt.join(User, User.id == Message.user_id)
+    return stmt.where(Message.deleted_at.is_(None))
+
+
+def message_cards(rows, author=None):
+    """MessageCards for rows of `message_card_select`, in order.
+
+    Extra columns in the rows are ignored. `author` (an object with id,
+    username and image_url) is used for every row when given.
+    """
+    authors = {}
+    if author is not None:
+        authors = {author.id: Author(author.id, author.username, author.image_url)}
+    cards = []
+    for row in rows:
+        user = authors.get(row.user_id)
+        if user is None:
+            user = authors[row.user_id] = Author(row.user_id, row.username, row.image_url)
+        cards.append(MessageCard(row.id, row.text, row.timestamp, row.user_id, user))
+    return cards
@@ -0,0 +1,190 @@
+"""Per-author cache of recent messages.
+
+Each cached author has a ring buffer (a bounded deque) of their newest
+messages as compact (id, timestamp, text) tuples, newest first. Buffers are
+filled from the database on a miss, updated in place when the author posts
+or deletes a message, and evicted least recently used first once the cache
+goes over its memory budget. The merge timeline plan reads it (and is only
+chosen once it is warm for most of the viewer's authors), and profile pages
+within an author's buffer are served from it.
+
+The cache is per process. Writes made in other workers are not seen, so a
+buffer is also reloaded after RECENT_TTL seconds.
+
+Hit and miss counts are kept per process (`stats()`) and per request (sent in
+the Server-Timing header).
+"""
+
+import sys
+import threading
+import time
+from collections import OrderedDict, deque
+from itertools import islice
+
+from flask import g, has_request_context
+
+# Messages kept per author: one full page (plus the has-more row) and then some.
+RECENT_SIZE = 128
+RECENT_MAX_BYTES = 32 * 1024 * 1024
+RECENT_TTL = 60
+
+# Tuple, id, timestamp and list slot overhead of one entry, on top of the text.
+ENTRY_OVERHEAD = 160
+
+
+class Buffer:
+    __slots__ = ('items', 'complete', 'loaded_at', 'nbytes')
+
+    def __init__(self, items, complete, loaded_at, size):
+        self.items = deque(items, maxlen=size)
+        # True when `items` holds every message the author has.
+        self.complete = complete
+        self.loaded_at = loaded_at
+        self.nbytes = sum(_entry_bytes(item) for item in self.items)
+
+
+def _entry_bytes(item):
+    return ENTRY_OVERHEAD + sys.getsizeof(item[2])
+
+
+class RecentMessages:
+    """Ring buffers of each author's newest messages, LRU across authors."""
+
+    def __init__(self, size=RECENT_SIZE, max_bytes=RECENT_MAX_BYTES, ttl=RECENT_TTL):
+        self.size = size
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._buffers = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+
+    def get(self, author_id, n, before=None):
+        """Newest `n` (id, timestamp, text) of `author_id` before `before`, or None.
+
+        `before` is a (timestamp, id) keyset bound. None means the buffer
+        cannot answer and the caller should read the database (and `load`).
+        """
+        return self.get_many([author_id], n, before)[author_id]
+
+    def get_many(self, author_ids, n, before=None):
+        """`get` for several authors at once: {author_id: items or None}."""
+        found = {}
+        expired_before = time.monotonic() - self.ttl
+        with self._lock:
+            for author_id in author_ids:
+                buf = self._buffers.get(author_id)
+                if buf is not None and buf.loaded_at < expired_before:
+                    self._drop(author_id)
+                    buf = None
+                items = None
+                if buf is not None:
+                    self._buffers.move_to_end(author_id)
+                    if before is None:
+                        items = list(islice(buf.items, n))
+                    else:
+                        items = [item for item in buf.items if (item[1], item[0]) < before][:n]
+                    if len(items) < n and not buf.complete:
+                        items = None
+                found[author_id] = items
+            hits = sum(items is not None for items in found.values())
+            self.hits += hits
+            self.misses += len(found) - hits
+        if has_request_context():
+            seen_hits, seen = g.get('recent_lookups', (0, 0))
+            g.recent_lookups = (seen_hits + hits, seen + len(found))
+        return found
+
+    def warm_fraction(self, author_ids):
+        """Share of `author_ids` with an unexpired buffer; counts as no lookup."""
+        if not author_ids:
+            return 0.0
+        expired_before = time.monotonic() - self.ttl
+        with self._lock:
+            warm = sum(1 for author_id in author_ids
+                       if (buf := self._buffers.get(author_id)) is not None
+                       and buf.loaded_at >= expired_before)
+        return warm / len(author_ids)
+
+    def load(self, author_id, rows):
+        """Cache the newest messages of `author_id`, given newest first.
+
+        `rows` must be the author's newest `size` messages (fewer means
+        those are all they have).
+        """
+        rows = [tuple(row) for row in rows[:self.size]]
+        buf = Buffer(rows, len(rows) < self.size, time.monotonic(), self.size)
+        with self._lock:
+            self._drop(author_id)
+            self._buffers[author_id] = buf
+            self._bytes += buf.nbytes
+            self._evict()
+
+    def add(self, author_id, msg_id, timestamp, text):
+        """Record a new message by `author_id` in their buffer, if cached."""
+        with self._lock:
+            buf = self._buffers.get(author_id)
+            if buf is None:
+                return
+            item = (msg_id, timestamp, text)
+            if len(buf.items) == buf.items.maxlen:
+                dropped = _entry_bytes(buf.items[-1])
+                buf.nbytes -= dropped
+                self._bytes -= dropped
+                buf.complete = False
+            buf.items.appendleft(item)
+            buf.nbytes += _entry_bytes(item)
+            self._bytes += _entry_bytes(item)
+            self._evict()
+
+    def remove(self, author_id, msg_id):
+        """Drop a deleted message from its author's buffer."""
+        with self._lock:
+            buf = self._buffers.get(author_id)
+            if buf is None:
+                return
+            for item in buf.items:
+                if item[0] == msg_id:
+                    buf.items.remove(item)
+                    buf.nbytes -= _entry_bytes(item)
+                    self._bytes -= _entry_bytes(item)
+                    break
+
+    def clear(self):
+        with self._lock:
+            self._buffers.clear()
+            self._bytes = 0
+            self.hits = self.misses = 0
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {'authors': len(self._buffers), 'bytes': self._bytes,
+                    'hits': self.hits, 'misses': self.misses,
+                    'hit_rate': self.hits / lookups if lookups else 0.0}
+
+    def _drop(self, author_id):
+        buf = self._buffers.pop(author_id, None)
+        if buf is not None:
+            self._bytes -= buf.nbytes
+
+    def _evict(self):
+        while self._bytes > self.max_bytes and self._buffers:
+            _, buf = self._buffers.popitem(last=False)
+            self._bytes -= buf.nbytes
+
+
+recent_messages = RecentMessages()
+
+
+def server_timing():
+    """Server-Timing header value for this request's cache lookups, or None."""
+    if 'recent_lookups' not in g:
+        return None
+    hits, lookups = g.recent_lookups
+    return f'recent-cache;desc="{hits}/{lookups} hits"'
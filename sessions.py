@@ -0,0 +1,241 @@
+"""Server-side session storage.
+
+Flask's default session is the whole dict, serialized and signed into the
+cookie, so every `flash()` re-signs and resends it. With a server-side store
+the cookie only carries a random session id, and:
+
+* the stored data is loaded lazily, on first access to `session`;
+* nothing is written unless the session was modified;
+* the cookie is only sent when a new id is issued, which includes any id
+  the store does not know (so a client cannot pick its own).
+
+Pick a store with SESSION_BACKEND:
+
+    cookie   Flask's signed cookie (default)
+    memory   per-process LRU; only for a single worker or development
+    sql      `sessions` table in the app database (SQLite or Postgres)
+"""
+
+import re
+import secrets
+import threading
+import time
+from collections import OrderedDict
+
+from flask.json.tag import TaggedJSONSerializer
+from flask.sessions import SessionInterface, SessionMixin
+from itsdangerous import BadSignature
+from sqlalchemy import select, delete
+
+from models import db
+
+serializer = TaggedJSONSerializer()
+
+SID_RE = re.compile(r'^[A-Za-z0-9_-]{43}$')
+
+session_table = db.Table(
+    'sessions',
+    db.Column('sid', db.String(43), primary_key=True),
+    db.Column('data', db.Text, nullable=False),
+    db.Column('expires_at', db.Float, nullable=False, index=True),
+)
+
+
+def new_sid():
+    return secrets.token_urlsafe(32)
+
+
+class MemoryStore:
+    """Sessions in a per-process dict, least recently used evicted first."""
+
+    def __init__(self, max_sessions=10_000):
+        self.max_sessions = max_sessions
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def load(self, sid):
+        with self._lock:
+            item = self._data.get(sid)
+            if item is None:
+                return None
+            if item[1] < time.time():
+                del self._data[sid]
+                return None
+            self._data.move_to_end(sid)
+            return serializer.loads(item[0])
+
+    def save(self, sid, data, expires_at):
+        blob = serializer.dumps(data)
+        with self._lock:
+            self._data[sid] = (blob, expires_at)
+            self._data.move_to_end(sid)
+            while len(self._data) > self.max_sessions:
+                self._data.popitem(last=False)
+
+    def delete(self, sid):
+        with self._lock:
+            self._data.pop(sid, None)
+
+
+class SQLStore:
+    """Sessions in the `sessions` table, on their own short transactions."""
+
+    def __init__(self, engine=None):
+        self._engine = engine
+
+    @property
+    def engine(self):
+        return self._engine or db.engine
+
+    def load(self, sid):
+        with self.engine.connect() as conn:
+            row = conn.execute(
+                select(session_table.c.data)
+                .where(session_table.c.sid == sid,
+                       session_table.c.expires_at >= time.time())).first()
+        return serializer.loads(row.data) if row else None
+
+    def save(self, sid, data, expires_at):
+        if self.engine.dialect.name == 'sqlite':
+            from sqlalchemy.dialects.sqlite import insert
+        else:
+            from sqlalchemy.dialects.postgresql import insert
+        values = {'sid': sid, 'data': serializer.dumps(data), 'expires_at': expires_at}
+        stmt = insert(session_table).values(**values)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[session_table.c.sid],
+            set_={'data': stmt.excluded.data, 'expires_at': stmt.excluded.expires_at})
+        with self.engine.begin() as conn:
+            conn.execute(stmt)
+
+    def delete(self, sid):
+        with self.engine.begin() as conn:
+            conn.execute(delete(session_table).where(session_table.c.sid == sid))
+
+    def purge_expired(self):
+        """Delete expired sessions; returns how many were removed."""
+        with self.engine.begin() as conn:
+            return conn.execute(delete(session_table)
+                                .where(session_table.c.expires_at < time.time())).rowcount
+
+
+class ServerSession(SessionMixin):
+    """Session dict that loads from the store on first access."""
+
+    def __init__(self, store, sid, new=False):
+        self.store = store
+        self.sid = sid
+        self.new = new
+        self.modified = False
+        self.accessed = False
+        self._data = {} if new else None
+
+    def _load(self):
+        self.accessed = True
+        if self._data is None:
+            self._data = self.store.load(self.sid)
+            if self._data is None:
+                # Unknown or expired id: never adopt an id the client picked.
+                self._data = {}
+                self.sid = new_sid()
+                self.new = True
+        return self._data
+
+    def __getitem__(self, key):
+        return self._load()[key]
+
+    def __setitem__(self, key, value):
+        self._load()[key] = value
+        self.modified = True
+
+    def __delitem__(self, key):
+        del self._load()[key]
+        self.modified = True
+
+    def __iter__(self):
+        return iter(self._load())
+
+    def __len__(self):
+        return len(self._load())
+
+    def __contains__(self, key):
+        return key in self._load()
+
+    def regenerate(self):
+        """Move the data to a fresh id (call on login against fixation)."""
+        data = dict(self._load())
+        if not self.new:
+            self.store.delete(self.sid)
+        self.sid = new_sid()
+        self.new = True
+        self._data = data
+        self.modified = True
+
+
+class ServerSessionInterface(SessionInterface):
+    """Keep session data in `store`; the cookie holds only the session id."""
+
+    def __init__(self, store):
+        self.store = store
+
+    def open_session(self, app, request):
+        sid = request.cookies.get(self.get_cookie_name(app))
+        if sid and SID_RE.match(sid):
+            return ServerSession(self.store, sid)
+        return ServerSession(self.store, new_sid(), new=True)
+
+    def save_session(self, app, session, response):
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+
+        if session.accessed:
+            response.vary.add('Cookie')
+        if not session.modified:
+            return
+
+        if not session:
+            if not session.new:
+                self.store.delete(session.sid)
+                response.delete_cookie(name, domain=domain, path=path,
+                                       secure=self.get_cookie_secure(app),
+                                       samesite=self.get_cookie_samesite(app))
+            return
+
+        lifetime = app.permanent_session_lifetime.total_seconds()
+        self.store.save(session.sid, dict(session), time.time() + lifetime)
+        if session.new or (session.permanent and app.config['SESSION_REFRESH_EACH_REQUEST']):
+            response.set_cookie(name, session.sid,
+                                expires=self.get_expiration_time(app, session),
+                                httponly=self.get_cookie_httponly(app),
+                                domain=domain, path=path,
+                                secure=self.get_cookie_secure(app),
+                                samesite=self.get_cookie_samesite(app))
+
+
+def session_data(app, cookie_value):
+    """Session dict for a raw cookie value, whichever interface is active.
+
+    For code outside Flask's request cycle (the ASGI fast path).
+    """
+    interface = app.session_interface
+    if isinstance(interface, ServerSessionInterface):
+        if not SID_RE.match(cookie_value):
+            return {}
+        return interface.store.load(cookie_value) or {}
+    signer = interface.get_signing_serializer(app)
+    try:
+        return signer.loads(cookie_value,
+                            max_age=int(app.permanent_session_lifetime.total_seconds()))
+    except BadSignature:
+        return {}
+
+
+def init_sessions(app, backend):
+    """Install the session store named by `backend` on `app`."""
+    if backend == 'memory':
+        app.session_interface = ServerSessionInterface(MemoryStore())
+    elif backend == 'sql':
+        app.session_interface = ServerSessionInterface(SQLStore())
+    elif backend != 'cookie':
+        raise ValueError(f"Unknown SESSION_BACKEND: {backend}")
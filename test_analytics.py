@@ -0,0 +1,131 @@
+"""Analytics export and report tests."""
+
+# run these tests like:
+#
+#    python -m pytest test_analytics.py
+
+
+import gzip
+import os
+import shutil
+import tempfile
+from datetime import datetime, timedelta
+from unittest import TestCase, skipIf
+
+import numpy as np
+
+from sqlalchemy import update
+
+from models import db, Like
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app
+from analytics import (EXPORT_LAG, daily_active_posters, export, export_files, like_distribution,
+                       load_watermarks, pa, read_columns, report)
+from factories import make_follows, make_likes, make_messages, make_users
+
+
+class AnalyticsTestCase(TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix='warbler-export-')
+        self.now = datetime.utcnow()
+        self.author, self.fan, self.lurker = make_users(3, prefix='ana')
+        make_follows([(self.fan, self.author), (self.lurker, self.author)])
+        self.msg_ids = make_messages([self.author, self.fan], per_user=3,
+                                     start=self.now - timedelta(hours=1), step=timedelta(days=1))
+        make_likes([(self.fan, self.msg_ids[0]), (self.lurker, self.msg_ids[0]),
+                    (self.lurker, self.msg_ids[1])])
+        db.session.execute(update(Like).values(timestamp=self.now - timedelta(hours=1)))
+        db.session.commit()
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_csv_export_is_incremental(self):
+        written = export(self.root, 'csv', now=self.now)
+        # Users wait until a run EXPORT_LAG later.
+        self.assertEqual(written, {'users': 0, 'messages': 6, 'likes': 3,
+                                   'followers_following': 2})
+        marks = load_watermarks(self.root)
+        self.assertEqual(marks['messages'], max(self.msg_ids))
+
+        # Nothing new, apart from a message too recent to export yet.
+        recent, = make_messages([self.fan], start=self.now - EXPORT_LAG / 2)
+        make_follows([(self.author, self.fan)])
+        db.session.commit()
+        written = export(self.root, 'csv', now=self.now)
+        self.assertEqual(written, {'users': 0, 'messages': 0, 'likes': 0,
+                                   'followers_following': 3})
+        self.assertEqual(len(export_files(self.root, 'messages')), 1)
+        self.assertEqual(len(export_files(self.root, 'followers_following')), 1)
+
+        written = export(self.root, 'csv', now=self.now + EXPORT_LAG)
+        self.assertEqual((written['users'], written['messages']), (3, 1))
+        with gzip.open(export_files(self.root, 'users')[0], 'rt') as f:
+            header = f.readline()
+        self.assertNotIn('password', header)
+        self.assertNotIn('email', header)
+        self.assertEqual(len(export_files(self.root, 'messages')), 2)
+        ids = read_columns(self.root, 'messages', ('id',))['id']
+        self.assertEqual(sorted(ids.tolist()), sorted(self.msg_ids + [recent]))
+
+    def test_rows_inside_lag_hold_back_higher_ids(self):
+        recent, = make_messages([self.fan], start=self.now - EXPORT_LAG / 2)
+        older, = make_messages([self.fan], start=self.now - timedelta(minutes=30))
+        db.session.commit()
+
+        self.assertEqual(export(self.root, 'csv', now=self.now)['messages'], 6)
+        self.assertEqual(load_watermarks(self.root)['messages'], max(self.msg_ids))
+
+        self.assertEqual(export(self.root, 'csv', now=self.now + EXPORT_LAG)['messages'], 2)
+        ids = read_columns(self.root, 'messages', ('id',))['id']
+        self.assertEqual(sorted(ids.tolist()), sorted(self.msg_ids + [recent, older]))
+
+    @skipIf(pa is None, "needs pyarrow")
+    def test_parquet_export(self):
+        export(self.root, 'parquet', now=self.now)
+        self.assertTrue(export_files(self.root, 'likes')[0].endswith('.parquet'))
+        likes = read_columns(self.root, 'likes', ('message_id',))['message_id']
+        self.assertEqual(sorted(likes.tolist()), sorted([self.msg_ids[0]] * 2 + [self.msg_ids[1]]))
+
+    def test_report(self):
+        export(self.root, 'csv', now=self.now)
+        summary = report(self.root)
+        self.assertEqual([count for _, count in summary['daily_active_posters']], [2, 2, 2])
+        likes = summary['likes_per_message']
+        self.assertEqual((likes['messages'], likes['likes'], likes['liked_messages']), (6, 3, 2))
+        self.assertEqual(likes['histogram'], {'0': 4, '1': 1, '2-3': 1})
+
+    def test_report_without_exports(self):
+        summary = report(self.root)
+        self.assertEqual(summary['daily_active_posters'], [])
+        self.assertEqual(summary['likes_per_message']['messages'], 0)
+
+    def test_cli(self):
+        runner = app.test_cli_runner()
+        result = runner.invoke(args=['analytics', 'export', '--format', 'csv',
+                                     '--root', self.root])
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn("likes: 3 rows", result.output)
+        result = runner.invoke(args=['analytics', 'report', '--root', self.root])
+        self.assertIn("3 likes on 2 of 6 messages", result.output)
+
+
+class SummaryTestCase(TestCase):
+
+    def test_daily_active_posters(self):
+        stamps = np.array(['2024-01-01T10:00', '2024-01-01T11:00', '2024-01-01T12:00',
+                           '2024-01-03T09:00'], dtype='datetime64[us]')
+        days, counts = daily_active_posters(np.array([1, 1, 2, 1]), stamps)
+        self.assertEqual([str(d) for d in days], ['2024-01-01', '2024-01-03'])
+        self.assertEqual(counts.tolist(), [2, 1])
+
+    def test_like_distribution(self):
+        likes = np.array([5] * 9 + [7, 7, 99])  # 99 is not among the messages
+        summary = like_distribution(np.array([7, 5, 3]), likes)
+        self.assertEqual(summary['likes'], 11)
+        self.assertEqual(summary['max'], 9)
+        self.assertEqual(summary['p50'], 2.0)
+        self.assertEqual(summary['histogram'], {'0': 1, '2-3': 1, '8-15': 1})
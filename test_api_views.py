@@ -0,0 +1,218 @@
+"""JSON API view tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_api_views.py
+
+
+import os
+from datetime import datetime, timedelta
+from unittest import TestCase
+from unittest.mock import patch
+
+from sqlalchemy.exc import IntegrityError
+
+from models import db, User, Message, Like
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, CURR_USER_KEY
+from broker import broker
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class APIViewTestCase(TestCase):
+    """Test views for the /api/v1 blueprint."""
+
+    def setUp(self):
+        """Create test client, add sample data."""
+        db.session.rollback()
+        Like.query.delete()
+        Message.query.delete()
+        User.query.delete()
+
+        self.client = app.test_client()
+
+        self.testuser = User.signup("testuser", "test@test.com", "testuser", None)
+        self.other = User.signup("other", "other@test.com", "otheruser", None)
+        db.session.commit()
+
+        self.testuser.following.append(self.other)
+        now = datetime.utcnow()
+        for i in range(5):
+            db.session.add(Message(text=f"mine {i}", user_id=self.testuser.id,
+                                   timestamp=now - timedelta(minutes=2 * i)))
+            db.session.add(Message(text=f"theirs {i}", user_id=self.other.id,
+                                   timestamp=now - timedelta(minutes=2 * i + 1)))
+        db.session.commit()
+
+    def tearDown(self):
+        """Clean up any fouled transactions."""
+        db.session.rollback()
+
+    def login(self, c, user):
+        with c.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user.id
+
+    def test_timeline_requires_login(self):
+        resp = self.client.get("/api/v1/timeline")
+        self.assertEqual(resp.status_code, 401)
+        self.assertIn("error", resp.get_json())
+
+    def test_timeline_cursor_pagination(self):
+        with self.client as c:
+            self.login(c, self.testuser)
+
+            first = c.get("/api/v1/timeline?limit=4").get_json()
+            self.assertEqual([m['text'] for m in first['data']],
+                             ["mine 0", "theirs 0", "mine 1", "theirs 1"])
+            self.assertIsNotNone(first['next_cursor'])
+
+            rest = c.get(f"/api/v1/timeline?limit=10&cursor={first['next_cursor']}").get_json()
+            self.assertEqual(len(rest['data']), 6)
+            self.assertIsNone(rest['next_cursor'])
+
+    def test_sparse_fieldsets(self):
+        with self.client as c:
+            self.login(c, self.testuser)
+
+            resp = c.get("/api/v1/timeline?fields=id,text&limit=1")
+            self.assertEqual(set(resp.get_json()['data'][0]), {"id", "text"})
+
+            resp = c.get("/api/v1/timeline?fields=password")
+            self.assertEqual(resp.status_code, 400)
+
+    def test_user_detail_counts(self):
+        resp = self.client.get(
+            f"/api/v1/users/{self.testuser.id}"
+            "?fields=username,messages_count,following_count,followers_count")
+        self.assertEqual(resp.get_json(), {"username": "testuser",
+                                           "messages_count": 5,
+                                           "following_count": 1,
+                                           "followers_count": 0})
+        self.assertNotIn(b"email", resp.data)
+
+    def test_followers_and_following(self):
+        following = self.client.get(f"/api/v1/users/{self.testuser.id}/following").get_json()
+        followers = self.client.get(f"/api/v1/users/{self.other.id}/followers").get_json()
+
+        self.assertEqual([u['username'] for u in following['data']], ["other"])
+        self.assertEqual([u['username'] for u in followers['data']], ["testuser"])
+
+    def test_like_and_list_likes(self):
+        msg = Message.query.filter_by(user_id=self.other.id).first()
+
+        with self.client as c:
+            self.login(c, self.testuser)
+
+            resp = c.post(f"/api/v1/messages/{msg.id}/like")
+            self.assertEqual(resp.status_code, 200)
+
+            likes = c.get(f"/api/v1/users/{self.testuser.id}/likes").get_json()
+            self.assertEqual([m['id'] for m in likes['data']], [msg.id])
+
+            resp = c.delete(f"/api/v1/messages/{msg.id}/like")
+            self.assertFalse(resp.get_json()['liked'])
+            self.assertEqual(Like.query.count(), 0)
+
+    def test_like_is_unique(self):
+        msg = Message.query.filter_by(user_id=self.other.id).first()
+
+        with self.client as c:
+            self.login(c, self.testuser)
+            for _ in range(2):
+                resp = c.post(f"/api/v1/messages/{msg.id}/like")
+                self.assertTrue(resp.get_json()['liked'])
+        self.assertEqual(Like.query.filter_by(message_id=msg.id).count(), 1)
+
+        with self.assertRaises(IntegrityError), db.session.begin_nested():
+            db.session.add(Like(user_id=self.testuser.id, message_id=msg.id))
+
+    def test_likes_ordered_by_like_time(self):
+        msgs = Message.query.filter_by(user_id=self.other.id).order_by(Message.id).all()
+        now = datetime.utcnow()
+        # Inserted in id order but liked in the reverse order.
+        for i, msg in enumerate(msgs):
+            db.session.add(Like(user_id=self.testuser.id, message_id=msg.id,
+                                timestamp=now - timedelta(minutes=i)))
+        db.session.commit()
+
+        ids, cursor = [], None
+        while True:
+            query = {'limit': 2, 'cursor': cursor} if cursor else {'limit': 2}
+            body = self.client.get(f"/api/v1/users/{self.testuser.id}/likes",
+                                   query_string=query).get_json()
+            ids += [m['id'] for m in body['data']]
+            cursor = body['next_cursor']
+            if cursor is None:
+                break
+        self.assertEqual(ids, [m.id for m in msgs])
+
+    def test_create_and_delete_message(self):
+        with self.client as c:
+            self.login(c, self.testuser)
+
+            resp = c.post("/api/v1/messages", json={"text": "Hello API"})
+            self.assertEqual(resp.status_code, 201)
+            msg_id = resp.get_json()['id']
+
+            resp = c.delete(f"/api/v1/messages/{msg_id}")
+            self.assertEqual(resp.status_code, 204)
+            self.assertIsNotNone(db.session.get(Message, msg_id).deleted_at)
+
+            resp = c.delete(f"/api/v1/messages/{msg_id}")
+            self.assertEqual(resp.status_code, 404)
+
+    def test_cannot_delete_others_message(self):
+        msg = Message.query.filter_by(user_id=self.other.id).first()
+
+        with self.client as c:
+            self.login(c, self.testuser)
+            resp = c.delete(f"/api/v1/messages/{msg.id}")
+
+            self.assertEqual(resp.status_code, 403)
+
+    def test_timeline_stream_pushes_new_ids(self):
+        missed = Message.query.filter_by(user_id=self.other.id).first()
+
+        with patch.dict(app.config, TIMELINE_STREAM=True, STREAM_HEARTBEAT=0.05,
+                        STREAM_MAX_SECONDS=0.2), \
+                self.client as c:
+            self.login(c, self.testuser)
+
+            resp = c.get("/api/v1/timeline/stream",
+                         headers={"Last-Event-ID": str(missed.id - 1)})
+            broker.publish(self.other.id, 123456)
+            body = resp.get_data(as_text=True)
+
+        self.assertEqual(resp.mimetype, "text/event-stream")
+        self.assertIn(f"id: {missed.id}\n", body)
+        self.assertIn("id: 123456\n", body)
+        self.assertEqual(broker.subscriber_count(), 0)
+
+    def test_bulk_follow_and_unfollow(self):
+        third = User.signup("third", "third@test.com", "password", None)
+        fourth = User.signup("fourth", "fourth@test.com", "password", None)
+        db.session.commit()
+
+        with self.client as c:
+            self.login(c, self.testuser)
+
+            resp = c.post("/api/v1/follows", json={
+                "ids": [self.other.id, third.id, self.testuser.id],
+                "usernames": ["fourth", "nobody"],
+            })
+            # `other` was already followed; self and unknown users are skipped.
+            self.assertEqual(resp.get_json(), {"followed": 2, "following_count": 3})
+
+            resp = c.delete("/api/v1/follows", json={"usernames": ["third", "fourth"]})
+            self.assertEqual(resp.get_json(), {"unfollowed": 2, "following_count": 1})
+
+            resp = c.post("/api/v1/follows", json={"ids": ["x"]})
+            self.assertEqual(resp.status_code, 400)
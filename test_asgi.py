@@ -0,0 +1,193 @@
+"""Async (ASGI) serving mode tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_asgi.py
+
+
+import asyncio
+import json
+import os
+import tempfile
+import threading
+from unittest import TestCase
+from unittest.mock import patch
+
+from flask.sessions import SecureCookieSessionInterface
+
+from models import db, User, Message, Like
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app as flask_app, CURR_USER_KEY
+import asgi
+from broker import broker
+from events import event_log
+from ratelimit import Policy, limiter
+from sessions import MemoryStore, ServerSessionInterface
+
+db.create_all()
+
+
+def call(method, path, query='', user_id=None):
+    """Run one request through the ASGI app and return (status, body)."""
+    status, _, body = call_with_headers(method, path, query, user_id)
+    return status, body
+
+
+def call_with_headers(method, path, query='', user_id=None, alongside=None):
+    """Like `call`, but return (status, {header: value}, body).
+
+    `alongside` is an optional coroutine function run next to the request.
+    """
+    headers = []
+    if user_id is not None:
+        serializer = SecureCookieSessionInterface().get_signing_serializer(flask_app)
+        cookie = f"{flask_app.config['SESSION_COOKIE_NAME']}={serializer.dumps({CURR_USER_KEY: user_id})}"
+        headers.append((b'cookie', cookie.encode()))
+    scope = {'type': 'http', 'method': method, 'path': path, 'headers': headers,
+             'query_string': query.encode(), 'root_path': '', 'scheme': 'http',
+             'server': ('testserver', 80), 'http_version': '1.1'}
+    sent = []
+    requested = []
+
+    async def receive():
+        if requested:
+            # The client stays connected.
+            await asyncio.Event().wait()
+        requested.append(True)
+        return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+    async def send(event):
+        sent.append(event)
+
+    async def run():
+        if alongside is None:
+            await asgi.app(scope, receive, send)
+        else:
+            await asyncio.gather(asgi.app(scope, receive, send), alongside())
+        # Connections are bound to the loop they were opened on.
+        await asgi.engine.dispose()
+
+    asyncio.run(run())
+    status = sent[0]['status']
+    headers = {name.decode(): value.decode() for name, value in sent[0]['headers']}
+    body = b''.join(e.get('body', b'') for e in sent[1:])
+    return status, headers, body
+
+
+class ASGITestCase(TestCase):
+    """Test the async views and the fall-through to Flask."""
+
+    # The async engine reads on its own connections, so data must be committed.
+    transactional = False
+
+    def setUp(self):
+        db.session.rollback()
+        Like.query.delete()
+        Message.query.delete()
+        User.query.delete()
+
+        self.author = User.signup("author", "author@test.com", "password", None)
+        self.fan = User.signup("fan", "fan@test.com", "password", None)
+        db.session.commit()
+        self.fan.following.append(self.author)
+        self.msg = Message(text="async hello", user_id=self.author.id)
+        db.session.add(self.msg)
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def test_server_side_session_loads_off_the_event_loop(self):
+        threads = []
+
+        def session_data(app, sid):
+            threads.append(threading.current_thread())
+            return {CURR_USER_KEY: self.fan.id}
+
+        with patch.object(flask_app, 'session_interface', ServerSessionInterface(MemoryStore())), \
+                patch('asgi.session_data', session_data):
+            status, _ = call('GET', '/api/v1/timeline', user_id=self.fan.id)
+        self.assertEqual(status, 200)
+        self.assertEqual(len(threads), 1)
+        self.assertIsNot(threads[0], threading.main_thread())
+
+    def test_user_detail(self):
+        status, body = call('GET', f'/api/v1/users/{self.author.id}',
+                            'fields=username,messages_count')
+        self.assertEqual(status, 200)
+        self.assertEqual(json.loads(body), {"username": "author", "messages_count": 1})
+
+    def test_timeline_requires_login(self):
+        status, _ = call('GET', '/api/v1/timeline')
+        self.assertEqual(status, 401)
+
+    def test_timeline_matches_sync_view(self):
+        _, async_body = call('GET', '/api/v1/timeline', user_id=self.fan.id)
+
+        with flask_app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.fan.id
+            sync_body = c.get('/api/v1/timeline').data
+
+        self.assertEqual(json.loads(async_body), json.loads(sync_body))
+
+    def test_like_and_unlike(self):
+        status, _ = call('POST', f'/api/v1/messages/{self.msg.id}/like', user_id=self.fan.id)
+        self.assertEqual(status, 200)
+        self.assertEqual(Like.query.filter_by(user_id=self.fan.id).count(), 1)
+        db.session.rollback()
+
+        call('DELETE', f'/api/v1/messages/{self.msg.id}/like', user_id=self.fan.id)
+        self.assertEqual(Like.query.filter_by(user_id=self.fan.id).count(), 0)
+
+    def test_like_and_unlike_are_logged_once(self):
+        path = f'/api/v1/messages/{self.msg.id}/like'
+        with tempfile.TemporaryDirectory() as root, patch.object(event_log, 'root', root):
+            for method in ('POST', 'POST', 'DELETE', 'DELETE'):
+                call(method, path, user_id=self.fan.id)
+            events = [e for _, e in event_log.read(0)[0]]
+        self.assertEqual([(e['type'], e['user_id'], e['message_id']) for e in events],
+                         [('like', self.fan.id, self.msg.id), ('unlike', self.fan.id, self.msg.id)])
+
+    def test_rate_limited_request_gets_retry_after(self):
+        path = f'/api/v1/messages/{self.msg.id}/like'
+        with patch.dict(limiter.policies, {'api.like_message': [Policy(1, 60, 'user')]}):
+            limiter.backend.clear()
+            try:
+                call('POST', path, user_id=self.fan.id)
+                status, headers, body = call_with_headers('POST', path, user_id=self.fan.id)
+            finally:
+                limiter.backend.clear()
+        self.assertEqual(status, 429)
+        self.assertIn('error', json.loads(body))
+        self.assertGreater(int(headers['retry-after']), 0)
+
+    def test_timeline_stream(self):
+        async def publish():
+            while not broker.subscriber_count():
+                await asyncio.sleep(0.01)
+            broker.publish(self.author.id, 123456)
+
+        path = '/api/v1/timeline/stream'
+        with patch.dict(flask_app.config, TIMELINE_STREAM=True, STREAM_HEARTBEAT=0.05,
+                        STREAM_MAX_SECONDS=0.2):
+            status, headers, body = call_with_headers(
+                'GET', path, f'last_id={self.msg.id - 1}', self.fan.id, alongside=publish)
+        body = body.decode()
+        self.assertEqual(status, 200)
+        self.assertTrue(headers['content-type'].startswith('text/event-stream'))
+        self.assertIn(f"id: {self.msg.id}\n", body)
+        self.assertIn("id: 123456\n", body)
+        self.assertIn(": keep-alive", body)
+        self.assertEqual(broker.subscriber_count(), 0)
+
+    def test_timeline_stream_off_by_default(self):
+        status, _ = call('GET', '/api/v1/timeline/stream', user_id=self.fan.id)
+        self.assertEqual(status, 404)
+
+    def test_other_paths_fall_through_to_flask(self):
+        status, body = call('GET', '/signup')
+        self.assertEqual(status, 200)
+        self.assertIn(b"Sign", body)
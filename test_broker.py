@@ -0,0 +1,89 @@
+"""Live timeline broker tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_broker.py
+
+
+import queue
+from unittest import TestCase
+from unittest.mock import patch
+
+from broker import Broker, RedisBackend
+
+
+class FakeRedis:
+    """Local stand-in for the bits of redis-py pub/sub the broker uses."""
+
+    def __init__(self):
+        self.listeners = []
+
+    def publish(self, channel, data):
+        for q in self.listeners:
+            q.put({'type': 'message', 'channel': channel, 'data': data.encode()})
+
+    def pubsub(self):
+        return FakePubSub(self)
+
+
+class FakePubSub:
+    def __init__(self, client):
+        self.queue = queue.Queue()
+        client.listeners.append(self.queue)
+
+    def subscribe(self, channel):
+        self.queue.put({'type': 'subscribe', 'channel': channel, 'data': 1})
+
+    def listen(self):
+        while True:
+            yield self.queue.get()
+
+
+class BrokerTestCase(TestCase):
+    """Test in-process and shared-backend delivery."""
+
+    def test_delivers_only_to_followers_of_author(self):
+        broker = Broker()
+        fan = broker.subscribe({1, 2})
+        other = broker.subscribe({3})
+
+        broker.publish(2, 42)
+
+        self.assertEqual(fan.get(timeout=0.1), 42)
+        self.assertIsNone(other.get(timeout=0.01))
+
+    def test_unsubscribe(self):
+        broker = Broker()
+        with broker.subscribe({1}) as sub:
+            self.assertEqual(broker.subscriber_count(), 1)
+        self.assertEqual(broker.subscriber_count(), 0)
+
+        broker.publish(1, 7)
+        self.assertIsNone(sub.get(timeout=0.01))
+
+    def test_shared_backend_reaches_other_workers(self):
+        shared = FakeRedis()
+        worker_a = Broker(RedisBackend(shared))
+        worker_b = Broker(RedisBackend(shared))
+        sub = worker_b.subscribe({5})
+
+        worker_a.publish(5, 99)
+
+        self.assertEqual(sub.get(timeout=1), 99)
+
+    def test_shared_backend_listens_once_per_process(self):
+        shared = FakeRedis()
+        worker = Broker(RedisBackend(shared))
+        # Nothing listens in a preloading master that never subscribes.
+        self.assertEqual(len(shared.listeners), 0)
+
+        worker.subscribe({5})
+        worker.subscribe({6})
+        self.assertEqual(len(shared.listeners), 1)
+
+        with patch('broker.os.getpid', return_value=-1):
+            sub = worker.subscribe({7})
+        self.assertEqual(len(shared.listeners), 2)
+
+        worker.publish(7, 11)
+        self.assertEqual(sub.get(timeout=1), 11)
@@ -0,0 +1,202 @@
+"""Read-through cache tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_cache.py
+
+
+import os
+import threading
+import time
+from unittest import TestCase
+from unittest.mock import patch
+
+from sqlalchemy import event
+
+from models import db, User, Message
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, CURR_USER_KEY
+from cache import MemoryStore, ReadThroughCache, SharedStore
+from profiles import profile_cache
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class FakeRedis:
+    """Local stand-in for the bits of redis-py the shared store uses."""
+
+    def __init__(self):
+        self.data = {}
+
+    def get(self, key):
+        item = self.data.get(key)
+        if item is None or item[1] < time.time():
+            return None
+        return item[0]
+
+    def set(self, key, value, ex=None, nx=False):
+        if nx and self.get(key) is not None:
+            return None
+        self.data[key] = (value, time.time() + ex)
+        return True
+
+    def delete(self, key):
+        self.data.pop(key, None)
+
+
+class ReadThroughCacheTestCase(TestCase):
+    """Test the cache without the database."""
+
+    def test_single_flight(self):
+        cache = ReadThroughCache(ttl=60)
+        calls = []
+        release = threading.Event()
+
+        def loader():
+            calls.append(1)
+            release.wait(1)
+            return 'value'
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(cache.get('k', loader)))
+                   for _ in range(8)]
+        for t in threads:
+            t.start()
+        time.sleep(0.05)
+        release.set()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, ['value'] * 8)
+        self.assertEqual(cache.get('k', loader), 'value')
+        self.assertEqual(len(calls), 1)
+
+    def test_errors_are_shared_not_cached(self):
+        cache = ReadThroughCache(ttl=60)
+
+        def loader():
+            raise KeyError('missing')
+
+        with self.assertRaises(KeyError):
+            cache.get('k', loader)
+        self.assertEqual(cache.get('k', lambda: 'found'), 'found')
+
+    def test_stale_while_revalidate(self):
+        store = MemoryStore()
+        cache = ReadThroughCache(store, ttl=60, stale_ttl=60)
+        store.set('k', ('old', time.time() - 1, 0.0), 60)
+
+        # One caller refreshes; anyone arriving meanwhile gets the old value.
+        flight, leader = cache._join('k')
+        self.assertEqual(cache.get('k', lambda: 'new'), 'old')
+        cache._land('k', flight)
+
+        self.assertEqual(cache.get('k', lambda: 'new'), 'new')
+        self.assertEqual(cache.get('k', lambda: 'newer'), 'new')
+
+    def test_probabilistic_early_expiry(self):
+        store = MemoryStore()
+        # -log(1 - 0.5) ~ 0.7: a 1s build time scaled by 1000 is due 5s early.
+        with patch('cache.random.random', return_value=0.5):
+            store.set('k', ('old', time.time() + 5, 1.0), 60)
+            self.assertEqual(ReadThroughCache(store, ttl=60, beta=1000).get('k', lambda: 'new'),
+                             'new')
+
+            store.set('k', ('old', time.time() + 5, 0.0), 60)
+            self.assertEqual(ReadThroughCache(store, ttl=60).get('k', lambda: 'new'), 'old')
+
+    def test_delete_during_load(self):
+        cache = ReadThroughCache(ttl=60)
+
+        def loader():
+            cache.delete('k')
+            return 'before the write'
+
+        self.assertEqual(cache.get('k', loader), 'before the write')
+        self.assertEqual(cache.get('k', lambda: 'after'), 'after')
+
+    def test_shared_store(self):
+        client = FakeRedis()
+        worker1 = ReadThroughCache(SharedStore(client), ttl=60)
+        worker2 = ReadThroughCache(SharedStore(client), ttl=60)
+
+        self.assertEqual(worker1.get('k', lambda: {'a': [1, 2]}), {'a': [1, 2]})
+        self.assertEqual(worker2.get('k', lambda: 'unused'), {'a': [1, 2]})
+
+        # Another worker holds the refresh lock: serve stale.
+        worker1.store.set('k', ('old', time.time() - 1, 0.0), 60)
+        worker1.store.lock('k', 10)
+        self.assertEqual(worker2.get('k', lambda: 'new'), 'old')
+        worker1.store.unlock('k')
+        self.assertEqual(worker2.get('k', lambda: 'new'), 'new')
+
+        worker2.delete('k')
+        self.assertEqual(worker1.get('k', lambda: 'reloaded'), 'reloaded')
+
+
+class ProfileCacheTestCase(TestCase):
+    """Test profile pages served from the cache."""
+
+    def setUp(self):
+        db.session.rollback()
+        User.query.delete()
+        Message.query.delete()
+        profile_cache.clear()
+
+        self.viewer = User.signup("viewer", "viewer@test.com", "password", None)
+        self.author = User.signup("author", "author@test.com", "password", None)
+        db.session.commit()
+        db.session.add(Message(text="first warble", user_id=self.author.id))
+        db.session.commit()
+        self.client = app.test_client()
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def get(self, path):
+        statements = []
+        listener = lambda *args: statements.append(args[2])
+        event.listen(db.engine, "before_cursor_execute", listener)
+        try:
+            resp = self.client.get(path, follow_redirects=True)
+        finally:
+            event.remove(db.engine, "before_cursor_execute", listener)
+        return resp, statements
+
+    def test_hit_skips_profile_queries(self):
+        resp, _ = self.get(f"/users/{self.author.id}")
+        self.assertIn(b"first warble", resp.data)
+
+        resp, statements = self.get(f"/users/{self.author.id}")
+        self.assertIn(b"first warble", resp.data)
+        self.assertEqual(statements, [])
+
+        resp = self.client.get("/users/nobody")
+        self.assertEqual(resp.status_code, 404)
+
+    def test_writes_invalidate(self):
+        self.get(f"/users/{self.author.id}")
+        self.get(f"/users/{self.viewer.id}")
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.author.id
+            c.post("/messages/new", data={"text": "second warble"})
+            resp, _ = self.get(f"/users/{self.author.id}")
+            self.assertIn(b"second warble", resp.data)
+            self.assertIn(b"2 total", resp.data)
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.viewer.id
+            c.post(f"/users/follow/{self.author.id}")
+            resp, _ = self.get(f"/users/{self.author.id}")
+            self.assertIn(b"Unfollow", resp.data)
+
+            c.post("/users/profile", data={"username": "viewer", "email": "viewer@test.com",
+                                           "bio": "new bio", "password": "password"})
+            resp, _ = self.get(f"/users/{self.viewer.id}")
+            self.assertIn(b"new bio", resp.data)
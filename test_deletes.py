@@ -0,0 +1,117 @@
+"""Message deletion and purge tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_deletes.py
+
+
+import os
+from datetime import datetime, timedelta
+from unittest import TestCase
+
+from models import db, User, Message, Like, timeline_entries
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, CURR_USER_KEY
+from deletes import purge
+from profiles import profile_cache
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class DeleteTestCase(TestCase):
+
+    def setUp(self):
+        db.session.rollback()
+        User.query.delete()
+        Message.query.delete()
+        profile_cache.clear()
+        self.author = User.signup("author", "author@test.com", "password", None)
+        self.fan = User.signup("fan", "fan@test.com", "password", None)
+        db.session.commit()
+        self.fan.follow_many([self.author.id])
+        self.msg = Message(text="soon gone", user_id=self.author.id)
+        self.kept = Message(text="still here", user_id=self.author.id)
+        db.session.add_all([self.msg, self.kept])
+        db.session.commit()
+        db.session.add(Like(user_id=self.fan.id, message_id=self.msg.id))
+        db.session.commit()
+        self.msg_id = self.msg.id
+        self.client = app.test_client()
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def login(self, c, user):
+        with c.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user.id
+
+    def test_deleted_message_disappears(self):
+        with self.client as c:
+            self.login(c, self.author)
+            resp = c.post(f"/messages/{self.msg_id}/delete")
+            self.assertEqual(resp.status_code, 302)
+
+            self.assertEqual(c.get(f"/messages/{self.msg_id}").status_code, 404)
+            self.assertEqual(c.post(f"/messages/{self.msg_id}/delete").status_code, 404)
+            profile = c.get(f"/users/{self.author.id}").data
+            self.assertNotIn(b"soon gone", profile)
+            self.assertIn(b"still here", profile)
+
+            self.login(c, self.fan)
+            self.assertNotIn(b"soon gone", c.get("/").data)
+            self.assertNotIn(b"soon gone", c.get(f"/liked_messages/{self.fan.id}").data)
+            timeline = c.get("/api/v1/timeline").get_json()['data']
+            self.assertEqual([m['text'] for m in timeline], ["still here"])
+            user = c.get(f"/api/v1/users/{self.author.id}?fields=messages_count").get_json()
+            self.assertEqual(user['messages_count'], 1)
+
+        # Still there until purged.
+        self.assertEqual(Like.query.count(), 1)
+
+    def test_counts_leave_out_deleted_messages(self):
+        with self.client as c:
+            self.login(c, self.author)
+            c.post(f"/messages/{self.msg_id}/delete")
+            home = c.get("/").get_data(as_text=True)
+            self.assertIn(f'<a href="/users/{self.author.id}">1</a>', home)
+            following = c.get(f"/users/{self.author.id}/following").get_data(as_text=True)
+            self.assertIn("1 total", following)
+
+            self.login(c, self.fan)
+            home = c.get("/").get_data(as_text=True)
+            self.assertIn("Liked Messages: 0", home)
+
+    def test_only_the_author_can_delete(self):
+        with self.client as c:
+            self.login(c, self.fan)
+            resp = c.post(f"/messages/{self.msg_id}/delete")
+            self.assertEqual(resp.status_code, 302)
+            self.assertEqual(c.post("/messages/0/delete").status_code, 404)
+
+        db.session.refresh(self.msg)
+        self.assertIsNone(self.msg.deleted_at)
+
+    def test_purge_removes_rows_and_likes(self):
+        extra = [Message(text=f"extra {i}", user_id=self.author.id) for i in range(4)]
+        db.session.add_all(extra)
+        db.session.commit()
+        long_ago = datetime.utcnow() - timedelta(days=1)
+        for msg in [self.msg, *extra]:
+            msg.deleted_at = long_ago
+        self.kept.deleted_at = datetime.utcnow()
+        db.session.commit()
+        db.session.execute(timeline_entries.insert().values(
+            owner_id=self.fan.id, message_id=self.msg_id, timestamp=self.msg.timestamp))
+        db.session.commit()
+
+        self.assertEqual(purge(chunk=2), 5)
+
+        db.session.expire_all()
+        self.assertEqual([m.text for m in Message.query], ["still here"])
+        self.assertEqual(Like.query.count(), 0)
+        self.assertEqual(db.session.execute(timeline_entries.select()).all(), [])
+        self.assertEqual(purge(grace=timedelta(0)), 1)
@@ -0,0 +1,141 @@
+"""Event log tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_events.py
+
+
+import os
+import tempfile
+from collections import Counter
+from unittest import TestCase
+
+from models import db, User, Message, Like
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, CURR_USER_KEY
+from events import Consumer, EventLog, event_log, replay, stage
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class EventLogTestCase(TestCase):
+    """Test the segment files without the database."""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.log = EventLog(self.tmp.name, segment_bytes=100)
+
+    def test_offsets_span_segments(self):
+        offsets = [self.log.append([{'type': 'like', 'n': i}])[0] for i in range(10)]
+        self.assertGreater(len(self.log.segments()), 1)
+        self.assertEqual(self.log.segments()[0], 0)
+
+        events, end = self.log.read(0)
+        self.assertEqual([e['n'] for _, e in events], list(range(10)))
+        self.assertEqual([at for at, _ in events], offsets)
+        self.assertEqual(end, self.log.end_offset())
+
+        events, _ = self.log.read(offsets[6], limit=2)
+        self.assertEqual([e['n'] for _, e in events], [6, 7])
+
+    def test_torn_lines(self):
+        self.log.append([{'n': 1}])
+        path = os.path.join(self.tmp.name, '%020d.jsonl' % 0)
+        with open(path, 'ab') as f:
+            f.write(b'{"n": 2')
+        events, end = self.log.read(0)
+        self.assertEqual([e['n'] for _, e in events], [1])
+        # The unterminated line is not consumed.
+        self.assertEqual(end, os.path.getsize(path) - len(b'{"n": 2'))
+
+        with open(path, 'ab') as f:
+            f.write(b'\n')
+        self.log.append([{'n': 3}])
+        events, _ = self.log.read(0)
+        self.assertEqual([e['n'] for _, e in events], [1, 3])
+
+    def test_consumer_and_prune(self):
+        self.log.segment_bytes = 20
+        self.log.append([{'n': i} for i in range(3)])
+        consumer = Consumer(self.log, 'counter')
+        seen = []
+        self.assertEqual(consumer.run(lambda e: seen.append(e['n'])), 3)
+        self.assertEqual(consumer.run(lambda e: seen.append(e['n'])), 0)
+        self.assertEqual(consumer.lag(), 0)
+
+        for i in range(3, 10):
+            self.log.append([{'n': i}])
+        self.assertGreater(consumer.lag(), 0)
+        consumer.run(lambda e: seen.append(e['n']), batch=2)
+        self.assertEqual(seen, list(range(10)))
+
+        self.assertGreater(self.log.prune(consumer.offset), 0)
+        seen.clear()
+        replay(self.log, lambda e: seen.append(e['n']))
+        self.assertEqual(seen[-1], 9)
+        self.assertLess(len(seen), 10)
+
+
+class RouteEventsTestCase(TestCase):
+    """Test that routes log committed changes."""
+
+    def setUp(self):
+        db.session.rollback()
+        User.query.delete()
+        Message.query.delete()
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.saved = event_log.root
+        event_log.root = self.tmp.name
+
+        self.fan = User.signup("fan", "fan@test.com", "password", None)
+        self.author = User.signup("author", "author@test.com", "password", None)
+        db.session.commit()
+        self.msg = Message(text="hello", user_id=self.author.id)
+        db.session.add(self.msg)
+        db.session.commit()
+        self.client = app.test_client()
+
+    def tearDown(self):
+        event_log.root = self.saved
+        db.session.rollback()
+
+    def events(self):
+        return [e for _, e in event_log.read(0)[0]]
+
+    def test_like_follow_and_post(self):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.fan.id
+            c.get(f"/like/{self.msg.id}", headers={"Referer": "/"})
+            c.post(f"/users/follow/{self.author.id}")
+            c.post("/messages/new", data={"text": "reply"})
+            c.delete(f"/api/v1/messages/{self.msg.id}/like")
+
+        events = self.events()
+        self.assertEqual([e['type'] for e in events], ['like', 'follow', 'message', 'unlike'])
+        self.assertEqual(events[0]['message_id'], self.msg.id)
+        self.assertEqual(events[1]['following_ids'], [self.author.id])
+        self.assertEqual(events[2]['user_id'], self.fan.id)
+
+        # A derived view rebuilt from the log.
+        likes = Counter()
+
+        def apply(e):
+            if e['type'] in ('like', 'unlike'):
+                likes[e['message_id']] += 1 if e['type'] == 'like' else -1
+
+        replay(event_log, apply)
+        self.assertEqual(likes[self.msg.id], 0)
+
+    def test_rollback_drops_staged_events(self):
+        stage('like', user_id=self.fan.id, message_id=self.msg.id)
+        db.session.rollback()
+        db.session.add(Like(user_id=self.fan.id, message_id=self.msg.id))
+        db.session.commit()
+        self.assertEqual(self.events(), [])
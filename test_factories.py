@@ -0,0 +1,46 @@
+"""Test data factory and fixture tests."""
+
+# run these tests like:
+#
+#    python -m pytest test_factories.py
+
+
+import os
+from unittest import TestCase
+
+from models import db, User, Message, Like
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, CURR_USER_KEY
+from factories import PASSWORD, make_follows, make_likes, make_messages, make_users
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class FactoryTestCase(TestCase):
+    """Needs the fixtures in conftest.py: nothing here clears the tables."""
+
+    def test_bulk_graph(self):
+        author, *fans = make_users(3, prefix='fac')
+        make_follows([(fan, author) for fan in fans])
+        msg_ids = make_messages([author], per_user=5)
+        make_likes([(fan, msg_ids[0]) for fan in fans])
+        db.session.commit()
+
+        user = db.session.get(User, author)
+        self.assertEqual(user.username_key, user.username.lower())
+        self.assertEqual(user.followers.count(), 2)
+        self.assertEqual([m.id for m in user.messages.order_by(Message.timestamp.desc())],
+                         msg_ids)
+        self.assertEqual(Like.query.filter_by(message_id=msg_ids[0]).count(), 2)
+        self.assertTrue(User.authenticate(user.username, PASSWORD))
+
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = fans[0]
+            self.assertIn(b"warble 0", c.get("/").data)
+
+    def test_commits_are_rolled_back_between_tests(self):
+        # Runs after test_bulk_graph, whose committed users must be gone.
+        self.assertIsNone(User.query.filter(User.username.like('fac%')).first())
@@ -0,0 +1,122 @@
+"""Media pipeline tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_media.py
+
+
+import io
+import os
+import tempfile
+from unittest import TestCase
+
+from PIL import Image
+
+from models import db, User
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, CURR_USER_KEY
+import media
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+def make_image(width=800, height=400, fmt='PNG'):
+    out = io.BytesIO()
+    Image.new('RGB', (width, height), (29, 161, 242)).save(out, fmt)
+    return out.getvalue()
+
+
+class MediaTestCase(TestCase):
+    """Test storage, variants and serving of images."""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.saved_root = app.config['MEDIA_ROOT']
+        app.config['MEDIA_ROOT'] = self.tmp.name
+        media._ready.clear()
+        self.client = app.test_client()
+
+    def tearDown(self):
+        media.worker.join()
+        app.config['MEDIA_ROOT'] = self.saved_root
+        self.tmp.cleanup()
+        db.session.rollback()
+
+    def test_store_is_content_addressed(self):
+        data = make_image()
+        with app.test_request_context():
+            url = media.store(data)
+            self.assertEqual(media.store(data), url)
+        self.assertRegex(url, r'^/media/[0-9a-f]{2}/[0-9a-f]{64}\.png$')
+
+    def test_rejects_non_images(self):
+        with app.test_request_context():
+            with self.assertRaises(media.MediaError):
+                media.store(b"not an image")
+
+    def test_variants_generated_and_rewritten(self):
+        with app.test_request_context():
+            url = media.store(make_image(width=300, height=150))
+        media.worker.join()
+
+        with app.test_request_context(headers={'Accept': 'image/webp,*/*'}):
+            self.assertTrue(media.variant_url(url, 'card').endswith('-144.webp'))
+            self.assertEqual(media.variant_filter(url, 'card'), media.variant_url(url, 'card'))
+            # Wider than the original: fall back to the original.
+            self.assertEqual(media.variant_url(url, 'hero'), url)
+            self.assertTrue(media.variant_url(url, 'thumb', webp=False).endswith('-96.jpg'))
+
+        self.assertEqual(media.variant_url("https://example.com/a.jpg", 'card'),
+                         "https://example.com/a.jpg")
+
+    def test_served_with_immutable_cache(self):
+        with app.test_request_context():
+            url = media.store(make_image(width=100, height=100))
+
+        resp = self.client.get(url)
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn("immutable", resp.headers['Cache-Control'])
+        self.assertIn("max-age=31536000", resp.headers['Cache-Control'])
+        resp.close()
+
+    def test_rejects_paths_outside_media(self):
+        with open(os.path.join(self.tmp.name, "secret.txt"), "w") as f:
+            f.write("secret")
+        os.mkdir(os.path.join(self.tmp.name, "ab"))
+        for path in ("/media/../app.py", "/media/..%2f/secret.txt", "/media/ab/..%2fsecret.txt",
+                     "/media/ab/secret.txt", f"/media/cd/ab{'0' * 62}.png"):
+            resp = self.client.get(path, follow_redirects=True)
+            self.assertEqual(resp.status_code, 404, path)
+            self.assertNotIn(b"secret", resp.data)
+            resp.close()
+
+    def test_variant_pages_vary_on_accept(self):
+        with app.test_request_context():
+            media.variant_filter("/static/images/default-pic.png", 'card')
+            resp = app.process_response(app.make_response("page"))
+        self.assertIn("Accept", resp.headers['Vary'])
+
+    def test_profile_upload(self):
+        User.query.delete()
+        user = User.signup("uploader", "up@test.com", "password", None)
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = user.id
+
+            resp = c.post("/users/profile", data={
+                "username": "uploader",
+                "email": "up@test.com",
+                "password": "password",
+                "image_file": (io.BytesIO(make_image(fmt='JPEG')), "me.jpg"),
+            }, content_type="multipart/form-data")
+
+            self.assertEqual(resp.status_code, 302)
+
+        db.session.rollback()
+        self.assertTrue(db.session.get(User, user.id).image_url.startswith("/media/"))
@@ -6,6 +6,7 @@
 
 
 import os
+from datetime import datetime
 from unittest import TestCase
 from models import db, User, Message, Like, followers_following
 from sqlalchemy.exc import IntegrityError
@@ -34,8 +35,10 @@ class MessageModelTestCase(TestCase):
 
     def setUp(self):
         """Create test client, add sample data."""
-        db.drop_all()
-        db.create_all()
+        db.session.rollback()
+        Like.query.delete()
+        Message.query.delete()
+        User.query.delete()
 
         self.user = User.signup("testuser", "test@test.com", "password", None)
         db.session.add(self.user)
@@ -161,4 +164,48 @@ class MessageModelTestCase(TestCase):
         """Does creating a new message with missing required data using Message.create raise the appropriate error?"""
         with self.assertRaises(IntegrityError):
             message = Message.create(None, self.user.id)
-            db.session.commit()
\ No newline at end of file
+            db.session.commit()
+
+    def test_liked_by_orders_by_like_time_with_counts(self):
+        """Does liked_by page through likes newest first, with authors and counts?"""
+        author = User.signup("author", "author@test.com", "password", None)
+        other = User.signup("other", "other@test.com", "password", None)
+        db.session.commit()
+
+        first = Message(text="first", user_id=author.id)
+        second = Message(text="second", user_id=author.id)
+        db.session.add_all([first, second])
+        db.session.commit()
+
+        db.session.add(Like(user_id=self.user.id, message_id=second.id,
+                            timestamp=datetime(2023, 1, 1)))
+        db.session.add(Like(user_id=self.user.id, message_id=first.id,
+                            timestamp=datetime(2023, 1, 2)))
+        db.session.add(Like(user_id=other.id, message_id=first.id))
+        db.session.commit()
+
+        rows, has_next = Message.liked_by(self.user.id, per_page=1)
+        self.assertTrue(has_next)
+        message, liked_at, like_count = rows[0]
+        self.assertEqual(message.text, "first")
+        self.assertEqual(message.user.username, "author")
+        self.assertEqual(liked_at, datetime(2023, 1, 2))
+        self.assertEqual(like_count, 2)
+
+        rows, has_next = Message.liked_by(self.user.id, page=2, per_page=1)
+        self.assertFalse(has_next)
+        self.assertEqual([r[0].text for r in rows], ["second"])
+
+
+class LikesMigrateTestCase(TestCase):
+    """Test the likes.timestamp migration."""
+
+    # The migration runs DDL on a connection of its own.
+    transactional = False
+
+    def test_migrate_likes_is_idempotent(self):
+        for _ in range(2):
+            result = app.test_cli_runner().invoke(args=["likes", "migrate"])
+            self.assertEqual(result.exit_code, 0, result.output)
+            self.assertIn("Backfilled timestamp for 0", result.output)
+            self.assertIn("Removed 0 duplicate", result.output)
@@ -92,7 +92,8 @@ class MessageViewTestCase(TestCase):
                 resp = c.post(f"/messages/{msg.id}/delete")
 
                 self.assertEqual(resp.status_code, 302)
-                self.assertIsNone(Message.query.get(msg.id))
+                db.session.refresh(msg)
+                self.assertIsNotNone(msg.deleted_at)
 
     def test_view_followers_logged_in(self):
         """When logged in, can you view a user's followers page?"""
@@ -149,7 +150,7 @@ class MessageViewTestCase(TestCase):
             resp = c.post(f"/messages/{msg.id}/delete")
 
             self.assertEqual(resp.status_code, 302)
-            self.assertEqual(Message.query.count(), 0)
+            self.assertEqual(Message.query.filter_by(deleted_at=None).count(), 0)
 
     def test_delete_message_logged_out(self):
         """When logged out, are you prohibited from deleting messages?"""
@@ -0,0 +1,209 @@
+"""Notification tests."""
+
+# run these tests like:
+#
+#    python -m pytest test_notifications.py
+
+
+import os
+from unittest import TestCase
+from unittest.mock import patch
+
+from models import db, Message, User, notifications
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, CURR_USER_KEY
+from factories import make_messages, make_users
+from notifications import (FLUSH_ATTEMPTS, FOLLOW, LIKE, MENTION, NOTIFICATIONS_PAGE_SIZE,
+                           mentions, notification_writer, notifications_page, notify,
+                           unread_count, unread_counts)
+from posting import post_message
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+def rows(user_id):
+    return db.session.execute(
+        notifications.select().where(notifications.c.user_id == user_id)
+        .order_by(notifications.c.id)).all()
+
+
+class NotificationTestCase(TestCase):
+
+    def setUp(self):
+        unread_counts.clear()
+        self.author, *self.fans = make_users(4, prefix='note')
+        self.msg_id, = make_messages([self.author])
+        db.session.commit()
+        self.client = app.test_client()
+
+    def tearDown(self):
+        unread_counts.clear()
+
+    def login(self, user_id):
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+
+    def test_follows_group(self):
+        for fan in self.fans:
+            notify(FOLLOW, [self.author], fan)
+        db.session.commit()
+        note, = rows(self.author)
+        self.assertEqual((note.actor_count, note.actor_id), (3, self.fans[-1]))
+
+    def test_mentions(self):
+        self.assertEqual(mentions("@ann and @bob, not me@mail.com or @@x; again @ann"),
+                         ['ann', 'bob'])
+
+    def test_likes_aggregate(self):
+        for fan in self.fans:
+            self.login(fan)
+            self.client.get(f"/like/{self.msg_id}")
+        self.login(self.author)
+        self.client.get(f"/like/{self.msg_id}")  # own warble: no notification
+
+        note, = rows(self.author)
+        self.assertEqual((note.kind, note.subject_id, note.actor_count, note.actor_id),
+                         (LIKE, self.msg_id, 3, self.fans[-1]))
+        self.assertEqual(unread_count(self.author), 1)
+
+    def test_read_groups_stay_closed(self):
+        notify(LIKE, [self.author], self.fans[0], self.msg_id)
+        db.session.commit()
+        self.login(self.author)
+        self.client.get("/notifications")
+        notify(LIKE, [self.author], self.fans[1], self.msg_id)
+        db.session.commit()
+
+        read, unread = rows(self.author)
+        self.assertIsNotNone(read.read_at)
+        self.assertIsNone(unread.read_at)
+        self.assertEqual(unread.actor_count, 1)
+
+    def test_follow_and_mention(self):
+        followed = db.session.get(User, self.fans[0])
+        followed.follow_many([self.author])
+        db.session.commit()
+        username = db.session.get(User, self.author).username
+        post_message(self.fans[1], f"hello @{username} and @nobody")
+
+        follow, mention = rows(self.author)
+        self.assertEqual((follow.kind, follow.subject_id, follow.actor_id),
+                         (FOLLOW, 0, self.fans[0]))
+        self.assertEqual((mention.kind, mention.actor_id), (MENTION, self.fans[1]))
+        self.assertEqual(db.session.get(Message, mention.subject_id).user_id, self.fans[1])
+
+    def test_unread_count_invalidated(self):
+        self.assertEqual(unread_count(self.author), 0)
+        notify(LIKE, [self.author], self.fans[0], self.msg_id)
+        self.assertEqual(unread_count(self.author), 0)  # not committed yet
+        db.session.commit()
+        self.assertEqual(unread_count(self.author), 1)
+
+    def test_page_marks_read(self):
+        notify(FOLLOW, [self.author], self.fans[0])
+        notify(LIKE, [self.author], self.fans[1], self.msg_id)
+        db.session.commit()
+        self.login(self.author)
+
+        resp = self.client.get("/")
+        self.assertIn(b'badge-primary">2<', resp.data)
+        resp = self.client.get("/notifications")
+        html = resp.get_data(as_text=True)
+        self.assertIn("followed you", html)
+        self.assertIn("liked", html)
+        self.assertEqual(unread_count(self.author), 0)
+        self.assertNotIn(b'badge-primary', self.client.get("/").data)
+
+    def test_page_marks_only_shown_read(self):
+        msg_ids = make_messages([self.author], per_user=NOTIFICATIONS_PAGE_SIZE + 1)
+        for msg_id in msg_ids:
+            notify(LIKE, [self.author], self.fans[0], msg_id)
+        db.session.commit()
+        self.login(self.author)
+
+        self.client.get("/notifications")
+        self.assertEqual(unread_count(self.author), 1)
+
+    def test_page_skips_deleted_messages(self):
+        notify(LIKE, [self.author], self.fans[0], self.msg_id)
+        db.session.commit()
+        self.login(self.author)
+        self.client.post(f"/messages/{self.msg_id}/delete")
+
+        page, next_cursor = notifications_page(self.author)
+        self.assertEqual(page, [])
+        self.assertIsNone(next_cursor)
+
+    def test_keyset_pages(self):
+        # Each like is of a different warble, so none are grouped.
+        for msg_id in make_messages([self.author], per_user=3):
+            notify(LIKE, [self.author], self.fans[0], msg_id)
+            db.session.commit()
+        first, cursor = notifications_page(self.author, limit=2)
+        rest, end = notifications_page(self.author, cursor, limit=2)
+        self.assertEqual(len(first), 2)
+        self.assertEqual(len(rest), 1)
+        self.assertIsNone(end)
+        self.assertEqual(len({n.id for n in first + rest}), 3)
+
+        self.login(self.author)
+        self.assertEqual(self.client.get("/notifications?cursor=nope").status_code, 400)
+
+    def test_anonymous(self):
+        resp = self.client.get("/notifications", follow_redirects=True)
+        self.assertIn(b"Access unauthorized", resp.data)
+
+
+class BatchedWriterTestCase(TestCase):
+
+    def setUp(self):
+        unread_counts.clear()
+        self.author, *self.fans = make_users(3, prefix='batch')
+        self.msg_id, = make_messages([self.author])
+        db.session.commit()
+        notification_writer.app = app
+        notification_writer.interval = 0
+
+    def tearDown(self):
+        notification_writer.app = None
+        notification_writer.flush()
+
+    def test_events_wait_for_commit_then_flush_together(self):
+        flushes = notification_writer.flushes
+        notify(LIKE, [self.author], self.fans[0], self.msg_id)
+        db.session.rollback()
+        for fan in self.fans:
+            notify(LIKE, [self.author], fan, self.msg_id)
+            db.session.commit()
+        self.assertEqual(rows(self.author), [])
+
+        self.assertEqual(notification_writer.flush(), 1)
+        note, = rows(self.author)
+        self.assertEqual(note.actor_count, 2)
+        self.assertEqual(notification_writer.flushes, flushes + 1)
+        self.assertEqual(unread_count(self.author), 1)
+
+    def test_failed_flush_is_retried(self):
+        notify(LIKE, [self.author], self.fans[0], self.msg_id)
+        db.session.commit()
+        with patch('notifications.write_groups', side_effect=RuntimeError("down")):
+            with self.assertRaises(RuntimeError):
+                notification_writer.flush()
+        notify(LIKE, [self.author], self.fans[1], self.msg_id)
+        db.session.commit()
+
+        self.assertEqual(notification_writer.flush(), 1)
+        note, = rows(self.author)
+        self.assertEqual((note.actor_count, note.actor_id), (2, self.fans[1]))
+
+    def test_batch_dropped_after_repeated_failures(self):
+        notify(LIKE, [self.author], self.fans[0], self.msg_id)
+        db.session.commit()
+        with patch('notifications.write_groups', side_effect=RuntimeError("down")):
+            for _ in range(FLUSH_ATTEMPTS):
+                with self.assertRaises(RuntimeError):
+                    notification_writer.flush()
+        self.assertEqual(notification_writer.flush(), 0)
+        self.assertEqual(rows(self.author), [])
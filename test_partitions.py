@@ -0,0 +1,172 @@
+"""Partitioning and archive tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_partitions.py
+
+
+import os
+import shutil
+import tempfile
+from datetime import datetime, timedelta
+from unittest import TestCase
+from unittest.mock import patch
+
+from sqlalchemy import text
+
+from models import db, User, Message, Like
+from partitions import (add_months, archive_partitions, archived_messages, convert_tables,
+                        forget_partitioned, is_partitioned, list_partitions, month_start)
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, CURR_USER_KEY
+from posting import post_message
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class PartitionTestCase(TestCase):
+
+    # Converting the tables takes locks on a connection of its own.
+    transactional = False
+    postgres_only = True
+
+    def setUp(self):
+        db.session.rollback()
+        Like.query.delete()
+        Message.query.delete()
+        User.query.delete()
+
+        self.user = User.signup("writer", "writer@test.com", "password", None)
+        self.fan = User.signup("fan", "fan@test.com", "password", None)
+        db.session.commit()
+
+        self.now = datetime.utcnow()
+        self.old = Message(text="old warble", user_id=self.user.id,
+                           timestamp=self.now - timedelta(days=800))
+        self.recent = Message(text="recent warble", user_id=self.user.id,
+                              timestamp=self.now - timedelta(days=1))
+        db.session.add_all([self.old, self.recent])
+        db.session.commit()
+        db.session.add(Like(user_id=self.fan.id, message_id=self.recent.id))
+        db.session.commit()
+
+        self.archive_root = tempfile.mkdtemp()
+        self.client = app.test_client()
+
+    def tearDown(self):
+        db.session.rollback()
+        shutil.rmtree(self.archive_root)
+        with db.engine.connect() as conn:
+            partitioned = is_partitioned(conn, 'messages')
+        if partitioned:
+            db.session.close()
+            db.drop_all()
+            db.create_all()
+        forget_partitioned()
+
+    def test_timeline_reaches_past_recent_window(self):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user.id
+            resp = c.get("/api/v1/timeline?fields=text&limit=5")
+
+        self.assertEqual([m['text'] for m in resp.get_json()['data']],
+                         ["recent warble", "old warble"])
+
+    def test_windows_only_on_partitioned_tables(self):
+        forget_partitioned()
+        with self.client as c, \
+                patch('partitions.is_partitioned', wraps=is_partitioned) as check, \
+                patch('timeline.newest_first') as windows:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user.id
+            for _ in range(2):
+                resp = c.get("/api/v1/timeline?fields=text&limit=5")
+                self.assertEqual(len(resp.get_json()['data']), 2)
+            post_message(self.user.id, "one more")
+
+        self.assertEqual(check.call_count, 1)
+        windows.assert_not_called()
+
+        db.session.commit()
+        with db.engine.begin() as conn:
+            convert_tables(conn)
+        with patch('timeline.newest_first', return_value=[]) as windows:
+            self.client.get("/api/v1/timeline?fields=text&limit=5")
+        windows.assert_called_once()
+
+    def test_convert_and_archive(self):
+        old_id, old_month = self.old.id, f"{self.old.timestamp:%Ym%m}"
+        db.session.commit()
+        with db.engine.begin() as conn:
+            convert_tables(conn)
+
+        with db.engine.connect() as conn:
+            self.assertTrue(is_partitioned(conn, 'messages'))
+            names = [p[0] for p in list_partitions(conn, 'messages')]
+        self.assertIn(f"messages_y{old_month}", names)
+        self.assertEqual(Message.query.count(), 2)
+        self.assertEqual(Like.query.count(), 1)
+
+        # New rows still get ids from the original sequence.
+        msg = Message(text="after convert", user_id=self.user.id)
+        db.session.add(msg)
+        db.session.commit()
+        self.assertGreater(msg.id, self.recent.id)
+        db.session.commit()  # DETACH PARTITION waits for open transactions
+
+        before = add_months(month_start(self.now), -12)
+        with db.engine.begin() as conn:
+            archived = archive_partitions(conn, self.archive_root, before)
+
+        self.assertIn((names[0], 1), archived)
+        self.assertEqual({m.text for m in Message.query}, {"recent warble", "after convert"})
+
+        rows = archived_messages(self.archive_root, self.user.id)
+        self.assertEqual([(r['id'], r['text']) for r in rows], [(old_id, "old warble")])
+        self.assertEqual(archived_messages(self.archive_root, self.fan.id), [])
+
+        app.config['ARCHIVE_ROOT'], saved = self.archive_root, app.config['ARCHIVE_ROOT']
+        try:
+            resp = self.client.get(f"/api/v1/users/{self.user.id}/archive")
+        finally:
+            app.config['ARCHIVE_ROOT'] = saved
+        self.assertEqual([m['text'] for m in resp.get_json()['data']], ["old warble"])
+
+    def test_likes_stay_unique_after_convert(self):
+        db.session.commit()
+        with db.engine.begin() as conn:
+            convert_tables(conn)
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.fan.id
+            for _ in range(2):
+                c.post(f"/api/v1/messages/{self.old.id}/like")
+        self.assertEqual(Like.query.filter_by(message_id=self.old.id).count(), 1)
+
+    def test_idempotency_keys_after_convert(self):
+        db.session.commit()
+        with db.engine.begin() as conn:
+            convert_tables(conn)
+            columns = conn.execute(text(
+                "SELECT indexdef FROM pg_indexes "
+                "WHERE indexname = 'ux_messages_user_id_idempotency_key'")).scalar()
+        self.assertIn("(user_id, idempotency_key, \"timestamp\")", columns)
+        # The migration sees the partitioned index and leaves it alone.
+        result = app.test_cli_runner().invoke(args=["posts", "migrate"])
+        self.assertEqual(result.exit_code, 0, result.output)
+
+        first = post_message(self.user.id, "once", "key-1")
+        again = post_message(self.user.id, "twice", "key-1")
+        other = post_message(self.fan.id, "theirs", "key-1")
+
+        self.assertTrue(first.created)
+        self.assertFalse(again.created)
+        self.assertEqual((again.id, again.text), (first.id, "once"))
+        self.assertTrue(other.created)
+        self.assertEqual(Message.query.filter_by(idempotency_key="key-1").count(), 2)
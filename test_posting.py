@@ -0,0 +1,156 @@
+"""Message posting tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_posting.py
+
+
+import os
+import threading
+from unittest import TestCase
+from unittest.mock import patch
+
+from models import db, User, Message
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, CURR_USER_KEY
+from posting import GroupCommitWriter, Post, post_message, write_batch
+import posting
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class PostingTestCase(TestCase):
+
+    def setUp(self):
+        db.session.rollback()
+        User.query.delete()
+        Message.query.delete()
+        self.user = User.signup("poster", "poster@test.com", "password", None)
+        self.other = User.signup("other", "other@test.com", "password", None)
+        db.session.commit()
+        self.client = app.test_client()
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def login(self, c):
+        with c.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.user.id
+
+    def test_form_double_submit_posts_once(self):
+        with self.client as c:
+            self.login(c)
+            data = {"text": "only once", "idempotency_key": "form-key-1"}
+            c.post("/messages/new", data=data)
+            c.post("/messages/new", data=data)
+            c.post("/messages/new", data={"text": "no key"})
+            c.post("/messages/new", data={"text": "no key"})
+
+        texts = sorted(m.text for m in Message.query.filter_by(user_id=self.user.id))
+        self.assertEqual(texts, ["no key", "no key", "only once"])
+
+    def test_api_idempotency_key(self):
+        with self.client as c:
+            self.login(c)
+            headers = {"Idempotency-Key": "api-key-1"}
+            first = c.post("/api/v1/messages", json={"text": "hello"}, headers=headers)
+            retry = c.post("/api/v1/messages", json={"text": "hello again"}, headers=headers)
+            bad = c.post("/api/v1/messages", json={"text": "x"},
+                         headers={"Idempotency-Key": "k" * 65})
+
+        self.assertEqual(first.status_code, 201)
+        self.assertEqual(retry.status_code, 200)
+        self.assertEqual(retry.get_json()["id"], first.get_json()["id"])
+        self.assertEqual(retry.get_json()["text"], "hello")
+        self.assertEqual(bad.status_code, 400)
+        self.assertEqual(Message.query.filter_by(user_id=self.user.id).count(), 1)
+
+    def test_keys_are_per_author(self):
+        mine = post_message(self.user.id, "mine", "shared-key")
+        theirs = post_message(self.other.id, "theirs", "shared-key")
+        self.assertTrue(mine.created and theirs.created)
+        self.assertNotEqual(mine.id, theirs.id)
+
+    def test_batch_with_repeated_keys(self):
+        posts = [Post(self.user.id, "a", "k1"), Post(self.user.id, "b"),
+                 Post(self.user.id, "a again", "k1"), Post(self.other.id, "c", "k1")]
+        write_batch(posts)
+
+        self.assertEqual([p.created for p in posts], [True, True, False, True])
+        self.assertEqual(posts[2].id, posts[0].id)
+        self.assertEqual(posts[2].text, "a")
+        self.assertEqual(Message.query.count(), 3)
+
+    def test_failed_batch_retried_post_by_post(self):
+        writer = GroupCommitWriter()
+        posts = [Post(self.user.id, "fine"), Post(0, "no such author"), Post(self.other.id, "ok")]
+        for p in posts:
+            p.done = threading.Event()
+        with self.assertLogs('posting', 'ERROR'):
+            writer._write(posts)
+
+        self.assertTrue(all(p.done.is_set() for p in posts))
+        self.assertEqual([p.error is None for p in posts], [True, False, True])
+        self.assertEqual([p.created for p in posts], [True, False, True])
+        self.assertEqual(writer.posts, 2)
+        self.assertEqual(sorted(m.text for m in Message.query), ["fine", "ok"])
+
+    def test_error_after_commit_still_succeeds(self):
+        post = Post(self.user.id, "committed")
+        with patch('posting.broker.publish', side_effect=RuntimeError), \
+                self.assertLogs('posting', 'ERROR'):
+            write_batch([post])
+        self.assertTrue(post.created)
+
+        post = Post(self.user.id, "hooked")
+        with patch('events.event_log.append', side_effect=RuntimeError), \
+                self.assertLogs('posting', 'ERROR'):
+            write_batch([post])
+        self.assertTrue(post.created)
+        self.assertEqual(Message.query.count(), 2)
+
+    def test_form_rejects_long_text(self):
+        with self.client as c:
+            self.login(c)
+            resp = c.post("/messages/new", data={"text": "x" * 141})
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(Message.query.count(), 0)
+
+    def test_group_commit_batches_concurrent_posts(self):
+        writer = GroupCommitWriter(window=0.05)
+        writer.app = app
+        saved, posting.group_writer = posting.group_writer, writer
+        self.addCleanup(setattr, posting, 'group_writer', saved)
+
+        user_id = self.user.id
+        results = []
+        threads = [threading.Thread(target=lambda i=i: results.append(
+                       post_message(user_id, f"warble {i}", f"key-{i % 10}")))
+                   for i in range(20)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(len(results), 20)
+        self.assertEqual(sum(p.created for p in results), 10)
+        self.assertEqual(writer.posts, 20)
+        self.assertLess(writer.batches, 20)
+        db.session.expire_all()
+        self.assertEqual(Message.query.filter_by(user_id=self.user.id).count(), 10)
+
+
+class PostsMigrateTestCase(TestCase):
+    """Test the idempotency_key migration."""
+
+    transactional = False
+
+    def test_migrate_posts_is_idempotent(self):
+        for _ in range(2):
+            result = app.test_cli_runner().invoke(args=["posts", "migrate"])
+            self.assertEqual(result.exit_code, 0, result.output)
+            self.assertIn("idempotency_key is in place", result.output)
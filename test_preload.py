@@ -0,0 +1,76 @@
+"""Cache preload tests."""
+
+# run these tests like:
+#
+#    python -m pytest test_preload.py
+
+
+import os
+from unittest import TestCase
+
+from models import db, User, Message, Like
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app
+from factories import make_follows, make_messages, make_users
+from preload import child_pids, hot_authors, memory_report, preload
+from profiles import profile_cache, profile_key
+from recent import recent_messages
+from usernames import username_ids
+
+
+class PreloadTestCase(TestCase):
+
+    def setUp(self):
+        # hot_authors ranks every user, including any a non-transactional test left behind.
+        Like.query.delete()
+        Message.query.delete()
+        User.query.delete()
+        profile_cache.clear()
+        recent_messages.clear()
+        username_ids.clear()
+        self.star, self.known, *fans = make_users(4, prefix='warm')
+        make_follows([(fan, self.star) for fan in fans] + [(fans[0], self.known)])
+        make_messages([self.star, self.known], per_user=3)
+        db.session.commit()
+
+    def tearDown(self):
+        profile_cache.clear()
+        recent_messages.clear()
+        username_ids.clear()
+
+    def test_hot_authors(self):
+        self.assertEqual([user_id for user_id, _ in hot_authors(1)], [self.star])
+        self.assertEqual([user_id for user_id, _ in hot_authors()], [self.star, self.known])
+
+    def test_preload(self):
+        loaded = preload(app, authors=1)
+        self.assertEqual(loaded['authors'], 1)
+        self.assertGreaterEqual(loaded['templates'], len(app.jinja_env.list_templates()))
+        self.assertIsNotNone(profile_cache.store.get(profile_key(self.star)))
+        self.assertIsNone(profile_cache.store.get(profile_key(self.known)))
+        self.assertEqual(len(recent_messages.get(self.star, 3)), 3)
+        self.assertIsNone(recent_messages.get(self.known, 3))
+        self.assertEqual(recent_messages.stats()['authors'], 1)
+
+        username = hot_authors(1)[0].username
+        misses = username_ids.misses
+        self.assertEqual(username_ids.get(username.upper()), self.star)
+        self.assertEqual(username_ids.misses, misses)
+
+    def test_preload_nothing(self):
+        self.assertEqual(preload(app, authors=0)['authors'], 0)
+        self.assertEqual(recent_messages.stats()['authors'], 0)
+
+    def test_memory_report(self):
+        report = memory_report()
+        if not report:
+            self.skipTest("no /proc/self/smaps_rollup")
+        self.assertGreater(report['rss'], 0)
+        self.assertLessEqual(report['pss'], report['rss'])
+        self.assertEqual(report['shared'] + report['private'], report['rss'])
+        self.assertEqual(memory_report(2 ** 31), {})
+
+    def test_child_pids(self):
+        self.assertIn(os.getpid(), child_pids(os.getppid()))
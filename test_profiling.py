@@ -0,0 +1,104 @@
+"""Sampled profiling tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_profiling.py
+
+
+import os
+import pstats
+import tempfile
+import time
+from unittest import TestCase
+
+from flask import Flask
+
+from profiling import Profiler, collapse, init_profiling
+
+
+def busy(seconds):
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        pass
+
+
+def make_app(**config):
+    app = Flask(__name__)
+    app.config.update(PROFILE_SAMPLE_RATE=1.0, PROFILE_MODE='sample',
+                      PROFILE_INTERVAL=0.001, PROFILE_FLUSH_INTERVAL=60, PROFILE_DIR=None)
+    app.config.update(config)
+
+    @app.route('/work')
+    def work():
+        busy(0.05)
+        return 'done'
+
+    return app
+
+
+class ProfilingTestCase(TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+
+    def test_disabled_installs_nothing(self):
+        app = make_app(PROFILE_SAMPLE_RATE=0, PROFILE_DIR=self.tmp.name)
+        hooks = sum(len(f) for f in app.before_request_funcs.values())
+        self.assertIsNone(init_profiling(app))
+        self.assertEqual(sum(len(f) for f in app.before_request_funcs.values()), hooks)
+
+    def test_sampled_stacks_per_endpoint(self):
+        app = make_app(PROFILE_DIR=self.tmp.name)
+        profiler = init_profiling(app)
+        with app.test_client() as c:
+            c.get('/work')
+            c.get('/work')
+            c.get('/missing')
+        profiler.flush()
+
+        path = os.path.join(self.tmp.name, f"work.{os.getpid()}.folded")
+        with open(path) as f:
+            lines = f.read().splitlines()
+        self.assertTrue(lines)
+        stack, count = lines[0].rsplit(' ', 1)
+        self.assertGreater(int(count), 0)
+        self.assertIn('busy (test_profiling.py:', stack)
+        self.assertTrue(any('work (test_profiling.py:' in line for line in lines))
+
+    def test_cprofile_mode(self):
+        app = make_app(PROFILE_MODE='cprofile', PROFILE_DIR=self.tmp.name)
+        profiler = init_profiling(app)
+        with app.test_client() as c:
+            c.get('/work')
+        profiler.flush()
+
+        stats = pstats.Stats(os.path.join(self.tmp.name, f"work.{os.getpid()}.prof"))
+        self.assertTrue(any(func[2] == 'busy' for func in stats.stats))
+
+    def test_files_written_on_flush_interval(self):
+        app = make_app(PROFILE_DIR=self.tmp.name)
+        profiler = init_profiling(app)
+        with app.test_client() as c:
+            c.get('/work')
+            self.assertEqual(os.listdir(self.tmp.name), [])
+
+            profiler.flush_interval = 0
+            c.get('/work')
+        self.assertEqual(os.listdir(self.tmp.name), [f"work.{os.getpid()}.folded"])
+
+    def test_rate_skips_requests(self):
+        app = make_app(PROFILE_DIR=self.tmp.name)
+        Profiler(self.tmp.name, 0.000001).init_app(app)
+        with app.test_client() as c:
+            c.get('/work')
+        self.assertEqual(os.listdir(self.tmp.name), [])
+
+    def test_collapse(self):
+        def inner():
+            import sys
+            return collapse(sys._getframe())
+
+        names = inner().split(';')
+        self.assertTrue(names[-1].startswith('inner (test_profiling.py:'))
+        self.assertTrue(names[-2].startswith('test_collapse (test_profiling.py:'))
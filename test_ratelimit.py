@@ -0,0 +1,136 @@
+"""Rate limiter tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_ratelimit.py
+
+
+import os
+from unittest import TestCase
+
+from sqlalchemy import event
+
+from models import db, User, Message, Like
+from ratelimit import MemoryBackend, Policy, RateLimiter, limiter
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, CURR_USER_KEY
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class TokenBucketTestCase(TestCase):
+    """Test the limiter without Flask."""
+
+    def test_bucket_refills_over_time(self):
+        backend = MemoryBackend()
+
+        self.assertEqual(backend.take('k', 1, 2, now=0), (True, 1))
+        self.assertEqual(backend.take('k', 1, 2, now=0), (True, 0))
+        self.assertFalse(backend.take('k', 1, 2, now=0)[0])
+        self.assertTrue(backend.take('k', 1, 2, now=1)[0])
+
+    def test_memory_backend_evicts_least_recent(self):
+        backend = MemoryBackend(max_keys=2)
+        backend.take('a', 1, 1, now=0)
+        backend.take('b', 1, 1, now=0)
+        backend.take('c', 1, 1, now=0)
+
+        # 'a' was evicted, so it starts with a full bucket again.
+        self.assertTrue(backend.take('a', 1, 1, now=0)[0])
+
+    def test_policies_per_scope_and_method(self):
+        rl = RateLimiter({'login': [Policy(1, 60, 'ip', methods=('POST',))]})
+
+        self.assertIsNone(rl.check('login', 'GET', None, '1.2.3.4'))
+        self.assertIsNone(rl.check('login', 'GET', None, '1.2.3.4'))
+        self.assertIsNone(rl.check('login', 'POST', None, '1.2.3.4'))
+        self.assertEqual(rl.check('login', 'POST', None, '1.2.3.4'), 60)
+        self.assertIsNone(rl.check('login', 'POST', None, '5.6.7.8'))
+        self.assertIsNone(rl.check('homepage', 'GET', None, '1.2.3.4'))
+
+    def test_rejected_request_takes_no_tokens(self):
+        rl = RateLimiter({'like': [Policy(1, 60, 'user'), Policy(2, 60, 'ip')]})
+
+        self.assertIsNone(rl.check('like', 'GET', 1, '1.2.3.4'))
+        self.assertEqual(rl.check('like', 'GET', 1, '1.2.3.4'), 60)
+        self.assertEqual(rl.check('like', 'GET', 1, '1.2.3.4'), 60)
+        # User 1's rejected requests did not use up the IP's second token.
+        self.assertIsNone(rl.check('like', 'GET', 2, '1.2.3.4'))
+        self.assertEqual(rl.check('like', 'GET', 3, '1.2.3.4'), 30)
+
+    def test_ip_checked_before_user_is_looked_up(self):
+        rl = RateLimiter({'like': [Policy(1, 60, 'user'), Policy(1, 60, 'ip')]})
+        lookups = []
+
+        def user_id():
+            lookups.append(1)
+            return 1
+
+        self.assertIsNone(rl.check('like', 'GET', user_id, '1.2.3.4'))
+        self.assertEqual(rl.check('like', 'GET', user_id, '1.2.3.4'), 60)
+        self.assertEqual(lookups, [1])
+
+
+class RateLimitViewTestCase(TestCase):
+    """Test throttling of real routes."""
+
+    def setUp(self):
+        db.session.rollback()
+        Like.query.delete()
+        Message.query.delete()
+        User.query.delete()
+
+        self.author = User.signup("author", "author@test.com", "password", None)
+        self.fan = User.signup("fan", "fan@test.com", "password", None)
+        db.session.commit()
+        self.msg = Message(text="like me", user_id=self.author.id)
+        db.session.add(self.msg)
+        db.session.commit()
+
+        self.saved = dict(limiter.policies)
+        limiter.backend.clear()
+        limiter.policies['like'] = [Policy(2, 60, 'user')]
+        limiter.policies['api.like_message'] = [Policy(1, 60, 'user')]
+        self.client = app.test_client()
+
+    def tearDown(self):
+        limiter.policies.clear()
+        limiter.policies.update(self.saved)
+        limiter.backend.clear()
+        db.session.rollback()
+
+    def test_like_is_throttled_before_db_work(self):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.fan.id
+
+            headers = {"Referer": "/"}
+            self.assertEqual(c.get(f"/like/{self.msg.id}", headers=headers).status_code, 302)
+            self.assertEqual(c.get(f"/like/{self.msg.id}", headers=headers).status_code, 302)
+
+            statements = []
+            listener = lambda *args: statements.append(args[2])
+            event.listen(db.engine, "before_cursor_execute", listener)
+            try:
+                resp = c.get(f"/like/{self.msg.id}", headers=headers)
+            finally:
+                event.remove(db.engine, "before_cursor_execute", listener)
+
+            self.assertEqual(resp.status_code, 429)
+            self.assertIn("Retry-After", resp.headers)
+            self.assertEqual(statements, [])
+
+    def test_api_returns_json_429(self):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.fan.id
+
+            c.post(f"/api/v1/messages/{self.msg.id}/like")
+            resp = c.post(f"/api/v1/messages/{self.msg.id}/like")
+
+            self.assertEqual(resp.status_code, 429)
+            self.assertIn("error", resp.get_json())
@@ -0,0 +1,97 @@
+"""Read model tests."""
+
+# run these tests like:
+#
+#    python -m pytest test_readmodels.py
+
+
+import os
+from datetime import datetime, timedelta
+from unittest import TestCase
+
+from models import db, User, Message, Like
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, CURR_USER_KEY
+from factories import make_follows, make_likes, make_messages, make_users
+from profiles import PROFILE_PAGE_SIZE, messages_page
+from readmodels import MessageCard, message_card_select, message_cards
+from recent import recent_messages
+from timeline import cached_streams
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class ReadModelTestCase(TestCase):
+
+    def setUp(self):
+        recent_messages.clear()
+        self.viewer, self.author, self.other = make_users(3, prefix='card')
+        make_follows([(self.viewer, self.author), (self.viewer, self.other)])
+        self.msg_ids = make_messages([self.author, self.other], per_user=3)
+        db.session.commit()
+
+    def test_message_cards(self):
+        rows = db.session.execute(
+            message_card_select().where(Message.id.in_(self.msg_ids))
+            .order_by(Message.id)).all()
+        cards = message_cards(rows)
+        self.assertEqual([c.id for c in cards], sorted(self.msg_ids))
+        self.assertIs(cards[0].user, cards[1].user)
+        self.assertIsNot(cards[0].user, cards[-1].user)
+        author = db.session.get(User, self.author)
+        self.assertEqual((cards[0].user.id, cards[0].user.username, cards[0].user.image_url),
+                         (author.id, author.username, author.image_url))
+        with self.assertRaises(AttributeError):
+            cards[0].bio = "not a field"
+
+    def test_deleted_messages_left_out(self):
+        db.session.get(Message, self.msg_ids[0]).deleted_at = db.func.now()
+        db.session.commit()
+        ids = db.session.execute(message_card_select().with_only_columns(Message.id)).scalars()
+        self.assertNotIn(self.msg_ids[0], set(ids))
+
+    def test_profile_page(self):
+        # Newer than setUp's, which are left for page 2.
+        make_messages([self.author], per_user=PROFILE_PAGE_SIZE,
+                      start=datetime.utcnow() + timedelta(hours=1))
+        make_likes([(self.viewer, self.msg_ids[2])])
+        db.session.commit()
+        author = db.session.get(User, self.author)
+        rows, has_next = messages_page(author, self.viewer, page=2)
+        self.assertFalse(has_next)
+        self.assertEqual([card.id for card, _, _ in rows], self.msg_ids[:3])
+        self.assertTrue(all(isinstance(card, MessageCard) for card, _, _ in rows))
+        self.assertEqual([(count, liked) for _, count, liked in rows],
+                         [(0, False), (0, False), (1, True)])
+
+    def test_profile_page_from_recent_cache(self):
+        make_likes([(self.viewer, self.msg_ids[2])])
+        db.session.commit()
+        author = db.session.get(User, self.author)
+        from_db = messages_page(author, self.viewer)
+
+        cached_streams([self.author], 1)
+        # Deleted in another worker: still in this worker's buffer.
+        db.session.get(Message, self.msg_ids[0]).deleted_at = db.func.now()
+        db.session.commit()
+        hits = recent_messages.hits
+        rows, has_next = messages_page(author, self.viewer)
+        self.assertEqual(recent_messages.hits, hits + 1)
+        self.assertFalse(has_next)
+        self.assertEqual([(card.id, card.text, card.user.username, count, liked)
+                          for card, count, liked in rows],
+                         [(card.id, card.text, card.user.username, count, liked)
+                          for card, count, liked in from_db[0] if card.id != self.msg_ids[0]])
+
+    def test_homepage_loads_no_orm_messages(self):
+        client = app.test_client()
+        with client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.viewer
+        db.session.expunge_all()
+        resp = client.get("/")
+        html = resp.get_data(as_text=True)
+        self.assertEqual(html.count('class="message-link"'), 6)
+        self.assertIn("warble 2", html)
+        self.assertFalse([obj for obj in db.session if isinstance(obj, (Message, Like))])
@@ -0,0 +1,114 @@
+"""Recent-messages cache tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_recent.py
+
+
+import os
+from datetime import datetime, timedelta
+from unittest import TestCase
+
+from models import db, User, Message, Like
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, CURR_USER_KEY
+from recent import RecentMessages, recent_messages
+from timeline import load_timeline
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+T0 = datetime(2023, 10, 1)
+
+
+def entry(i):
+    return (i, T0 + timedelta(minutes=i), f"warble {i}")
+
+
+class RingBufferTestCase(TestCase):
+    """Test the cache without the database."""
+
+    def test_get_needs_enough_history(self):
+        cache = RecentMessages(size=3)
+        self.assertIsNone(cache.get(1, 2))
+
+        cache.load(1, [entry(5), entry(4), entry(3)])
+        self.assertEqual(cache.get(1, 2), [entry(5), entry(4)])
+        # Older than the buffer reaches: the database has to answer.
+        self.assertIsNone(cache.get(1, 2, before=(entry(4)[1], 4)))
+
+        cache.load(2, [entry(1)])
+        self.assertEqual(cache.get(2, 10), [entry(1)])
+        self.assertEqual(cache.stats()['hits'], 2)
+        self.assertEqual(cache.stats()['misses'], 2)
+
+    def test_add_and_remove(self):
+        cache = RecentMessages(size=2)
+        cache.load(1, [entry(2), entry(1)])
+        cache.add(1, *entry(3))
+        self.assertEqual(cache.get(1, 2), [entry(3), entry(2)])
+        self.assertIsNone(cache.get(1, 3))
+
+        cache.remove(1, 3)
+        self.assertEqual(cache.get(1, 1), [entry(2)])
+
+        cache.add(7, *entry(9))  # not cached: ignored
+        self.assertIsNone(cache.get(7, 1))
+
+    def test_evicts_least_recently_used_author(self):
+        cache = RecentMessages(size=2)
+        cache.load(1, [entry(1)])
+        cache.max_bytes = cache.stats()['bytes'] * 2
+        cache.load(2, [entry(2)])
+        cache.get(1, 1)
+        cache.load(3, [entry(3)])
+
+        self.assertIsNotNone(cache.get(1, 1))
+        self.assertIsNone(cache.get(2, 1))
+        self.assertEqual(cache.stats()['authors'], 2)
+
+    def test_expires_after_ttl(self):
+        cache = RecentMessages(ttl=0)
+        cache.load(1, [entry(1)])
+        self.assertIsNone(cache.get(1, 1))
+
+
+class RecentViewTestCase(TestCase):
+    """Test the cache behind the merge plan and message writes."""
+
+    def setUp(self):
+        db.session.rollback()
+        Like.query.delete()
+        Message.query.delete()
+        User.query.delete()
+        recent_messages.clear()
+
+        self.viewer = User.signup("viewer", "viewer@test.com", "password", None)
+        self.author = User.signup("author", "author@test.com", "password", None)
+        db.session.commit()
+        self.viewer.follow_many(ids=[self.author.id])
+        db.session.add(Message(text="hello", user_id=self.author.id))
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def merged(self):
+        with app.test_request_context('/'):
+            return [m.text for m in load_timeline(self.viewer.id, Message.query,
+                                                  lambda q: q.all(), 10, plan='merge')]
+
+    def test_merge_plan_reads_and_updates_cache(self):
+        self.assertEqual(self.merged(), ["hello"])
+        self.assertEqual(recent_messages.stats()['misses'], 2)
+
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.author.id
+            c.post("/messages/new", data={"text": "again"})
+
+        self.assertEqual(self.merged(), ["again", "hello"])
+        self.assertEqual(recent_messages.stats()['hits'], 2)
@@ -0,0 +1,141 @@
+"""Server-side session tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_sessions.py
+
+
+import os
+from unittest import TestCase
+
+from models import db, User
+from sessions import MemoryStore, SQLStore, ServerSessionInterface
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, CURR_USER_KEY
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class CountingStore(MemoryStore):
+    """Memory store that records how often it is hit."""
+
+    def __init__(self):
+        super().__init__()
+        self.loads = 0
+        self.saves = 0
+
+    def load(self, sid):
+        self.loads += 1
+        return super().load(sid)
+
+    def save(self, sid, data, expires_at):
+        self.saves += 1
+        super().save(sid, data, expires_at)
+
+
+class SessionTestCase(TestCase):
+    """Test the server-side session interface on the real app."""
+
+    def setUp(self):
+        db.session.rollback()
+        User.query.delete()
+        self.user = User.signup("sessionuser", "s@test.com", "password", None)
+        db.session.commit()
+
+        self.saved_interface = app.session_interface
+        self.store = CountingStore()
+        app.session_interface = ServerSessionInterface(self.store)
+        self.client = app.test_client()
+
+    def tearDown(self):
+        app.session_interface = self.saved_interface
+        db.session.rollback()
+
+    def test_cookie_only_sent_for_new_session(self):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user.id
+
+            resp = c.get("/")
+            self.assertNotIn("Set-Cookie", resp.headers)
+            self.assertIn(b"@sessionuser", resp.data)
+
+    def test_unchanged_session_is_not_written(self):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user.id
+            saves = self.store.saves
+
+            c.get("/")
+            c.get(f"/users/{self.user.id}")
+
+            self.assertEqual(self.store.saves, saves)
+
+    def test_flash_updates_store_but_not_cookie(self):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user.id
+
+            resp = c.get("/logout")
+            self.assertNotIn("Set-Cookie", resp.headers)
+
+            resp = c.get("/")
+            self.assertIn(b"You have been logged out", resp.data)
+
+    def test_static_files_do_not_load_session(self):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user.id
+            loads = self.store.loads
+
+            c.get("/static/stylesheets/style.css").close()
+
+            self.assertEqual(self.store.loads, loads)
+
+    def test_login_issues_new_session_id(self):
+        with self.client as c:
+            c.get("/login")
+            with c.session_transaction() as sess:
+                sess["before"] = True
+            old_sid = c.get_cookie(app.config['SESSION_COOKIE_NAME']).value
+
+            resp = c.post("/login", data={"username": "sessionuser", "password": "password"})
+
+            self.assertIn("Set-Cookie", resp.headers)
+            self.assertNotEqual(c.get_cookie(app.config['SESSION_COOKIE_NAME']).value, old_sid)
+            self.assertIsNone(self.store.load(old_sid))
+
+    def test_unknown_session_id_is_replaced(self):
+        name = app.config['SESSION_COOKIE_NAME']
+        chosen = "a" * 43
+        with self.client as c:
+            c.set_cookie(name, chosen)
+
+            resp = c.get("/logout")
+
+            self.assertIn("Set-Cookie", resp.headers)
+            self.assertNotEqual(c.get_cookie(name).value, chosen)
+            self.assertIsNone(self.store.load(chosen))
+
+
+class SQLStoreTestCase(TestCase):
+    """Test the database-backed store."""
+
+    # The store commits on connections of its own.
+    transactional = False
+
+    def test_round_trip_and_expiry(self):
+        store = SQLStore()
+        store.save("a" * 43, {"x": (1, 2)}, expires_at=4102444800)
+        store.save("b" * 43, {"y": 1}, expires_at=1)
+
+        self.assertEqual(store.load("a" * 43), {"x": (1, 2)})
+        self.assertIsNone(store.load("b" * 43))
+        self.assertGreaterEqual(store.purge_expired(), 1)
+
+        store.delete("a" * 43)
+        self.assertIsNone(store.load("a" * 43))
@@ -0,0 +1,164 @@
+"""Timeline planner tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_timeline.py
+
+
+import os
+from datetime import datetime, timedelta
+from unittest import TestCase
+from unittest.mock import patch
+
+from models import db, User, Message, Like, timeline_entries
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from flask import g
+
+from app import app, CURR_USER_KEY
+from recent import recent_messages
+from timeline import (IN_LIST_MAX_FOLLOWS, LATERAL_MIN_RECENT, MERGE_MIN_WARM, author_ids,
+                      cached_streams, fan_out, load_timeline, merge_newest, plan_for, trim)
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class TimelinePlanTestCase(TestCase):
+
+    def setUp(self):
+        db.session.rollback()
+        Like.query.delete()
+        Message.query.delete()
+        User.query.delete()
+
+        self.viewer = User.signup("viewer", "viewer@test.com", "password", None)
+        self.authors = [User.signup(f"author{i}", f"author{i}@test.com", "password", None)
+                        for i in range(4)]
+        db.session.commit()
+        self.viewer.follow_many(ids=[a.id for a in self.authors[:3]])
+
+        now = datetime.utcnow()
+        for i, author in enumerate([self.viewer] + self.authors):
+            for j in range(6):
+                db.session.add(Message(text=f"{author.username} {j}", user_id=author.id,
+                                       timestamp=now - timedelta(minutes=7 * j + i)))
+        db.session.commit()
+        self.saved = app.config['TIMELINE_PRECOMPUTED']
+        recent_messages.clear()
+
+    def tearDown(self):
+        app.config['TIMELINE_PRECOMPUTED'] = self.saved
+        db.session.rollback()
+
+    def page(self, plan, limit=10, before=None):
+        with app.test_request_context('/'):
+            rows = load_timeline(self.viewer.id, Message.query, lambda q: q.all(),
+                                 limit, before, plan=plan)
+        return [m.id for m in rows]
+
+    def test_plan_choice(self):
+        self.assertEqual(plan_for(3, 5000, 'postgresql'), 'in_list')
+        self.assertEqual(plan_for(IN_LIST_MAX_FOLLOWS + 1, 10, 'postgresql'), 'in_list')
+        self.assertEqual(plan_for(IN_LIST_MAX_FOLLOWS + 1, LATERAL_MIN_RECENT, 'postgresql'),
+                         'lateral')
+        self.assertEqual(plan_for(IN_LIST_MAX_FOLLOWS + 1, LATERAL_MIN_RECENT, 'sqlite'),
+                         'in_list')
+        self.assertEqual(plan_for(IN_LIST_MAX_FOLLOWS + 1, 0, 'postgresql', precomputed=True),
+                         'precomputed')
+        self.assertEqual(plan_for(IN_LIST_MAX_FOLLOWS + 1, 0, 'sqlite', warm=MERGE_MIN_WARM),
+                         'merge')
+        self.assertEqual(plan_for(IN_LIST_MAX_FOLLOWS + 1, LATERAL_MIN_RECENT, 'postgresql',
+                                  warm=MERGE_MIN_WARM / 2), 'lateral')
+        self.assertEqual(plan_for(3, 0, 'postgresql', warm=1.0), 'in_list')
+
+    def test_merge_chosen_once_cache_is_warm(self):
+        expected = self.page('in_list')
+        with patch('timeline.IN_LIST_MAX_FOLLOWS', 1), app.test_request_context('/'):
+            load_timeline(self.viewer.id, Message.query, lambda q: q.all(), 10)
+            self.assertNotEqual(g.timeline_plan[0], 'merge')
+
+            cached_streams(author_ids(self.viewer.id), 1)
+            rows = load_timeline(self.viewer.id, Message.query, lambda q: q.all(), 10)
+            self.assertEqual(g.timeline_plan[0], 'merge')
+        self.assertEqual([m.id for m in rows], expected)
+
+    def test_plans_agree(self):
+        if db.engine.dialect.name != 'postgresql':
+            self.skipTest("the lateral plan needs PostgreSQL")
+        expected = self.page('in_list')
+        self.assertEqual(len(expected), 10)
+        self.assertEqual(self.page('lateral'), expected)
+        self.assertEqual(self.page('merge'), expected)
+        self.assertEqual(self.page('precomputed'), expected)
+
+        last = Message.query.get(expected[-1])
+        older = self.page('in_list', before=(last.timestamp, last.id))
+        self.assertEqual(self.page('lateral', before=(last.timestamp, last.id)), older)
+        self.assertEqual(self.page('merge', before=(last.timestamp, last.id)), older)
+        self.assertEqual(self.page('precomputed', before=(last.timestamp, last.id)), older)
+
+    def test_merge_newest(self):
+        streams = [[(5, 50), (2, 20)], [(4, 40), (3, 30), (1, 10)], []]
+        self.assertEqual(merge_newest(streams, 4), [50, 40, 30, 20])
+
+    def test_precomputed_fan_out_and_reset(self):
+        app.config['TIMELINE_PRECOMPUTED'] = True
+        self.page('precomputed')
+
+        with app.test_request_context('/'):
+            msg = Message(text="fresh", user_id=self.authors[0].id)
+            db.session.add(msg)
+            db.session.flush()
+            fan_out(msg)
+            db.session.commit()
+        self.assertEqual(self.page('precomputed', limit=1), [msg.id])
+
+        self.viewer.follow_many(ids=[self.authors[3].id])
+        db.session.commit()
+        self.assertEqual(db.session.query(timeline_entries).filter_by(
+            owner_id=self.viewer.id).count(), 0)
+        self.assertEqual(self.page('precomputed'), self.page('in_list'))
+
+    def test_precomputed_falls_back_only_past_horizon(self):
+        app.config['TIMELINE_PRECOMPUTED'] = True
+        everything = self.page('in_list', limit=50)
+
+        def plan_used():
+            with app.test_request_context('/'):
+                rows = load_timeline(self.viewer.id, Message.query, lambda q: q.all(), 50,
+                                     plan='precomputed')
+                return g.timeline_plan[0], [m.id for m in rows]
+
+        # Built from every message: a short page is the end of the timeline.
+        self.assertEqual(plan_used(), ('precomputed', everything))
+
+        trim(keep=5)
+        plan, rows = plan_used()
+        self.assertNotEqual(plan, 'precomputed')
+        self.assertEqual(rows, everything)
+
+    def test_materialize_leaves_commit_to_view(self):
+        app.config['TIMELINE_PRECOMPUTED'] = True
+        entries = db.session.query(timeline_entries).filter_by(owner_id=self.viewer.id)
+        self.page('precomputed')
+        self.assertGreater(entries.count(), 0)
+        db.session.rollback()
+        self.assertEqual(entries.count(), 0)
+
+        with patch('timeline.IN_LIST_MAX_FOLLOWS', 1), app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.viewer.id
+            resp = c.get("/api/v1/timeline")
+        self.assertIn('timeline;desc="precomputed"', resp.headers['Server-Timing'])
+        self.assertGreater(entries.count(), 0)
+
+    def test_plan_in_server_timing(self):
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.viewer.id
+            resp = c.get("/api/v1/timeline")
+
+        self.assertIn('timeline;desc="in_list"', resp.headers['Server-Timing'])
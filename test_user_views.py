@@ -1,7 +1,10 @@
 import os
+from datetime import datetime, timedelta
 from unittest import TestCase
 
-from models import db, connect_db, User
+from sqlalchemy import event
+
+from models import db, connect_db, User, Message, Like
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
@@ -13,6 +16,10 @@ os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
 # Now we can import app
 
 from app import app, CURR_USER_KEY
+from profiles import PROFILE_PAGE_SIZE
+from usernames import username_ids
+from directory import DIRECTORY_PAGE_SIZE
+from notifications import unread_count
 
 # Create our tables (we do this here, so we only create the tables
 # once for all tests --- in each test, we'll delete the data
@@ -30,6 +37,7 @@ class UserViewTestCase(TestCase):
         """Create test client, add sample data."""
 
         User.query.delete()
+        username_ids.clear()
 
         self.client = app.test_client()
 
@@ -124,3 +132,210 @@ class UserViewTestCase(TestCase):
             self.assertEqual(resp.status_code, 200)
             self.assertIn(b"User deleted successfully", resp.data)
             self.assertIsNone(User.query.get(self.testuser.id))
+
+    def test_liked_messages_page(self):
+        """Does the liked messages page list liked warbles with their author?"""
+        author = User.signup(username="author", email="author@test.com",
+                             password="author", image_url=None)
+        db.session.commit()
+        msg = Message(text="Likeable warble", user_id=author.id)
+        db.session.add(msg)
+        db.session.commit()
+        db.session.add(Like(user_id=self.testuser.id, message_id=msg.id))
+        db.session.commit()
+
+        resp = self.client.get(f"/liked_messages/{self.testuser.id}")
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn(b"Likeable warble", resp.data)
+        self.assertIn(b"@author", resp.data)
+
+    def test_follow_adds_single_edge(self):
+        """Does following create exactly one follow row?"""
+        other = User.signup(username="other", email="other@test.com",
+                            password="other1", image_url=None)
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            c.post(f"/users/follow/{other.id}")
+            resp = c.post(f"/users/follow/{other.id}", follow_redirects=True)
+
+            self.assertIn(b"already following", resp.data)
+            self.assertEqual(self.testuser.following.count(), 1)
+
+    def test_import_follows(self):
+        """Can a user follow a pasted list of usernames?"""
+        for name in ("alice", "bob"):
+            User.signup(username=name, email=f"{name}@test.com",
+                        password=name * 3, image_url=None)
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            resp = c.post("/users/follows/import",
+                          data={"usernames": "@alice, bob\nnobody"},
+                          follow_redirects=True)
+
+            self.assertIn(b"following 2 more", resp.data)
+            self.assertEqual(self.testuser.following.count(), 2)
+
+    def test_profile_anonymous(self):
+        """Can a logged-out visitor view a profile?"""
+        db.session.add(Message(text="Public warble", user_id=self.testuser.id))
+        db.session.commit()
+
+        resp = self.client.get(f"/users/{self.testuser.id}")
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn(b"Public warble", resp.data)
+        self.assertIn(b"1 total", resp.data)
+
+    def test_profile_query_budget(self):
+        """Does the profile page cost the same few queries however many messages it shows?"""
+        author = User.signup(username="author", email="author@test.com",
+                             password="author", image_url=None)
+        db.session.commit()
+        msgs = [Message(text=f"warble {i}", user_id=author.id)
+                for i in range(PROFILE_PAGE_SIZE + 5)]
+        db.session.add_all(msgs)
+        db.session.commit()
+        db.session.add(Like(user_id=self.testuser.id, message_id=msgs[-1].id))
+        self.testuser.following.append(author)
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+            # The navbar's unread count is cached across requests.
+            unread_count(self.testuser.id)
+
+            statements = []
+            listener = lambda *args: statements.append(args[2])
+            event.listen(db.engine, "before_cursor_execute", listener)
+            try:
+                resp = c.get(f"/users/{author.id}")
+            finally:
+                event.remove(db.engine, "before_cursor_execute", listener)
+
+        self.assertEqual(resp.status_code, 200)
+        # g.user, the profile user, the counters and the message page.
+        self.assertLessEqual(len(statements), 4)
+        self.assertIn(f"{PROFILE_PAGE_SIZE + 5} total".encode(), resp.data)
+        self.assertEqual(resp.data.count(b"You liked this message!"), 1)
+        self.assertIn(b"Unfollow", resp.data)
+        self.assertIn(b"Older", resp.data)
+
+    def test_usernames_ignore_case(self):
+        """Are usernames unique, routed and logged in regardless of case?"""
+        resp = self.client.post("/signup", data={
+            "username": "TestUser",
+            "email": "other@test.com",
+            "password": "testuser",
+        }, follow_redirects=True)
+        self.assertIn(b"Username already taken", resp.data)
+
+        username_ids.clear()
+        resp = self.client.get("/users/TESTUSER")
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn(b"@testuser", resp.data)
+        self.client.get("/users/testUser")
+        self.assertEqual(username_ids.hits, 1)
+        self.assertEqual(self.client.get("/users/nobody").status_code, 404)
+
+        resp = self.client.post("/login", data={"username": "TestUser", "password": "testuser"},
+                                follow_redirects=True)
+        self.assertIn(b"Hello, testuser!", resp.data)
+
+    def test_rename_frees_username(self):
+        """Does a renamed user stop resolving under the old name?"""
+        self.assertEqual(username_ids.get("testuser"), self.testuser.id)
+        self.testuser.username = "Renamed"
+        db.session.commit()
+
+        self.assertIsNone(username_ids.get("testuser"))
+        self.assertEqual(username_ids.get("renamed"), self.testuser.id)
+
+    def test_directory_pages_by_recent_activity(self):
+        """Does /users list the most recently active first, a page at a time?"""
+        now = datetime.utcnow()
+        for i in range(DIRECTORY_PAGE_SIZE + 3):
+            user = User.signup(username=f"dir{i}", email=f"dir{i}@test.com",
+                               password="password", image_url=None)
+            user.last_active_at = now - timedelta(hours=i + 1)
+        self.testuser.last_active_at = now
+        db.session.commit()
+        self.testuser.following.append(User.query.filter_by(username="dir0").one())
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+            resp = c.get("/users")
+            html = resp.data.decode()
+            self.assertLess(html.index("@testuser"), html.index("@dir0"))
+            self.assertLess(html.index("@dir0"), html.index("@dir1<"))
+            self.assertNotIn(f"@dir{DIRECTORY_PAGE_SIZE - 1}<", html)
+            self.assertEqual(html.count("Unfollow"), 1)
+
+            cursor = html.split('data-cursor="')[1].split('"')[0]
+            page = c.get(f"/users?cursor={cursor}&fragment=1").get_json()
+
+        self.assertIn(f"@dir{DIRECTORY_PAGE_SIZE - 1}<", page["html"])
+        self.assertIn(f"@dir{DIRECTORY_PAGE_SIZE + 2}<", page["html"])
+        self.assertIsNone(page["next_cursor"])
+        self.assertEqual(self.client.get("/users?cursor=garbage").status_code, 400)
+
+    def test_directory_search(self):
+        """Does ?q= match usernames ignoring case, treating wildcards literally?"""
+        for name in ("Alice", "malice", "bob", "al_x"):
+            User.signup(username=name, email=f"{name}@test.com",
+                        password="password", image_url=None)
+        db.session.commit()
+
+        html = self.client.get("/users?q=ALI").data.decode()
+        self.assertIn("@Alice", html)
+        self.assertIn("@malice", html)
+        self.assertNotIn("@bob", html)
+
+        html = self.client.get("/users?q=l_").data.decode()
+        self.assertIn("@al_x", html)
+        self.assertNotIn("@Alice", html)
+
+    def test_posting_marks_user_active(self):
+        self.testuser.last_active_at = datetime.utcnow() - timedelta(days=1)
+        db.session.commit()
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+            c.post("/messages/new", data={"text": "hello"})
+        db.session.expire_all()
+        self.assertLess(datetime.utcnow() - self.testuser.last_active_at, timedelta(minutes=1))
+
+
+class UsernameMigrateTestCase(TestCase):
+    """Test the username_key migration."""
+
+    # The migration runs DDL on a connection of its own.
+    transactional = False
+
+    def test_migrate_usernames_is_idempotent(self):
+        result = app.test_cli_runner().invoke(args=["usernames", "migrate"])
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn("Backfilled 0", result.output)
+
+
+class FollowsMigrateTestCase(TestCase):
+    """Test the followers_following key migration."""
+
+    transactional = False
+
+    def test_migrate_follows_is_idempotent(self):
+        for _ in range(2):
+            result = app.test_cli_runner().invoke(args=["follows", "migrate"])
+            self.assertEqual(result.exit_code, 0, result.output)
+            self.assertIn("Removed 0 duplicate", result.output)
@@ -0,0 +1,403 @@
+"""Home timeline query planning.
+
+A timeline is the newest messages by a user and everyone they follow. The
+cheapest way to fetch one depends on who is asking:
+
+    in_list      WHERE user_id IN (followees), then sort every candidate row.
+                 Best for a few follows or quiet authors.
+    lateral      A LATERAL top-K per followee from the (user_id, timestamp)
+                 index, then a sort of at most K rows per followee. Best for
+                 many active authors. PostgreSQL only.
+    merge        Take each followee's newest ids from the per-author cache in
+                 recent.py, merge the lists with a heap in Python and load
+                 only the winning rows by id. Used for viewers with many
+                 follows once at least MERGE_MIN_WARM of their authors are
+                 cached, so there is no candidate sort and next to no index
+                 work left for the database; authors not cached yet are
+                 loaded into it in one query.
+    precomputed  Read the viewer's materialized timeline (`timeline_entries`),
+                 which new messages are pushed into by `fan_out`. Used for
+                 viewers with many follows when TIMELINE_PRECOMPUTED is on.
+
+`choose_plan` picks one from the viewer's follow count, how many messages
+their followees posted in the last day and how many of them are cached.
+`load_timeline` runs it, records the plan and its time on `g` (sent as a
+Server-Timing header) and in the per-process `plan_stats`.
+
+Each materialized timeline has a marker entry (message_id 0) whose
+timestamp is its horizon: the timeline holds every message at or after it.
+A timeline built from all of the viewer's messages, or never trimmed, has
+FEED_COMPLETE there, and a short page from it is the end of the timeline;
+otherwise pages past the horizon are read with another plan.
+"""
+
+import heapq
+import threading
+import time
+from collections import defaultdict
+from datetime import datetime, timedelta
+from itertools import islice
+
+import click
+from flask import current_app, g
+from flask.cli import AppGroup
+from sqlalchemy import DateTime, Integer, delete, func, literal, select, true, tuple_, update
+from sqlalchemy.orm import aliased
+
+from models import db, Message, followers_following, insert_ignore, timeline_entries
+from partitions import TIMELINE_WINDOWS, newest_first, partitioned
+from recent import recent_messages
+
+PLANS = ('in_list', 'lateral', 'merge', 'precomputed')
+
+# Up to this many follows the IN-list plan is always cheap enough.
+IN_LIST_MAX_FOLLOWS = 100
+
+# Followees' messages in the last ACTIVITY_WINDOW, counted up to LATERAL_MIN_RECENT.
+# Below that, sorting every candidate row costs less than one probe per followee.
+ACTIVITY_WINDOW = timedelta(days=1)
+LATERAL_MIN_RECENT = 1000
+
+# Share of the viewer's authors that must be in `recent_messages` for the merge plan.
+MERGE_MIN_WARM = 0.9
+
+# Messages kept per materialized timeline by `flask timeline trim`.
+TIMELINE_SIZE = 800
+
+# Horizon of a materialized timeline that is missing no older messages.
+FEED_COMPLETE = datetime(1970, 1, 1)
+MARKER_ID = 0
+
+ff = followers_following
+te = timeline_entries
+
+timeline_cli = AppGroup('timeline', help='Manage precomputed timelines.')
+
+_stats_lock = threading.Lock()
+plan_stats = {plan: {'count': 0, 'seconds': 0.0} for plan in PLANS}
+
+
+##############################################################################
+# Planning
+
+def stats_select(user_id, now=None):
+    """SELECT (follows, recent) for `user_id`; `recent` is capped."""
+    followed = select(ff.c.following_id).where(ff.c.follower_id == user_id)
+    since = (now or datetime.utcnow()) - ACTIVITY_WINDOW
+    recent = (select(Message.id)
+              .where(Message.user_id.in_(followed), Message.timestamp >= since,
+                     Message.deleted_at.is_(None))
+              .limit(LATERAL_MIN_RECENT)
+              .subquery())
+    return select(
+        select(func.count()).select_from(ff).where(ff.c.follower_id == user_id)
+        .scalar_subquery().label('follows'),
+        select(func.count()).select_from(recent).scalar_subquery().label('recent'))
+
+
+def plan_for(follows, recent, dialect, precomputed=False, warm=0.0):
+    """Name of the cheapest plan for a viewer with these statistics.
+
+    `warm` is the share of the viewer's authors in the recent-message cache.
+    """
+    if follows <= IN_LIST_MAX_FOLLOWS:
+        return 'in_list'
+    if precomputed:
+        return 'precomputed'
+    if warm >= MERGE_MIN_WARM:
+        return 'merge'
+    if dialect != 'postgresql' or recent < LATERAL_MIN_RECENT:
+        return 'in_list'
+    return 'lateral'
+
+
+def choose_plan(user_id):
+    row = db.session.execute(stats_select(user_id)).one()
+    precomputed = current_app.config['TIMELINE_PRECOMPUTED']
+    warm = 0.0
+    if row.follows > IN_LIST_MAX_FOLLOWS and not precomputed and recent_messages.enabled:
+        warm = recent_messages.warm_fraction(author_ids(user_id))
+    return plan_for(row.follows, row.recent, db.engine.dialect.name, precomputed, warm)
+
+
+def record(plan, seconds):
+    g.timeline_plan = (plan, seconds)
+    with _stats_lock:
+        plan_stats[plan]['count'] += 1
+        plan_stats[plan]['seconds'] += seconds
+
+
+def server_timing():
+    """Server-Timing header value for this request's timeline, or None."""
+    if 'timeline_plan' not in g:
+        return None
+    plan, seconds = g.timeline_plan
+    return f'timeline;desc="{plan}";dur={seconds * 1000:.1f}'
+
+
+##############################################################################
+# Plans
+
+def authors_select(user_id):
+    """The viewer and everyone they follow, as one `author_id` column."""
+    return (select(ff.c.following_id.label('author_id')).where(ff.c.follower_id == user_id)
+            .union_all(select(literal(user_id, Integer).label('author_id'))))
+
+
+def top_select(plan, user_id, limit, before=None):
+    """SELECT (id, timestamp) of the newest `limit` timeline messages via `plan`."""
+    msg = aliased(Message)
+    if plan == 'precomputed':
+        stmt = (select(te.c.message_id.label('id'), te.c.timestamp)
+                .join(msg, msg.id == te.c.message_id)
+                .where(te.c.owner_id == user_id, msg.deleted_at.is_(None)))
+        key = (te.c.timestamp, te.c.message_id)
+    elif plan == 'lateral':
+        authors = authors_select(user_id).subquery('authors')
+        per_author = select(msg.id, msg.timestamp).where(msg.user_id == authors.c.author_id,
+                                                         msg.deleted_at.is_(None))
+        if before is not None:
+            per_author = per_author.where(tuple_(msg.timestamp, msg.id) < before)
+        top = (per_author.order_by(msg.timestamp.desc(), msg.id.desc())
+               .limit(limit).lateral('top'))
+        stmt = select(top.c.id, top.c.timestamp).select_from(authors).join(top, true())
+        key = (top.c.timestamp, top.c.id)
+    else:
+        stmt = (select(msg.id, msg.timestamp)
+                .where(msg.user_id.in_(authors_select(user_id)), msg.deleted_at.is_(None)))
+        key = (msg.timestamp, msg.id)
+    if before is not None:
+        stmt = stmt.where(tuple_(*key) < before)
+    return stmt.order_by(key[0].desc(), key[1].desc()).limit(limit)
+
+
+def followed_select(user_id):
+    return select(ff.c.following_id).where(ff.c.follower_id == user_id)
+
+
+def author_ids(user_id):
+    """The viewer's id and the ids of everyone they follow."""
+    return [user_id] + list(db.session.execute(followed_select(user_id)).scalars())
+
+
+def streams_select(authors, per_author, before=None, since=None, with_text=False):
+    """SELECT (user_id, id, timestamp[, text]): each author's newest `per_author` messages."""
+    rank = func.row_number().over(partition_by=Message.user_id,
+                                  order_by=(Message.timestamp.desc(), Message.id.desc()))
+    columns = [Message.user_id, Message.id, Message.timestamp]
+    if with_text:
+        columns.append(Message.text)
+    ranked = select(*columns, rank.label('rank'))
+    ranked = ranked.where(Message.user_id.in_(authors), Message.deleted_at.is_(None))
+    if before is not None:
+        ranked = ranked.where(tuple_(Message.timestamp, Message.id) < before)
+    if since is not None:
+        ranked = ranked.where(Message.timestamp >= since)
+    ranked = ranked.subquery()
+    return (select(*[ranked.c[c.key] for c in columns])
+            .where(ranked.c.rank <= per_author))
+
+
+def group_streams(rows):
+    """Per-author lists of (timestamp, id), newest first, from `streams_select` rows."""
+    streams = defaultdict(list)
+    for row in rows:
+        streams[row.user_id].append((row.timestamp, row.id))
+    return [sorted(stream, reverse=True) for stream in streams.values()]
+
+
+def cached_streams(authors, limit, before=None):
+    """Per-author (timestamp, id) lists from `recent_messages`, filling misses.
+
+    Missing authors are loaded with one query. Authors whose buffer does not
+    reach back past `before` are read from the database directly.
+    """
+    streams, missing, uncovered = [], [], []
+    for author_id, items in recent_messages.get_many(authors, limit, before).items():
+        if items is None:
+            missing.append(author_id)
+        else:
+            streams.append([(ts, msg_id) for msg_id, ts, _ in items])
+
+    if missing:
+        loaded = defaultdict(list)
+        rows = db.session.execute(
+            streams_select(missing, recent_messages.size, with_text=True)).all()
+        for row in rows:
+            loaded[row.user_id].append((row.id, row.timestamp, row.text))
+        for author_id in missing:
+            items = sorted(loaded[author_id], key=lambda i: (i[1], i[0]), reverse=True)
+            recent_messages.load(author_id, items)
+            stream = [(ts, msg_id) for msg_id, ts, _ in items
+                      if before is None or (ts, msg_id) < before]
+            if len(stream) >= limit or len(items) < recent_messages.size:
+                streams.append(stream[:limit])
+            else:
+                uncovered.append(author_id)
+
+    if uncovered:
+        rows = db.session.execute(streams_select(uncovered, limit, before)).all()
+        streams.extend(group_streams(rows))
+    return streams
+
+
+def merge_newest(streams, limit):
+    """Ids of the newest `limit` entries across newest-first (timestamp, id) lists."""
+    return [msg_id for _, msg_id in islice(heapq.merge(*streams, reverse=True), limit)]
+
+
+def merge_windows(before=None):
+    """Lower timestamp bounds to try in turn, as in `partitions.newest_first`."""
+    if not partitioned(db.session.connection()):
+        return [None]
+    upper = before[0] if before else datetime.utcnow()
+    return [None if window is None else upper - window for window in TIMELINE_WINDOWS]
+
+
+def merge_ids(user_id, limit, before=None):
+    authors = author_ids(user_id)
+    if recent_messages.enabled:
+        return merge_newest(cached_streams(authors, limit, before), limit)
+    for since in merge_windows(before):
+        rows = db.session.execute(streams_select(authors, limit, before, since)).all()
+        ids = merge_newest(group_streams(rows), limit)
+        if since is None or len(ids) >= limit:
+            return ids
+
+
+def timeline_condition(plan, user_id, limit, before=None):
+    """WHERE clause on Message selecting the viewer's timeline via `plan`."""
+    if plan == 'in_list':
+        followed = select(ff.c.following_id).where(ff.c.follower_id == user_id)
+        return ((Message.user_id.in_(followed) | (Message.user_id == user_id))
+                & Message.deleted_at.is_(None))
+    top = top_select(plan, user_id, limit, before).subquery()
+    return Message.id.in_(select(top.c.id))
+
+
+def newest_page(stmt, limit, before=None):
+    """Order `stmt` newest first and cut it to `limit` rows before `before`."""
+    if before is not None:
+        stmt = stmt.where(tuple_(Message.timestamp, Message.id) < before)
+    return stmt.order_by(Message.timestamp.desc(), Message.id.desc()).limit(limit)
+
+
+##############################################################################
+# Precomputed timelines
+
+def feed_horizon(user_id):
+    """Horizon of `user_id`'s materialized timeline, or None if there is none."""
+    return db.session.execute(
+        select(te.c.timestamp).where(te.c.owner_id == user_id,
+                                     te.c.message_id == MARKER_ID)).scalar()
+
+
+def materialize(user_id):
+    """Fill `user_id`'s precomputed timeline with their newest TIMELINE_SIZE messages.
+
+    Returns its horizon. Written on the current session; committing it is
+    up to the caller.
+    """
+    plan = 'lateral' if db.engine.dialect.name == 'postgresql' else 'in_list'
+    top = top_select(plan, user_id, TIMELINE_SIZE).subquery()
+    # SQLite can't parse ON CONFLICT after an INSERT ... SELECT without a WHERE.
+    db.session.execute(insert_ignore(te).from_select(
+        ['owner_id', 'message_id', 'timestamp'],
+        select(literal(user_id, Integer), top.c.id, top.c.timestamp).where(true())))
+    count, oldest = db.session.execute(
+        select(func.count(), func.min(te.c.timestamp))
+        .where(te.c.owner_id == user_id, te.c.message_id != MARKER_ID)).one()
+    # A full timeline may have left older messages out.
+    horizon = oldest if count >= TIMELINE_SIZE else FEED_COMPLETE
+    db.session.execute(insert_ignore(te).values(owner_id=user_id, message_id=MARKER_ID,
+                                                timestamp=horizon))
+    return horizon
+
+
+def fan_out(message):
+    """Push a new (flushed) message into every materialized timeline showing it.
+
+    Viewers without a materialized timeline are skipped; theirs is built
+    with the message already in it the next time they read it.
+    """
+    if not current_app.config['TIMELINE_PRECOMPUTED']:
+        return
+    owners = (select(ff.c.follower_id.label('owner_id'))
+              .where(ff.c.following_id == message.user_id)
+              .union(select(literal(message.user_id, Integer).label('owner_id')))
+              .subquery())
+    materialized = select(te.c.owner_id).where(te.c.owner_id == owners.c.owner_id).exists()
+    db.session.execute(insert_ignore(te).from_select(
+        ['owner_id', 'message_id', 'timestamp'],
+        select(owners.c.owner_id, literal(message.id, Integer),
+               literal(message.timestamp, DateTime)).where(materialized)))
+
+
+def trim(keep=TIMELINE_SIZE):
+    """Delete all but the newest `keep` entries of every precomputed timeline."""
+    ranked = select(te.c.owner_id, te.c.message_id, te.c.timestamp,
+                    func.row_number().over(partition_by=te.c.owner_id,
+                                           order_by=te.c.timestamp.desc()).label('rank')
+                    ).where(te.c.message_id != MARKER_ID).subquery()
+    # Trimmed timelines now start at their oldest kept entry.
+    db.session.execute(update(te).where(
+        te.c.message_id == MARKER_ID,
+        te.c.owner_id.in_(select(ranked.c.owner_id).where(ranked.c.rank > keep))
+    ).values(timestamp=select(func.max(ranked.c.timestamp)).where(
+        ranked.c.owner_id == te.c.owner_id, ranked.c.rank == keep).scalar_subquery()))
+    result = db.session.execute(delete(te).where(
+        tuple_(te.c.owner_id, te.c.message_id).in_(
+            select(ranked.c.owner_id, ranked.c.message_id).where(ranked.c.rank > keep))))
+    db.session.commit()
+    return result.rowcount
+
+
+##############################################################################
+# Loading
+
+def _run_plan(plan, user_id, base, execute, limit, before):
+    if plan == 'merge':
+        ids = merge_ids(user_id, limit, before)
+        # Other workers' recent-message caches may still list a deleted message.
+        stmt = base.where(Message.id.in_(ids), Message.deleted_at.is_(None))
+        return execute(newest_page(stmt, limit)) if ids else []
+    stmt = base.where(timeline_condition(plan, user_id, limit, before))
+    if plan == 'in_list' and partitioned(db.session.connection()):
+        return newest_first(lambda s: execute(newest_page(s, limit, before)), stmt, limit,
+                            before[0] if before else None)
+    return execute(newest_page(stmt, limit, before))
+
+
+def load_timeline(user_id, base, execute, limit, before=None, plan=None):
+    """Rows of `base` (a Message select or query) on `user_id`'s timeline.
+
+    `execute(stmt)` returns a list of rows. Pages of `limit` rows go newest
+    first, strictly before the (timestamp, id) pair `before`. `plan` forces
+    a plan instead of choosing one.
+
+    The precomputed plan materializes a missing timeline on the session but
+    does not commit; views that may use it commit once they have read.
+    """
+    start = time.perf_counter()
+    plan = plan or choose_plan(user_id)
+    horizon = None
+    if plan == 'precomputed':
+        horizon = feed_horizon(user_id)
+        if horizon is None:
+            horizon = materialize(user_id)
+
+    rows = _run_plan(plan, user_id, base, execute, limit, before)
+    if plan == 'precomputed' and len(rows) < limit and horizon > FEED_COMPLETE:
+        # Paged past the materialized entries: read older messages directly.
+        plan = 'lateral' if db.engine.dialect.name == 'postgresql' else 'merge'
+        rows = _run_plan(plan, user_id, base, execute, limit, before)
+
+    record(plan, time.perf_counter() - start)
+    return rows
+
+
+@timeline_cli.command('trim')
+@click.option('--keep', default=TIMELINE_SIZE, help='Entries to keep per timeline.')
+def trim_command(keep):
+    """Cut precomputed timelines down to their newest entries."""
+    click.echo(f"Deleted {trim(keep)} timeline entries.")
@@ -0,0 +1,146 @@
+"""Username → user id resolution.
+
+Usernames are matched case-insensitively through `users.username_key`
+(`models.normalize_username`, unique). Profile routing (/users/<username>)
+and follow imports resolve names through `username_ids`, a per-process LRU
+map, so a popular profile's name costs a dict lookup instead of a query.
+
+Names that don't exist are not cached (a signup may claim them at any
+moment). Renames and deletions drop their old key from this worker's map
+when they commit; other workers pick them up once the entry's USERNAME_TTL
+runs out.
+
+Databases created before username_key existed are upgraded with:
+
+    flask usernames migrate
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+import click
+from flask.cli import AppGroup
+from sqlalchemy import event, inspect, select, text
+from sqlalchemy.orm import Session
+
+from models import db, User, normalize_username
+
+USERNAME_CACHE_SIZE = 100_000
+USERNAME_TTL = 300
+MIGRATE_BATCH = 5000
+
+usernames_cli = AppGroup('usernames', help='Maintain the normalized username key.')
+
+
+class UsernameMap:
+    """LRU map of normalized username to user id."""
+
+    def __init__(self, size=USERNAME_CACHE_SIZE, ttl=USERNAME_TTL):
+        self.size = size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._ids = OrderedDict()
+        self._lock = threading.Lock()
+
+    def resolve(self, names):
+        """{name: user id} for those of `names` that exist; one query for misses."""
+        keys = {name: normalize_username(name) for name in names}
+        found, missing = {}, set()
+        expired_before = time.monotonic() - self.ttl
+        with self._lock:
+            for key in set(keys.values()):
+                item = self._ids.get(key)
+                if item is None or item[1] < expired_before:
+                    missing.add(key)
+                else:
+                    self._ids.move_to_end(key)
+                    found[key] = item[0]
+            self.hits += len(found)
+            self.misses += len(missing)
+        if missing:
+            rows = db.session.execute(select(User.username_key, User.id)
+                                      .where(User.username_key.in_(missing))).all()
+            now = time.monotonic()
+            with self._lock:
+                for key, user_id in rows:
+                    found[key] = user_id
+                    self._ids[key] = (user_id, now)
+                    self._ids.move_to_end(key)
+                while len(self._ids) > self.size:
+                    self._ids.popitem(last=False)
+        return {name: found[key] for name, key in keys.items() if key in found}
+
+    def get(self, name):
+        """Id of the user called `name` (any case), or None."""
+        return self.resolve([name]).get(name)
+
+    def discard(self, key):
+        with self._lock:
+            self._ids.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._ids.clear()
+            self.hits = self.misses = 0
+
+
+username_ids = UsernameMap()
+
+
+@event.listens_for(Session, 'before_flush')
+def _note_stale_usernames(session, flush_context, instances):
+    stale = set()
+    for obj in session.deleted:
+        if isinstance(obj, User) and obj.username_key:
+            stale.add(obj.username_key)
+    for obj in session.dirty:
+        if isinstance(obj, User):
+            old = inspect(obj).attrs.username_key.history.deleted
+            stale.update(k for k in old if k)
+    if stale:
+        session.info.setdefault('stale_usernames', set()).update(stale)
+
+
+@event.listens_for(Session, 'after_commit')
+def _drop_stale_usernames(session):
+    for key in session.info.pop('stale_usernames', ()):
+        username_ids.discard(key)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _keep_usernames(session):
+    session.info.pop('stale_usernames', None)
+
+
+@usernames_cli.command('migrate')
+def migrate_command():
+    """Add and backfill users.username_key on an existing database."""
+    engine = db.engine
+    columns = {c['name'] for c in inspect(engine).get_columns('users')}
+    with engine.begin() as conn:
+        if 'username_key' not in columns:
+            conn.execute(text("ALTER TABLE users ADD COLUMN username_key TEXT"))
+        filled = 0
+        while True:
+            rows = conn.execute(text("SELECT id, username FROM users WHERE username_key IS NULL "
+                                     "ORDER BY id LIMIT :n"), {'n': MIGRATE_BATCH}).all()
+            if not rows:
+                break
+            conn.execute(text("UPDATE users SET username_key = :key WHERE id = :id"),
+                         [{'id': id, 'key': normalize_username(name)} for id, name in rows])
+            filled += len(rows)
+
+        clashes = conn.execute(text("SELECT username_key, COUNT(*) FROM users "
+                                    "GROUP BY username_key HAVING COUNT(*) > 1")).all()
+        if clashes:
+            for key, n in clashes:
+                click.echo(f"{n} users share the username {key!r} ignoring case", err=True)
+            raise click.ClickException("Rename the users above, then run migrate again.")
+
+        if engine.dialect.name == 'postgresql':
+            conn.execute(text("ALTER TABLE users ALTER COLUMN username_key SET NOT NULL"))
+        conn.execute(text("CREATE UNIQUE INDEX IF NOT EXISTS ix_users_username_key "
+                          "ON users (username_key)"))
+    click.echo(f"Backfilled {filled} username key(s).")